@@ -34,11 +34,16 @@ http://resighting.wikia.com/wiki/Apiclient.py.
 Requires Python 2.7.
 
 Usage: apiclient.py server-url method [options]
+       apiclient.py server-url --batch=FILE [options]
+       apiclient.py server-url --ingest=FILE [options]
+       apiclient.py server-url --sync=DATABASE --user-id=USER_ID [options]
+       apiclient.py --serve=SOCKET [options]
 
 Arguments:
   server-url            The url of the server where the API is running,
                         e.g. https://resighting-api.appspot.com
   method                The name of the API to invoke. See list below.
+                        Omitted in batch mode.
 
 Methods:
   CreateLocator
@@ -69,24 +74,59 @@ Options:
   -h, --help            show this help message and exit
   --access-token=ACCESS_TOKEN
                         An API access token
+  --all-pages           Follow the cursor returned by a List method and output
+                        the results from every page
   --accuracy=ACCURACY   The accuracy of a latitude and longitude in metres
   --altitude=ALTITUDE   An altitude in metres
   --altitude-accuracy=ALTITUDE_ACCURACY
                         The accuracy of an altitude reading in metres
+  --batch=BATCH         Invoke the API methods listed in a file, one JSON
+                        object per line, or - to read from stdin
   --blobtracker-id=BLOBTRACKER_ID
                         A blobtracker id returned by the Upload API
+  --cache               Cache responses to GET requests on disk and answer
+                        later requests from the cache
+  --cache-dir=CACHE_DIR
+                        The directory responses to GET requests are cached in,
+                        which turns on caching. Defaults to ~/.apiclient/cache
+                        with --cache.
+  --cache-size=CACHE_SIZE
+                        The maximum number of bytes of responses kept in the
+                        cache. The least recently used are removed first.
+  --checkpoint-file=CHECKPOINT_FILE
+                        The file recording the progress of a resumable upload
+                        or of an ingest. Defaults to the file to upload or
+                        ingest with .checkpoint added.
+  --chunk-size=CHUNK_SIZE
+                        The number of bytes sent in each request of a
+                        resumable upload
   --closed              A closed locator requiring approval to join
+  --concurrency=CONCURRENCY
+                        The number of API methods invoked at the same time in
+                        batch, ingest or sync mode
   --cursor=CURSOR       A cursor returned by a previous call to the method
                         marking the point where listing should continue from
+  --daemon=SOCKET       The Unix socket of an apiclient.py daemon to forward
+                        the command to. Defaults to the APICLIENT_DAEMON
+                        environment variable.
   --date=DATE           A date in the format YYYY-MM-DD
   --description=DESCRIPTION
                         A description
   --end-date=END_DATE   A date or datetime in ISO 8601 format
+  --export=PATH         Export the Sightings from every page of a List method
+                        as columns of numbers that NumPy can load, to a .npz
+                        file or else to a directory of .npy files
   --fetch-size=FETCH_SIZE
                         The number of results to retrieve
   --filename=FILENAME   A file to upload
   --heading=HEADING     A heading
   --hold                Place a Sighting on hold
+  --ingest=FILE         Create a Sighting for each row of a CSV file with a
+                        header row naming the CreateSighting options, or for
+                        each point of a GPX file
+  --idle-timeout=IDLE_TIMEOUT
+                        The number of seconds an idle connection to the server
+                        is kept open for reuse
   --latitude=LATITUDE   A latitude
   --list-type=LIST_TYPE
                         The type of list to request: latest or nearest
@@ -95,40 +135,73 @@ Options:
                         A Locator id. Multiple can be specified.
   --longitude=LONGITUDE
                         A longitude
+  --max-per-host=MAX_PER_HOST
+                        The maximum number of requests made to a single server
+                        at the same time
+  --max-requests-per-connection=MAX_REQUESTS_PER_CONNECTION
+                        The maximum number of requests sent over a single
+                        connection to the server
+  --mmap-upload         Memory-map the file to upload and send it without
+                        copying it into memory
   --name=NAME           A name
+  --no-cache            Do not cache responses to GET requests or use cached
+                        responses, even if --cache or --cache-dir is given
   --no-hold             Do not place a Sighting on hold
   --no-publish-to-facebook
                         Do not publish a Sighting to the user's Facebook wall
   --no-tweet-sighting   Do not tweet a Sighting
   --options             Send an OPTIONS HTTP request to the server
+  --output=FORMAT       How the response is written: pretty (indented JSON,
+                        the default), compact (JSON on one line), ndjson (one
+                        line of JSON per result of a List method) or raw (the
+                        response body unchanged)
+  --pool-size=POOL_SIZE
+                        The maximum number of idle connections kept open per
+                        server
   --publish-to-facebook
                         Publish a Sighting to the user's Facebook wall
+  --rate=RATE           The maximum number of requests made per second
+  --resumable           Upload a file in chunks that can be resumed if the
+                        upload is interrupted. The upload url must support
+                        resumable uploads.
+  --retries=RETRIES     The number of times a request the server throttles
+                        with a 429 or 503 response is retried
+  --retry-posts         Retry throttled POST requests as well as GET requests.
+                        A retried POST may create a duplicate.
   --sandbox             Invoke the API in sandbox mode
+  --serve=SOCKET        Run as a daemon accepting commands on a Unix socket,
+                        keeping connections open between them
   --sighting-id=SIGHTING_ID
                         A Sighting id
   --speed=SPEED         A speed
   --start-date=START_DATE
                         A date or datetime in ISO 8601 format
+  --sync=DATABASE       Mirror the Sightings of the user given by --user-id,
+                        with their Resightings and Locators, into a SQLite
+                        database, fetching only those updated since the last
+                        sync
+  --timing              Write the time spent in each phase of the request,
+                        such as DNS, connect, TLS and waiting for the
+                        response, to stderr as JSON. In batch mode the times
+                        are added to each result.
   --tweet-sighting      Tweet a Sighting
   --tz-offset=TZ_OFFSET
                         The number of minutes that the user's timezone is
                         offset from UTC. Valid values are from -720
                         (UTC-12:00) to 840 (UTC+14:00).
+  --unordered           Output batch or ingest results as soon as each
+                        completes rather than in order
   --upload-url=UPLOAD_URL
                         The url to upload the file to
   --user-id=USER_ID     A user's id
 """
 
-import datetime
-import httplib
-import json
-import socket
+import errno
+import os
+import re
 import sys
-import urllib
-import urllib2
-import urlparse
-
-from optparse import OptionParser
+import threading
+import time
 
 # The base path to version 1 of the API
 _API_ROOT_PATH = 'api/1'
@@ -138,1029 +211,2683 @@ class Error(Exception):
     """
     pass
 
-def encode_post_data(params, files=None):
-    """Create POST data for an HTTP request.
-    
-    If the files argument is None then the parameters specified in the params
-    argument are added to the post data in x-www-form-urlencode form. If the
-    files argument is not None then a multipart/form-data post is constructed
-    containing the files and parameters.
-    
-    Arguments:
-    params - A dictionary containing any required HTTP parameters. The key is used
-             as the parameter name and the value is the parameter value. If the
-             parameter value is a list or a tuple then multiple parameters are
-             added to the request each with the same name, one for each value in
-             the list/tuple.
-    files - (optional) A dictionary containing files to be added to the request.
-            The key is used as the parameter name and filename in the request and the
-            value is the file data. If the parameter value is a list or a tuple then
-            multiple files are added to the request each with the same name, one for
-            each value (file data) in the list/tuple.
-    
-    Returns:
-    A tuple containing first the POST data and second the content type.
-    """
-    data = None
-    content_type = None
-
-    if files is None:
-        # application/x-www-form-urlencoded
-        data = ''
-        content_type = 'application/x-www-form-urlencoded charset=utf-8'
+class APIError(Error):
+    """Exception raised when an API method returns a response other than 200
+    where the response cannot be returned to the caller directly.
 
-        if params is not None:
-            for name, value in params.viewitems():
-                # The value can be a list or tuple of multiple values.
-                # In this case we added multiple parameters to the request, each with the
-                # same name.
-                if isinstance(value, (list, tuple)):
-                    multi_value = value
-                else:
-                    multi_value = [value]
-            
-                for i_value in multi_value:
-                    if len(data) > 0:
-                        data += '&'
+    Attributes:
+    status_code - The HTTP status code.
+    response - The response body.
+    headers - The response headers.
+    """
+    def __init__(self, status_code, response, headers):
+        Error.__init__(self, 'HTTP Response Code: %d' % status_code)
+        self.status_code = status_code
+        self.response = response
+        self.headers = headers
+
+# Default settings for the pool of persistent connections to the API server
+_DEFAULT_POOL_SIZE = 4
+_DEFAULT_IDLE_TIMEOUT = 60.0
+_DEFAULT_MAX_REQUESTS_PER_CONNECTION = 100
+
+# The maximum number of redirects followed for a single request
+_MAX_REDIRECTS = 10
+
+# Responses that mean the server is throttling requests. These are retried,
+# after waiting for the time given in any Retry-After header or else for an
+# exponentially increasing, randomly jittered time.
+_THROTTLED_STATUS_CODES = frozenset([429, 503])
+_DEFAULT_RETRIES = 3
+
+# How a RateLimiter adapts its rate. It never falls below _MIN_RATE requests
+# per second and grows back by _RATE_INCREASE of the maximum rate per second.
+_MIN_RATE = 0.1
+_RATE_INCREASE = 0.1
+_RETRY_BACKOFF = 0.5
+_MAX_RETRY_BACKOFF = 30.0
+
+# Requests that can be retried without the risk of repeating their effects
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# The size of the chunks response bodies are read in
+_READ_CHUNK_SIZE = 65536
+
+# Used when decoding JSON responses incrementally. _JSON_SKIP matches strings
+# and brackets so that a list can be skipped over without decoding it.
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_SKIP = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+def header_value(headers, name):
+    """Get the value of a header from a list of raw header lines.
 
-                    if i_value is None:
-                        data += '%s=' % (urllib.quote_plus(name))
-                    else:
-                        data += '%s=%s' % (urllib.quote_plus(name), urllib.quote_plus(i_value))
-    else:
-        # multipart/form-data
-        boundary = 'c281a12c-c3e2-4c17-969b-9dbf859af2ee'
-        data = ''
-        content_type = 'multipart/form-data; boundary=%s' % boundary
+    Arguments:
+    headers - The list of raw header lines.
+    name - The lower case name of the header.
 
-        # Add HTTP parameters
-        if params is not None:
-            for name, value in params.viewitems():
-                # The value can be a list or tuple of multiple values.
-                # In this case we added multiple parameters to the request, each with the
-                # same name.
-                if isinstance(value, (list, tuple)):
-                    multi_value = value
-                else:
-                    multi_value = [value]
-            
-                for i_value in multi_value:
-                    data += '\r\n--%s\r\n' % boundary
-                    data += 'Content-Disposition: form-data; name="%s"\r\n\r\n' % urllib.quote_plus(name)
-                    
-                    if i_value is not None:
-                        data += urllib.quote_plus(i_value)
+    Returns:
+    The value of the last header with the name, or None if there is none.
+    """
+    found = None
 
-        # Add any files to be uploaded
-        if files is not None:
-            for name, file_data in files.viewitems():
-                # The file data can be a list or tuple of data from multiple files.
-                # In this case we added multiple files to the request, each with the
-                # same name.
-                if isinstance(file_data, (list, tuple)):
-                    multi_file_data = file_data
-                else:
-                    multi_file_data = [file_data]
-            
-                for i_file_data in multi_file_data:
-                    data += '\r\n--%s\r\n' % boundary
-                    data += 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (urllib.quote_plus(name), urllib.quote_plus(name))
-                    data += 'Content-Type: application/octet-stream\r\n\r\n'
-                    
-                    if i_file_data is not None:
-                        data += i_file_data
+    for header in headers:
+        header_name, _, value = header.partition(':')
 
-        # Add final boundary
-        data += '\r\n--%s--\r\n' % boundary
+        if header_name.strip().lower() == name:
+            found = value.strip()
 
-    return data, content_type
+    return found
 
-# The following api_* functions take the url of the server where the API is
-# running and the options specified on the command-line and return a tuple
-# containing the url for the particular API method, the POST data to send
-# with the request and the POST data content type. For GET requests the latter
-# two are None.
+def _retry_after(headers):
+    """Get the number of seconds to wait from a Retry-After header, which is
+    either a number of seconds or an HTTP date.
 
-def api_createlocator(server_url, opts):
-    """Construct the url and POST data for a call to the CreateLocator API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
     Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
+    The number of seconds, or None if there is no valid Retry-After header.
     """
-    method_url = u'{0}/{1}/locators'.format(server_url, _API_ROOT_PATH)
+    value = header_value(headers, 'retry-after')
 
-    params = {}
-    
-    if opts.access_token is not None:
-        params[u'access_token'] = opts.access_token
+    if value is None:
+        return None
 
-    if opts.closed:
-        params[u'closed'] = 'true'
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
 
-    if opts.description is not None:
-        params[u'description'] = opts.description
+    # Only imported for a date as it is slow to import, and this is checked
+    # for every response
+    import email.utils
 
-    if opts.name is not None:
-        params[u'name'] = opts.name
+    date = email.utils.parsedate_tz(value)
 
-    if opts.sandbox:
-        params[u'sandbox'] = 'true'
+    if date is None:
+        return None
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+def _retry_delay(headers, attempt):
+    """Get the number of seconds to wait before retrying a throttled request.
 
-def api_createlocatorsighting(server_url, opts):
-    """Construct the url and POST data for a call to the CreateLocatorSighting API method.
-    
     Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
+    headers - The headers of the throttled response.
+    attempt - The number of times the request has already been retried.
     """
-    # The url requires a locator_id so this is mandatory
-    if opts.locator_id is None:
-        raise Error('A locator-id is required for this API method')
-    
-    method_url = '%s/%s/locators/%s/sightings' % (server_url, _API_ROOT_PATH, opts.locator_id[0])
-    
-    params = {}
+    import random
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    backoff = random.uniform(0, min(_MAX_RETRY_BACKOFF, _RETRY_BACKOFF * 2 ** attempt))
+    retry_after = _retry_after(headers)
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+    if retry_after is None:
+        return backoff
 
-    if opts.user_id is not None:
-        params['user_id'] = opts.user_id
-        
-    if opts.sighting_id is not None:
-        params['sighting_id'] = opts.sighting_id
+    return max(retry_after, backoff)
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+def _follow_redirect(response, http_method, url, body, headers):
+    """Work out the request to make to follow a redirect response.
+
+    Redirects are followed in the same way as urllib2, i.e. a POST that is
+    redirected with a 301, 302 or 303 becomes a GET without a body and a POST
+    that is redirected with a 307 is not followed.
 
-def api_createsighting(server_url, opts):
-    """Construct the url and POST data for a call to the CreateSighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
     Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
+    A tuple containing the HTTP method, url, body and headers of the request
+    to make, or None if the response is not a redirect that can be followed.
     """
-    method_url = '%s/%s/sightings' % (server_url, _API_ROOT_PATH)
+    import urlparse
 
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    if response.status_code not in (301, 302, 303, 307) or http_method not in ('GET', 'HEAD', 'POST'):
+        return None
 
-    if opts.accuracy is not None:
-        params['accuracy'] = opts.accuracy
+    if response.status_code == 307 and http_method == 'POST':
+        return None
 
-    if opts.altitude is not None:
-        params['altitude'] = opts.altitude
+    location = header_value(response.headers, 'location')
 
-    if opts.altitude_accuracy is not None:
-        params['altitude_accuracy'] = opts.altitude_accuracy
+    if location is None:
+        return None
 
-    if opts.blobtracker_id is not None:
-        params['blobtracker_id'] = opts.blobtracker_id
+    url = urlparse.urljoin(url, location)
 
-    if opts.description is not None:
-        params['description'] = opts.description
+    if http_method == 'POST':
+        http_method = 'GET'
+        body = None
+        headers = dict(headers)
+        headers.pop('Content-Type', None)
 
-    if opts.heading is not None:
-        params['heading'] = opts.heading
+    return http_method, url, body, headers
 
-    if opts.hold:
-        params['hold'] = 'true'
+# The content codings the client accepts, and decodes, in responses
+_ACCEPT_ENCODING = 'gzip, deflate'
+
+class _ContentDecoder(object):
+    """Decompresses a gzip or deflate encoded response body chunk by chunk.
+    """
+    def __init__(self, encoding):
+        import zlib
 
-    if opts.latitude is not None:
-        params['latitude'] = opts.latitude
+        self._encoding = encoding
+        self._started = False
 
-    if opts.locator_id is not None:
-        params['locator_id'] = opts.locator_id
+        if encoding == 'deflate':
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-    if opts.longitude is not None:
-        params['longitude'] = opts.longitude
+    def decompress(self, data):
+        """Decompress the next chunk of the body.
 
-    if opts.publish_to_facebook:
-        params['publish_to_facebook'] = 'true'
+        Raises:
+        httplib.HTTPException if the body is not validly encoded.
+        """
+        import httplib
+        import zlib
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+        try:
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                # Some servers send raw deflate data without the zlib header
+                if self._started or self._encoding != 'deflate':
+                    raise
+
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self._decompressor.decompress(data)
+            finally:
+                self._started = True
+        except zlib.error:
+            raise httplib.HTTPException('Invalid %s encoded response' % self._encoding)
+
+    def flush(self):
+        """Get the rest of the decompressed body once all of it has been read.
+        """
+        import httplib
+        import zlib
 
-    if opts.speed is not None:
-        params['speed'] = opts.speed
+        try:
+            return self._decompressor.flush()
+        except zlib.error:
+            raise httplib.HTTPException('Invalid %s encoded response' % self._encoding)
 
-    if opts.tweet_sighting:
-        params['tweet_sighting'] = 'true'
+def _content_decoder(headers):
+    """Get a _ContentDecoder for a response body from the response headers, or
+    None if the body is not compressed.
+    """
+    encoding = (header_value(headers, 'content-encoding') or '').strip().lower()
 
-    if opts.tz_offset is not None:
-        params['tz_offset'] = opts.tz_offset
+    if encoding in ('gzip', 'x-gzip'):
+        return _ContentDecoder('gzip')
+    elif encoding == 'deflate':
+        return _ContentDecoder('deflate')
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+    return None
+
+# The ids of the monotonic clock for clock_gettime on macOS, and elsewhere
+_CLOCK_MONOTONIC_DARWIN = 6
+_CLOCK_MONOTONIC = 1
+
+def _monotonic_clock():
+    """Get a function returning the time in seconds from a monotonic clock,
+    which unlike time.time never jumps when the system time is changed.
 
-def api_getdailysighting(server_url, opts):
-    """Construct the url for a call to the GetDailySighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
     Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no date was specified on the command-line or if the date is not
-    a valid date.
+    time.monotonic if available, else a function calling clock_gettime
+    through ctypes, else time.time if neither is available.
     """
-    # The url requires a date so this is mandatory
-    if opts.date is None:
-        raise Error('A date is required for this API method')
-    
-    # Check the date is a valid date
-    d = None
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
     try:
-        d = datetime.datetime.strptime(opts.date, '%Y-%m-%d')
-    except ValueError:
-        raise Error('The date is invalid')
-    
-    params = {}
+        import ctypes
+    except ImportError:
+        return time.time
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
 
-    method_url = '%s/%s/dailysightings/%04d/%02d/%02d?%s' % (server_url, _API_ROOT_PATH, d.year, d.month, d.day, urllib.urlencode(params))
+    clock_gettime = None
 
-    return method_url, None, None
+    # clock_gettime is in the C library, or in librt with older glibc
+    for library in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
 
-def api_getsighting(server_url, opts):
-    """Construct the url for a call to the GetSighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id or sighting_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
-        
-    params = {}
+    if clock_gettime is None:
+        return time.time
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    clock_id = _CLOCK_MONOTONIC_DARWIN if sys.platform == 'darwin' else _CLOCK_MONOTONIC
 
-    method_url = '%s/%s/sightings/%s/%s?%s' % (server_url, _API_ROOT_PATH, opts.user_id, opts.sighting_id, urllib.urlencode(params))
+    if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+        return time.time
 
-    return method_url, None, None
+    def monotonic():
+        now = timespec()
+        clock_gettime(clock_id, ctypes.byref(now))
 
-def api_getuser(server_url, opts):
-    """Construct the url for a call to the GetUser API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
-    
-    method_url = '%s/%s/users/%s?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
-    
-    return method_url, None, None
+        return now.tv_sec + now.tv_nsec * 1e-9
 
-def api_getuserstatistics(server_url, opts):
-    """Construct the url for a call to the GetUserStatistics API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
-    
-    method_url = '%s/%s/users/%s/statistics?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
-    
-    return method_url, None, None
+    return monotonic
 
-def api_listlocators(server_url, opts):
-    """Construct the url for a call to the ListLocators API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
+# Loaded the first time a request is timed
+_monotonic = None
+
+def monotonic():
+    """Get the time in seconds from a monotonic clock. Only differences
+    between times are meaningful.
     """
-    params = {}
+    global _monotonic
+
+    if _monotonic is None:
+        _monotonic = _monotonic_clock()
+
+    return _monotonic()
+
+class RequestTiming(object):
+    """The time spent in each phase of an HTTP request, measured with a
+    monotonic clock.
+
+    Pass a RequestTiming to ConnectionPool.open or request, or to invoke_api,
+    to have it filled in as the request is made. Phases that did not happen
+    are None, e.g. dns, connect and tls for a request sent over a connection
+    reused from the pool. When a request is retried or redirected the phases
+    are those of the last request sent, and total covers them all.
+
+    Attributes, in seconds:
+    wait - Waiting for the RateLimiter or for the limit on requests to the
+           host.
+    dns - Resolving the host name.
+    connect - Opening the TCP connection.
+    tls - The TLS handshake.
+    send - Sending the request.
+    ttfb - From sending the request to receiving the response headers, which
+           is mostly the time taken by the server.
+    download - Reading the response body.
+    parse - Decoding the JSON response, recorded by the caller that decodes
+            it. None if the response was decoded as it was read, in which case
+            decoding is part of download.
+    total - From the start of the request, once it has been built, until the
+            last phase recorded.
+
+    Other attributes:
+    requests - The number of requests sent, including retries and redirects.
+    reused - True if the last request was sent over a reused connection.
+    cached - True if the response was answered from a ResponseCache without
+             a request.
+    """
+    PHASES = ('wait', 'dns', 'connect', 'tls', 'send', 'ttfb', 'download', 'parse')
+
+    def __init__(self):
+        self.start = self.end = monotonic()
+        self.requests = 0
+        self.reused = None
+        self.cached = False
+
+        for phase in self.PHASES:
+            setattr(self, phase, None)
+
+    @property
+    def total(self):
+        return self.end - self.start
+
+    def begin(self):
+        """Record that the request is starting.
+        """
+        self.start = self.end = monotonic()
+
+    def record(self, phase, since):
+        """Record the time spent in a phase, from a time until now.
+
+        Arguments:
+        phase - The name of the phase, e.g. dns.
+        since - The monotonic time the phase started.
+
+        Returns:
+        The monotonic time now, which is when the next phase starts.
+        """
+        now = monotonic()
+        setattr(self, phase, now - since)
+        self.end = now
+
+        return now
+
+    def _new_request(self, reused):
+        """Start recording the phases of another request.
+        """
+        self.requests += 1
+        self.reused = reused
+        self.dns = self.connect = self.tls = None
+        self.send = self.ttfb = self.download = None
+
+    def to_dict(self):
+        """Get the timings in milliseconds, e.g. to encode as JSON.
+
+        Returns:
+        A dictionary holding each phase that happened, the total and the
+        number of requests, and whether the connection was reused or the
+        response was cached.
+        """
+        timings = dict((phase, round(getattr(self, phase) * 1000, 3)) for phase in self.PHASES
+                       if getattr(self, phase) is not None)
+        timings['total'] = round(self.total * 1000, 3)
+        timings['requests'] = self.requests
+
+        if self.reused is not None:
+            timings['reused'] = self.reused
+
+        if self.cached:
+            timings['cached'] = True
+
+        return timings
+
+def _connect_timed(connection, timing):
+    """Open an httplib connection, recording the time taken to resolve the
+    host, connect and for any TLS handshake.
+    """
+    import httplib
+    import socket
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    start = monotonic()
+    addresses = socket.getaddrinfo(connection.host, connection.port, 0, socket.SOCK_STREAM)
+    start = timing.record('dns', start)
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+    # Try each address in turn, as socket.create_connection does
+    sock = None
+    error = socket.error('getaddrinfo returns an empty list')
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+    for family, socktype, proto, _, address in addresses:
+        sock = socket.socket(family, socktype, proto)
 
-    method_url = '%s/%s/locators?%s' % (server_url, _API_ROOT_PATH, urllib.urlencode(params))
+        try:
+            if connection.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(connection.timeout)
 
-    return method_url, None, None
+            sock.connect(address)
+            break
+        except socket.error as e:
+            error = e
+            sock.close()
+            sock = None
 
-def api_listlocatorsightings(server_url, opts):
-    """Construct the url for a call to the ListLocatorSightings API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no locator_id was specified on the command-line.
+    if sock is None:
+        raise error
+
+    # Ask a proxy for a tunnel to the server, as HTTPSConnection.connect does
+    tunnel_host = getattr(connection, '_tunnel_host', None)
+
+    if tunnel_host:
+        connection.sock = sock
+        connection._tunnel()
+
+    start = timing.record('connect', start)
+
+    if isinstance(connection, httplib.HTTPSConnection):
+        import ssl
+
+        # Wrapped as HTTPSConnection.connect does, so that the certificate is
+        # checked in the same way
+        context = getattr(connection, '_context', None)
+
+        try:
+            if context is not None:
+                sock = context.wrap_socket(sock, server_hostname=tunnel_host or connection.host)
+            else:
+                sock = ssl.wrap_socket(sock, connection.key_file, connection.cert_file)
+        except:
+            sock.close()
+            raise
+
+        timing.record('tls', start)
+
+    connection.sock = sock
+
+class Response(object):
+    """The response to an HTTP request made through a ConnectionPool.
+
+    Attributes:
+    status_code - The HTTP status code.
+    headers - The response headers as a list of raw header lines.
+    body - The response body, decompressed if it was compressed.
+    compressed_bytes - The size of the body as received.
+    uncompressed_bytes - The size of the body once decompressed.
     """
-    # The url requires a locator_id so this is mandatory
-    if opts.locator_id is None:
-        raise Error('A locator-id is required for this API method')
-    
-    params = {}
+    def __init__(self, status_code, headers, body, compressed_bytes=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.uncompressed_bytes = len(body)
+
+        if compressed_bytes is None:
+            self.compressed_bytes = self.uncompressed_bytes
+        else:
+            self.compressed_bytes = compressed_bytes
+
+class StreamingResponse(object):
+    """The response to an HTTP request made through a ConnectionPool whose body
+    is read from the connection in chunks as it is consumed.
+
+    The connection is returned to the pool once the whole body has been read.
+    If the response is closed before then the connection is closed. A gzip or
+    deflate encoded body is decompressed as it is read.
+
+    Attributes:
+    url - The url that was requested.
+    status_code - The HTTP status code.
+    headers - The response headers as a list of raw header lines.
+    compressed_bytes - The number of bytes of the body read so far, as
+                       received.
+    uncompressed_bytes - The number of bytes of the body read so far, once
+                         decompressed.
+    timing - The RequestTiming recording the request, or None.
+    """
+    def __init__(self, url, http_response, on_finish, timing=None):
+        self.url = url
+        self.status_code = http_response.status
+        self.headers = http_response.msg.headers
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.timing = timing
+        self._http_response = http_response
+        self._on_finish = on_finish
+        self._decoder = _content_decoder(self.headers)
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+        if timing is not None:
+            self._received = monotonic()
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+    def _finish(self, reusable):
+        if self._on_finish is not None:
+            on_finish, self._on_finish = self._on_finish, None
 
-    if opts.end_date is not None:
-        params['end_date'] = opts.end_date
+            if self.timing is not None:
+                self.timing.record('download', self._received)
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+            on_finish(reusable)
 
-    if opts.latitude is not None:
-        params['latitude'] = opts.latitude
+    def iter_chunks(self, chunk_size=_READ_CHUNK_SIZE):
+        """Read the body of the response in chunks.
 
-    if opts.list_type is not None:
-        params['list_type'] = opts.list_type
+        Arguments:
+        chunk_size - (optional) The maximum size of each chunk.
 
-    if opts.longitude is not None:
-        params['longitude'] = opts.longitude
+        Returns:
+        A generator yielding each chunk of the body as it is read.
 
-    if opts.start_date is not None:
-        params['start_date'] = opts.start_date
+        Raises:
+        httplib.HTTPException or socket.error if reading fails.
+        """
+        completed = False
 
-    method_url = '%s/%s/locators/%s/sightings?%s' % (server_url, _API_ROOT_PATH, opts.locator_id[0], urllib.urlencode(params))
+        try:
+            while True:
+                chunk = self._http_response.read(chunk_size)
 
-    return method_url, None, None
+                if not chunk:
+                    break
 
-def api_listresightings(server_url, opts):
-    """Construct the url for a call to the ListResightings API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id or sighting_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
-        
-    params = {}
+                self.compressed_bytes += len(chunk)
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+                if self._decoder is not None:
+                    chunk = self._decoder.decompress(chunk)
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+                    if not chunk:
+                        continue
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+                self.uncompressed_bytes += len(chunk)
+                yield chunk
 
-    method_url = '%s/%s/sightings/%s/%s/resightings?%s' % (server_url, _API_ROOT_PATH, opts.user_id, opts.sighting_id, urllib.urlencode(params))
+            if self._decoder is not None:
+                chunk = self._decoder.flush()
 
-    return method_url, None, None
+                if chunk:
+                    self.uncompressed_bytes += len(chunk)
+                    yield chunk
 
-def api_listsightinglocators(server_url, opts):
-    """Construct the url for a call to the ListSightingLocators API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id or sighting_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
-        
-    params = {}
+            completed = True
+        finally:
+            self._finish(completed and not self._http_response.will_close)
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    def read(self):
+        """Read the whole body of the response, decompressed if it was
+        compressed.
+        """
+        return ''.join(self.iter_chunks())
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+    def close(self):
+        """Stop reading the response, closing the connection if the body has
+        not been read in full.
+        """
+        self._finish(False)
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+class _PooledConnection(object):
+    """An httplib connection along with the bookkeeping needed to decide
+    whether it can be reused.
 
-    method_url = '%s/%s/sightings/%s/%s/locators?%s' % (server_url, _API_ROOT_PATH, opts.user_id, opts.sighting_id, urllib.urlencode(params))
+    Attributes:
+    proxy_headers - The headers to add to each request if the connection is
+                    to a proxy that forwards http requests, or None if the
+                    connection is to the server or a tunnel through a proxy.
+    """
+    def __init__(self, connection, proxy_headers=None):
+        self.connection = connection
+        self.proxy_headers = proxy_headers
+        self.requests = 0
+        self.last_used = time.time()
 
-    return method_url, None, None
+def _proxy_for(scheme, netloc):
+    """Find the proxy to connect to a host through from the environment, e.g.
+    the http_proxy, https_proxy and no_proxy variables, as urllib2 does.
 
-def api_listsightings(server_url, opts):
-    """Construct the url for a call to the ListSightings API method.
-    
     Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
+    scheme - The scheme of the url, http or https.
+    netloc - The host and optional port of the url.
+
     Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
+    A tuple containing the host and port of the proxy and a dictionary of
+    the headers to send it, or None if the host is connected to directly.
+
+    Raises:
+    Error if the proxy is not an http:// proxy.
     """
-    params = {}
+    import base64
+    import urllib
+    import urlparse
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    proxy = urllib.getproxies().get(scheme)
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+    if not proxy or urllib.proxy_bypass(urlparse.urlsplit('//' + netloc).hostname or netloc):
+        return None
 
-    if opts.end_date is not None:
-        params['end_date'] = opts.end_date
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+    parts = urlparse.urlsplit(proxy)
 
-    if opts.latitude is not None:
-        params['latitude'] = opts.latitude
+    if parts.scheme != 'http' or not parts.hostname:
+        raise Error('Unsupported %s proxy: %s' % (scheme, proxy))
 
-    if opts.list_type is not None:
-        params['list_type'] = opts.list_type
+    headers = {}
 
-    if opts.longitude is not None:
-        params['longitude'] = opts.longitude
+    if parts.username is not None:
+        credentials = '%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
 
-    if opts.start_date is not None:
-        params['start_date'] = opts.start_date
+    return parts.netloc.rpartition('@')[2], headers
 
-    method_url = '%s/%s/sightings?%s' % (server_url, _API_ROOT_PATH, urllib.urlencode(params))
+def _body_chunks(body):
+    """Get the chunks to send for a request body that is not a string. A buffer
+    is sent as a single chunk and anything else, such as a MultipartBody, is
+    iterated over.
+    """
+    if isinstance(body, buffer):
+        return [body]
 
-    return method_url, None, None
+    return body
 
-def api_listusercountrystatistics(server_url, opts):
-    """Construct the url for a call to the ListUserCountryStatistics API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
+def _send_streaming(connection, http_method, path, body, headers):
+    """Send a request with a body that is a buffer or is produced in chunks,
+    such as a MultipartBody, over an httplib connection.
     """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    connection.putrequest(http_method, path)
+
+    for name, value in headers.viewitems():
+        connection.putheader(name, value)
+
+    connection.putheader('Content-Length', str(len(body)))
+    connection.endheaders()
+
+    for chunk in _body_chunks(body):
+        # Send the chunk directly to the socket rather than with sendall, which
+        # copies what remains of the chunk for an SSL socket after a partial
+        # send, so that buffers over a memory-mapped file are not copied
+        sent = 0
+
+        while sent < len(chunk):
+            sent += connection.sock.send(buffer(chunk, sent))
+
+class RateLimiter(object):
+    """Paces the requests made through a ConnectionPool and adapts how many
+    are made at the same time to throttling by the server.
+
+    Requests take a token from a bucket that is refilled at the current rate.
+    Both the rate and the number of requests in progress adapt to throttling
+    by halving when the server responds with 429 or 503 and growing again
+    with every other response (additive increase, multiplicative decrease).
+    The rate never grows beyond the rate given and the number of requests in
+    progress is unlimited until the first throttled response. A Retry-After
+    header on a throttled response also holds back every request until that
+    time has passed.
+
+    Attributes:
+    rate - The current number of requests per second, or None.
+    concurrency - The current limit on requests in progress, or None.
+    throttled - The number of throttled responses received.
+    """
+    def __init__(self, rate=None, burst=None, max_concurrency=None):
+        """Create a rate limiter.
+
+        Arguments:
+        rate - (optional) The maximum number of requests per second. If not
+               specified requests are not paced.
+        burst - (optional) The number of requests that can be made at once
+                after a pause. Defaults to 1, which spaces requests evenly.
+        max_concurrency - (optional) The maximum number of requests in
+                          progress at the same time, which the window never
+                          grows beyond.
+        """
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst or 1.0
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.throttled = 0
+        self._condition = threading.Condition()
+        self._tokens = self.burst
+        self._filled = time.time()
+        self._in_flight = 0
+        self._paused_until = 0
+        self._epoch = 0
+
+    def _wait_time(self, now):
+        """Get the time to wait before a request can be made, 0 if it can be
+        made now or None if it must wait for a request to complete.
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        if self.concurrency is not None and self._in_flight >= int(self.concurrency):
+            return None
+
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._filled) * self.rate)
+            self._filled = now
+
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+        return 0
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+    def acquire(self):
+        """Wait until a request can be made.
 
-    method_url = '%s/%s/users/%s/statistics/countries?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
+        Returns:
+        A ticket to pass to release once the response has been read.
+        """
+        with self._condition:
+            while True:
+                wait = self._wait_time(time.time())
 
-    return method_url, None, None
+                if wait == 0:
+                    break
 
-def api_listuserlocalitystatistics(server_url, opts):
-    """Construct the url for a call to the ListUserLocalityStatistics API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+                self._condition.wait(wait)
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+            if self.rate is not None:
+                self._tokens -= 1
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+            self._in_flight += 1
 
-    method_url = '%s/%s/users/%s/statistics/localities?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
+            return self._epoch
 
-    return method_url, None, None
+    def release(self, ticket, status_code=None, retry_after=None):
+        """Record that a request has completed.
 
-def api_listuserlocators(server_url, opts):
-    """Construct the url for a call to the ListUserLocators API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+        Arguments:
+        ticket - The ticket returned by acquire.
+        status_code - (optional) The HTTP status code of the response, or None
+                      if the request failed.
+        retry_after - (optional) The number of seconds a throttled response
+                      asked for requests to be held back.
+        """
+        with self._condition:
+            self._in_flight -= 1
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+            if status_code in _THROTTLED_STATUS_CODES:
+                self.throttled += 1
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+                # Only back off once for the requests made before backing off
+                if ticket == self._epoch:
+                    window = self.concurrency or self._in_flight + 1
+                    self.concurrency = max(1.0, window / 2.0)
+                    self._epoch += 1
 
-    method_url = '%s/%s/users/%s/locators?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
+                    if self.rate is not None:
+                        self.rate = max(_MIN_RATE, self.rate / 2.0)
 
-    return method_url, None, None
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, time.time() + retry_after)
+            elif status_code is not None:
+                if self.concurrency is not None:
+                    # Grow by one for every window's worth of responses
+                    self.concurrency += 1.0 / self.concurrency
 
-def api_listusersightings(server_url, opts):
-    """Construct the url for a call to the ListUserSightings API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    
-    Raises:
-    Error if no user_id was specified on the command-line.
+                    if self.max_concurrency is not None:
+                        self.concurrency = min(self.concurrency, self.max_concurrency)
+
+                if self.rate is not None:
+                    # Grow by a tenth of the maximum rate every second
+                    self.rate = min(self.max_rate, self.rate + _RATE_INCREASE * self.max_rate / self.rate)
+
+            self._condition.notify_all()
+
+class ConnectionPool(object):
+    """A pool of persistent HTTP and HTTPS connections, kept per host.
+
+    Connections are returned to the pool once a response has been read in full
+    so that subsequent requests to the same host reuse the open socket rather
+    than paying for a new TCP and TLS handshake. The pool is thread-safe and
+    can optionally limit the number of requests made to a host at the same
+    time.
+
+    Requests accept gzip and deflate compressed responses, which are
+    decompressed as they are read. They can be paced by a RateLimiter, and
+    requests the server throttles with a 429 or 503 response can be retried.
+
+    Requests go through the proxy given by the http_proxy or https_proxy
+    environment variable unless no_proxy excludes the host. https requests
+    are tunnelled through the proxy with CONNECT.
+
+    Attributes:
+    compressed_bytes - The total size of the response bodies read, as
+                       received.
+    uncompressed_bytes - The total size of the response bodies read, once
+                         decompressed.
     """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-    
-    params = {}
+    def __init__(self, pool_size=_DEFAULT_POOL_SIZE,
+                 idle_timeout=_DEFAULT_IDLE_TIMEOUT,
+                 max_requests=_DEFAULT_MAX_REQUESTS_PER_CONNECTION,
+                 max_per_host=None, rate_limiter=None, retries=0, retry_posts=False):
+        """Create a connection pool.
+
+        Arguments:
+        pool_size - The maximum number of idle connections kept per host.
+        idle_timeout - The number of seconds after which an idle connection is
+                       closed rather than reused.
+        max_requests - The maximum number of requests sent over a single
+                       connection before it is closed.
+        max_per_host - The maximum number of requests in progress to a single
+                       host at the same time, or None for no limit.
+        rate_limiter - (optional) A RateLimiter that every request waits for.
+        retries - The number of times a throttled request is retried.
+        retry_posts - Whether POST requests are retried as well as idempotent
+                      requests such as GET. A retried POST may have its effect
+                      twice.
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.retry_posts = retry_posts
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._host_limits = {}
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+
+    def _host_limit(self, netloc):
+        """Get the semaphore limiting concurrent requests to a host.
+        """
+        with self._lock:
+            limit = self._host_limits.get(netloc)
+
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.max_per_host)
+                self._host_limits[netloc] = limit
+
+        return limit
+
+    def _acquire(self, scheme, netloc):
+        """Take an idle connection to the host from the pool or open a new one.
+
+        Returns:
+        A tuple containing the pooled connection and True if the connection
+        was reused from the pool or False if it is new.
+        """
+        import httplib
+
+        key = (scheme, netloc)
+        now = time.time()
+        stale = []
+        pooled = None
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+
+            while idle:
+                candidate = idle.pop()
+
+                if now - candidate.last_used > self.idle_timeout:
+                    stale.append(candidate)
+                else:
+                    pooled = candidate
+                    break
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+        for candidate in stale:
+            candidate.connection.close()
 
-    if opts.cursor is not None:
-        params['cursor'] = opts.cursor
+        if pooled is not None:
+            return pooled, True
 
-    if opts.end_date is not None:
-        params['end_date'] = opts.end_date
+        proxy = _proxy_for(scheme, netloc)
 
-    if opts.fetch_size is not None:
-        params['fetch_size'] = opts.fetch_size
+        if proxy is None:
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc)
+            else:
+                connection = httplib.HTTPConnection(netloc)
 
-    if opts.latitude is not None:
-        params['latitude'] = opts.latitude
+            return _PooledConnection(connection), False
 
-    if opts.list_type is not None:
-        params['list_type'] = opts.list_type
+        proxy_netloc, proxy_headers = proxy
 
-    if opts.longitude is not None:
-        params['longitude'] = opts.longitude
+        if scheme == 'https':
+            # The proxy is asked to CONNECT a tunnel to the server, through
+            # which TLS is negotiated with the server itself
+            connection = httplib.HTTPSConnection(proxy_netloc)
+            connection.set_tunnel(netloc, headers=proxy_headers)
 
-    if opts.start_date is not None:
-        params['start_date'] = opts.start_date
+            return _PooledConnection(connection), False
 
-    method_url = '%s/%s/users/%s/sightings?%s' % (server_url, _API_ROOT_PATH, opts.user_id, urllib.urlencode(params))
+        # Requests are sent to the proxy with the absolute url of the server
+        return _PooledConnection(httplib.HTTPConnection(proxy_netloc), proxy_headers), False
 
-    return method_url, None, None
+    def _release(self, scheme, netloc, pooled, reusable):
+        """Return a connection to the pool, or close it if it cannot be reused.
+        """
+        pooled.requests += 1
+        pooled.last_used = time.time()
 
-def api_meta(server_url, opts):
-    """Construct the url for a call to the Meta API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
-    """
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+        if reusable and pooled.requests < self.max_requests:
+            with self._lock:
+                idle = self._idle.setdefault((scheme, netloc), [])
 
-    method_url = '%s/%s/meta?%s' % (server_url, _API_ROOT_PATH, urllib.urlencode(params))
+                if len(idle) < self.pool_size:
+                    idle.append(pooled)
+                    return
 
-    return method_url, None, None
+        pooled.connection.close()
 
-def api_removelocatorsighting(server_url, opts):
-    """Construct the url and POST data for a call to the RemoveLocatorSighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
-    """
-    # The url requires a locator_id so this is mandatory
-    if opts.locator_id is None:
-        raise Error('A locator-id is required for this API method')
-        
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
+    def close(self):
+        """Close all idle connections in the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
 
-    method_url = '{0}/{1}/locators/{2}/sightings/{3}/{4}/remove'.format(server_url, _API_ROOT_PATH, opts.locator_id[0], opts.user_id, opts.sighting_id)
-    
-    params = {}
+        for connections in idle.values():
+            for pooled in connections:
+                pooled.connection.close()
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    def _open(self, http_method, url, body, headers, timing=None):
+        """Send a single request without following redirects and return the
+        response once its headers have been received.
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+        A request that fails on a reused connection is retried once on a new
+        connection as the server may have closed the idle socket.
+        """
+        import httplib
+        import socket
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+        path = url.path or '/'
 
-def api_resightsighting(server_url, opts):
-    """Construct the url and POST data for a call to the ResightSighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
-    
-    method_url = '%s/%s/sightings/%s/%s/resightings' % (server_url, _API_ROOT_PATH, opts.user_id, opts.sighting_id)
+        if url.query and http_method != 'OPTIONS':
+            path = '%s?%s' % (path, url.query)
 
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+        limit = None
+        ticket = None
 
-    if opts.accuracy is not None:
-        params['accuracy'] = opts.accuracy
+        if timing is not None:
+            start = monotonic()
 
-    if opts.altitude is not None:
-        params['altitude'] = opts.altitude
+        if self.max_per_host is not None:
+            # The limit is held until the response body has been read
+            limit = self._host_limit(url.netloc)
+            limit.acquire()
 
-    if opts.altitude_accuracy is not None:
-        params['altitude_accuracy'] = opts.altitude_accuracy
+        try:
+            if self.rate_limiter is not None:
+                ticket = self.rate_limiter.acquire()
 
-    if opts.blobtracker_id is not None:
-        params['blobtracker_id'] = opts.blobtracker_id
+            if timing is not None:
+                timing.record('wait', start)
 
-    if opts.description is not None:
-        params['description'] = opts.description
+            while True:
+                pooled, reused = self._acquire(url.scheme, url.netloc)
 
-    if opts.heading is not None:
-        params['heading'] = opts.heading
+                try:
+                    if timing is not None:
+                        timing._new_request(reused)
 
-    if opts.hold:
-        params['hold'] = 'true'
+                        # Connect before sending the request, rather than when
+                        # it is sent, to time each step
+                        if not reused:
+                            _connect_timed(pooled.connection, timing)
 
-    if opts.latitude is not None:
-        params['latitude'] = opts.latitude
+                        start = monotonic()
 
-    if opts.locator_id is not None:
-        params['locator_id'] = opts.locator_id
+                    if pooled.proxy_headers is None:
+                        request_path, request_headers = path, headers
+                    else:
+                        request_path = '%s://%s%s' % (url.scheme, url.netloc, path)
+                        request_headers = dict(headers or {})
+                        request_headers.update(pooled.proxy_headers)
 
-    if opts.longitude is not None:
-        params['longitude'] = opts.longitude
+                    if body is None or isinstance(body, basestring):
+                        pooled.connection.request(http_method, request_path, body, request_headers)
+                    else:
+                        _send_streaming(pooled.connection, http_method, request_path, body, request_headers)
 
-    if opts.publish_to_facebook:
-        params['publish_to_facebook'] = 'true'
+                    if timing is not None:
+                        start = timing.record('send', start)
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+                    http_response = pooled.connection.getresponse()
 
-    if opts.speed is not None:
-        params['speed'] = opts.speed
+                    if timing is not None:
+                        timing.record('ttfb', start)
+                except (httplib.HTTPException, socket.error):
+                    pooled.connection.close()
 
-    if opts.tweet_sighting:
-        params['tweet_sighting'] = 'true'
+                    if reused:
+                        continue
 
-    if opts.tz_offset is not None:
-        params['tz_offset'] = opts.tz_offset
+                    raise
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+                def finish(reusable, pooled=pooled):
+                    self._release(url.scheme, url.netloc, pooled, reusable)
 
-def api_updatesighting(server_url, opts):
-    """Construct the url and POST data for a call to the UpdateSighting API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
-    """
-    # The url requires a user_id so this is mandatory
-    if opts.user_id is None:
-        raise Error('A user-id is required for this API method')
-        
-    # The url requires a sighting_id so this is mandatory
-    if opts.sighting_id is None:
-        raise Error('A sighting-id is required for this API method')
-    
-    method_url = '%s/%s/sightings/%s/%s' % (server_url, _API_ROOT_PATH, opts.user_id, opts.sighting_id)
+                    if limit is not None:
+                        limit.release()
 
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+                    if ticket is not None:
+                        self.rate_limiter.release(ticket, response.status_code,
+                                                  _retry_after(response.headers))
 
-    if opts.blobtracker_id is not None:
-        params['blobtracker_id'] = opts.blobtracker_id
+                    with self._lock:
+                        self.compressed_bytes += response.compressed_bytes
+                        self.uncompressed_bytes += response.uncompressed_bytes
 
-    if opts.description is not None:
-        params['description'] = opts.description
+                response = StreamingResponse(url.geturl(), http_response, finish, timing)
 
-    if opts.hold is not None:
-        # We can either set or unset the hold flag
-        if opts.hold:
-            params['hold'] = 'true'
-        else:
-            params['hold'] = 'false'
+                return response
+        except:
+            if limit is not None:
+                limit.release()
 
-    if opts.publish_to_facebook is not None:
-        # We can either set or unset the publish to Facebook flag
-        if opts.publish_to_facebook:
-            params['publish_to_facebook'] = 'true'
-        else:
-            params['publish_to_facebook'] = 'false'
+            if ticket is not None:
+                self.rate_limiter.release(ticket)
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+            raise
 
-    if opts.tweet_sighting is not None:
-        # We can either set or unset the tweet Sighting flag
-        if opts.tweet_sighting:
-            params['tweet_sighting'] = 'true'
-        else:
-            params['tweet_sighting'] = 'false'
+    def _retryable(self, http_method):
+        """Check whether throttled requests made with an HTTP method are
+        retried.
+        """
+        return self.retry_posts or http_method in _IDEMPOTENT_METHODS
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+    def _open_redirected(self, http_method, url, body, headers, timing=None):
+        """Make an HTTP request, following any redirects, and return the
+        response once its headers have been received.
+        """
+        import urlparse
 
-def api_upload(server_url, opts):
-    """Construct the url and POST data for a call to the Upload API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
-    
-    Raises:
-    Error if no upload_url was specified on the command-line.
-    """
-    # The upload_url is mandatory
-    if opts.upload_url is None:
-        raise Error('An upload-url is required for this API method')
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._open(http_method, urlparse.urlparse(url), body, headers, timing)
+            redirect = _follow_redirect(response, http_method, url, body, headers)
 
-    params = {}
+            if redirect is None:
+                return response
 
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+            # Read the body of the redirect so the connection can be reused
+            response.read()
+            http_method, url, body, headers = redirect
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+        return response
 
-    files = {}
-    
-    if opts.filename is not None:
-        try:
-            with open(opts.filename, 'rb') as f:
-                files['file'] = f.read()
-        except IOError as e:
-            raise Error(str(e))
+    def open(self, http_method, url, body=None, headers=None, timing=None):
+        """Make an HTTP request, following any redirects, and return the
+        response once its headers have been received. The body of the
+        response is read from the connection as it is consumed.
 
-    data, content_type = encode_post_data(params, files=files)
-    
-    return opts.upload_url, data, content_type
+        Arguments:
+        http_method - The HTTP method, e.g. GET or POST.
+        url - The url to request.
+        body - (optional) The request body.
+        headers - (optional) A dictionary of additional request headers.
+        timing - (optional) A RequestTiming to record the time spent in each
+                 phase of the request in.
 
-def api_uploadurl(server_url, opts):
-    """Construct the url and POST data for a call to the UploadUrl API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method, the POST data
-    to be sent and the POST data content type.
+        Returns:
+        A StreamingResponse. If the server is still throttling the request
+        once it has been retried this is the last throttled response.
+
+        Raises:
+        httplib.HTTPException or socket.error if the request fails.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', _ACCEPT_ENCODING)
+        attempt = 0
+
+        if timing is not None:
+            timing.begin()
+
+        while True:
+            response = self._open_redirected(http_method, url, body, headers, timing)
+
+            if (response.status_code not in _THROTTLED_STATUS_CODES or
+                attempt >= self.retries or not self._retryable(http_method)):
+                return response
+
+            # Read the body of the throttled response so the connection can be
+            # reused
+            response.read()
+            time.sleep(_retry_delay(response.headers, attempt))
+            attempt += 1
+
+    def request(self, http_method, url, body=None, headers=None, timing=None):
+        """Make an HTTP request, following any redirects, and read the whole
+        response.
+
+        The arguments are the same as for open.
+
+        Returns:
+        A Response.
+
+        Raises:
+        httplib.HTTPException or socket.error if the request fails.
+        """
+        response = self.open(http_method, url, body, headers, timing)
+        body = response.read()
+
+        return Response(response.status_code, response.headers, body, response.compressed_bytes)
+
+# Default settings for the asynchronous engine
+_DEFAULT_ASYNC_MAX_CONNECTIONS = 256
+_DEFAULT_ASYNC_TIMEOUT = 60.0
+
+class _ResponseParser(object):
+    """An incremental parser for an HTTP/1.1 response that is fed data as it
+    arrives on a non-blocking socket.
     """
-    method_url = '%s/%s/uploadurl' % (server_url, _API_ROOT_PATH)
+    def __init__(self, http_method):
+        self.http_method = http_method
+        self.status_code = None
+        self.headers = []
+        self.will_close = False
+        self.complete = False
+        self.received = False
+        self._version = None
+        self._buffer = ''
+        self._state = 'status'
+        self._remaining = None
+        self._chunked = False
+        self._body = []
+        self._decoder = None
+        self._compressed_bytes = 0
+
+    def response(self):
+        """Get the parsed response once it is complete.
+
+        Raises:
+        httplib.HTTPException if a compressed body is not validly encoded.
+        """
+        if self._decoder is not None:
+            self._body.append(self._decoder.flush())
+
+        return Response(self.status_code, self.headers, ''.join(self._body), self._compressed_bytes)
+
+    def _append(self, data):
+        """Add data to the body, decompressing it as it arrives.
+        """
+        self._compressed_bytes += len(data)
+
+        if self._decoder is not None:
+            data = self._decoder.decompress(data)
+
+        self._body.append(data)
+
+    def feed(self, data):
+        """Parse data received from the server.
+
+        Raises:
+        httplib.HTTPException if the response is malformed.
+        """
+        self.received = True
+        self._buffer += data
+
+        while not self.complete:
+            if self._state == 'body':
+                if self._remaining is None:
+                    # The body continues until the server closes the connection
+                    self._append(self._buffer)
+                    self._buffer = ''
+                    return
+
+                if not self._buffer:
+                    return
+
+                chunk = self._buffer[:self._remaining]
+                self._buffer = self._buffer[len(chunk):]
+                self._append(chunk)
+                self._remaining -= len(chunk)
+
+                if self._remaining == 0:
+                    if self._chunked:
+                        self._state = 'chunk_end'
+                    else:
+                        self.complete = True
+            else:
+                end = self._buffer.find('\r\n')
+
+                if end < 0:
+                    return
+
+                line = self._buffer[:end]
+                self._buffer = self._buffer[end + 2:]
+                self._line(line)
+
+    def _line(self, line):
+        """Parse a line of the status, headers or chunk framing.
+        """
+        import httplib
+
+        if self._state == 'status':
+            try:
+                self._version, status_code = line.split(None, 2)[:2]
+                self.status_code = int(status_code)
+            except ValueError:
+                raise httplib.BadStatusLine(line)
+
+            self.headers = []
+            self._state = 'headers'
+        elif self._state == 'headers':
+            if line:
+                self.headers.append(line + '\r\n')
+            else:
+                self._end_headers()
+        elif self._state == 'chunk_size':
+            try:
+                self._remaining = int(line.split(';', 1)[0], 16)
+            except ValueError:
+                raise httplib.HTTPException('Invalid chunk size')
+
+            self._state = 'body' if self._remaining else 'trailer'
+        elif self._state == 'chunk_end':
+            self._state = 'chunk_size'
+        elif self._state == 'trailer':
+            if not line:
+                self.complete = True
+
+    def _header(self, name):
+        """Get the value of a response header, or None.
+        """
+        return header_value(self.headers, name)
+
+    def _end_headers(self):
+        """Work out how the body is framed once all the headers are read.
+        """
+        import httplib
+
+        if 100 <= self.status_code < 200:
+            # Skip informational responses
+            self._state = 'status'
+            return
+
+        connection = (self._header('connection') or '').lower()
+        self.will_close = connection == 'close' or (self._version == 'HTTP/1.0' and connection != 'keep-alive')
+        self._chunked = (self._header('transfer-encoding') or '').lower() == 'chunked'
+        self._decoder = _content_decoder(self.headers)
+        self._state = 'body'
+
+        if self.http_method == 'HEAD' or self.status_code in (204, 304):
+            self.complete = True
+        elif self._chunked:
+            self._state = 'chunk_size'
+        elif self._header('content-length') is not None:
+            try:
+                self._remaining = int(self._header('content-length'))
+            except ValueError:
+                raise httplib.HTTPException('Invalid Content-Length')
+
+            self.complete = self._remaining == 0
+        else:
+            self.will_close = True
 
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    def finish(self):
+        """Handle the server closing the connection.
 
-    if opts.sandbox:
-        params['sandbox'] = 'true'
+        Raises:
+        httplib.IncompleteRead if the response is incomplete.
+        """
+        import httplib
 
-    data, content_type = encode_post_data(params)
-    
-    return method_url, data, content_type
+        if self._state == 'body' and self._remaining is None:
+            self.complete = True
+        elif not self.complete:
+            raise httplib.IncompleteRead(''.join(self._body))
 
-def api_user(server_url, opts):
-    """Construct the url for a call to the User API method.
-    
-    Arguments:
-    server_url - The url of the server where the API is running.
-    opts - The command-line options.
-    
-    Returns:
-    A tuple containing the full url for invoking the API method and None for
-    the POST data and content type as this is a GET request.
+class _AsyncRequest(object):
+    """A request waiting for or being sent over an _AsyncConnection.
     """
-    params = {}
-    
-    if opts.access_token is not None:
-        params['access_token'] = opts.access_token
+    def __init__(self, http_method, url, body, headers, callback, deadline):
+        import urlparse
 
-    method_url = '%s/%s/user?%s' % (server_url, _API_ROOT_PATH, urllib.urlencode(params))
+        self.http_method = http_method
+        self.url = url
+        self.parsed_url = urlparse.urlparse(url)
+        self.body = body
+        self.headers = headers
+        self.callback = callback
+        self.deadline = deadline
+        self.redirects = 0
+        self.retried = False
 
-    return method_url, None, None
+    def key(self):
+        """The scheme, host and port of the server the request is sent to.
+        """
+        scheme = self.parsed_url.scheme
+        port = self.parsed_url.port or (443 if scheme == 'https' else 80)
 
-# A dictionary containing all the API methods and the function to call to
-# construct the url and optional POST data.
-methods = {
-    'createlocator': api_createlocator,
-    'createlocatorsighting': api_createlocatorsighting,
-    'createsighting': api_createsighting,
-    'getdailysighting': api_getdailysighting,
-    'getsighting': api_getsighting,
-    'getuser': api_getuser,
-    'getuserstatistics': api_getuserstatistics,
-    'listlocators': api_listlocators,
-    'listlocatorsightings': api_listlocatorsightings,
-    'listresightings': api_listresightings,
-    'listsightinglocators': api_listsightinglocators,
-    'listsightings': api_listsightings,
-    'listusercountrystatistics': api_listusercountrystatistics,
-    'listuserlocalitystatistics': api_listuserlocalitystatistics,
-    'listuserlocators': api_listuserlocators,
-    'listusersightings': api_listusersightings,
-    'meta': api_meta,
-    'removelocatorsighting': api_removelocatorsighting,
-    'resightsighting': api_resightsighting,
-    'updatesighting': api_updatesighting,
-    'upload': api_upload,
-    'uploadurl': api_uploadurl,
-    'user': api_user,
-}
+        return scheme, self.parsed_url.hostname, port
 
-def parse_command_line():
-    """Parse the command-line arguments and options.
-    
-    Returns:
-    A tuple containing the API server url, the name of the API method to call
-    and the command-line options object returned by the options parser.
+    def chunks(self):
+        """Generate the request line, headers and body to send.
+        """
+        path = self.parsed_url.path or '/'
+
+        if self.parsed_url.query and self.http_method != 'OPTIONS':
+            path = '%s?%s' % (path, self.parsed_url.query)
+
+        lines = ['%s %s HTTP/1.1' % (self.http_method, path),
+                 'Host: %s' % self.parsed_url.netloc]
+
+        if self.body is not None:
+            lines.append('Content-Length: %d' % len(self.body))
+
+        for name, value in self.headers.viewitems():
+            lines.append('%s: %s' % (name, value))
+
+        lines.extend(['', ''])
+
+        if self.body is None or isinstance(self.body, basestring):
+            yield '\r\n'.join(lines) + (self.body or '')
+        else:
+            yield '\r\n'.join(lines)
+
+            for chunk in _body_chunks(self.body):
+                yield chunk
+
+class _AsyncConnection(object):
+    """A non-blocking connection to a server used by the AsyncEngine.
     """
-    parser = OptionParser(usage="""%prog server-url method [options]
+    def __init__(self, key):
+        self.key = key
+        self.sock = None
+        self.state = None
+        self.want_write = False
+        self.request = None
+        self.parser = None
+        self.requests = 0
+        self.reused = False
+        self.last_used = time.time()
+        self._chunks = None
+        self._data = None
+        self._sent = 0
+        self._addresses = []
+
+    def connect(self):
+        """Start connecting to the server.
+        """
+        import socket
+
+        scheme, host, port = self.key
+        self._addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self._connect_next(socket.error('getaddrinfo returns an empty list'))
+
+    def _connect_next(self, error):
+        """Start connecting to the next address of the server, trying each
+        in turn as socket.create_connection does.
+
+        Arguments:
+        error - The socket.error to raise if there are no more addresses.
+        """
+        import socket
+
+        while self._addresses:
+            family, socktype, proto, _, address = self._addresses.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            err = sock.connect_ex(address)
+
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                self.sock = sock
+                self.state = 'connecting'
+                self.want_write = True
+                return
+
+            sock.close()
+            error = socket.error(err, os.strerror(err))
+
+        raise error
+
+    def start(self, request):
+        """Start sending a request over the connection.
+        """
+        self.request = request
+        self.parser = _ResponseParser(request.http_method)
+        self.reused = self.requests > 0
+        self._chunks = request.chunks()
+        self._data = next(self._chunks)
+        self._sent = 0
+
+        if self.sock is None:
+            self.connect()
+        else:
+            self.state = 'sending'
+            self.want_write = True
+
+    def close(self):
+        """Close the connection.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+        self.state = None
+
+    def fileno(self):
+        """The file descriptor of the socket.
+        """
+        return self.sock.fileno()
+
+    def handle_event(self, readable, writable):
+        """Make progress on the request after a socket event.
+
+        Returns:
+        True if a complete response has been received.
+
+        Raises:
+        socket.error or httplib.HTTPException if the request fails.
+        """
+        import socket
+        import ssl
+
+        if self.state == 'idle':
+            # An idle connection becoming readable means the server closed it
+            raise socket.error(errno.ECONNRESET, 'Connection closed by server')
+
+        if self.state == 'connecting':
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if err != 0:
+                # The socket changes, so the engine finds the connection by its
+                # new file descriptor
+                self.sock.close()
+                self.sock = None
+                self._connect_next(socket.error(err, os.strerror(err)))
+                return False
+
+            if self.key[0] == 'https':
+                context = ssl.create_default_context()
+                self.sock = context.wrap_socket(self.sock, server_hostname=self.key[1],
+                                                do_handshake_on_connect=False)
+                self.state = 'handshaking'
+            else:
+                self.state = 'sending'
+
+        if self.state == 'handshaking':
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.want_write = False
+                return False
+            except ssl.SSLWantWriteError:
+                self.want_write = True
+                return False
+
+            self.state = 'sending'
+            self.want_write = True
+
+        if self.state == 'sending':
+            try:
+                while self._data is not None:
+                    if self._sent < len(self._data):
+                        self._sent += self.sock.send(buffer(self._data, self._sent, 65536))
+                    else:
+                        self._data = next(self._chunks, None)
+                        self._sent = 0
+            except ssl.SSLWantWriteError:
+                return False
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+
+                raise
+
+            self._chunks = None
+            self.state = 'receiving'
+            self.want_write = False
+            return False
+
+        if self.state == 'receiving':
+            while True:
+                try:
+                    data = self.sock.recv(65536)
+                except ssl.SSLWantReadError:
+                    return False
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return False
+
+                    raise
+
+                if not data:
+                    self.parser.finish()
+                    self.parser.will_close = True
+                    return True
+
+                self.parser.feed(data)
+
+                if self.parser.complete:
+                    return True
+
+        return False
+
+class AsyncEngine(object):
+    """An event loop that makes many HTTP requests at the same time from a
+    single thread using non-blocking sockets.
+
+    Requests are queued with request() and made when run() is called. The
+    callback for each request is called from within run() once the response
+    has been received, so callbacks can queue further requests. Connections
+    are kept open between requests to the same server and reused.
+
+    To make the requests from another event loop instead, register the file
+    descriptors returned by select_args() with it and call step(0) whenever
+    one is ready or the timeout passes.
+
+    Requests are not sent through proxies. A request to a host that the
+    environment gives a proxy for fails.
+
+    Compressed responses are decompressed in the same way as by
+    ConnectionPool.
+
+    Host names are resolved with a blocking lookup when a connection is
+    opened.
+    """
+    def __init__(self, max_connections=_DEFAULT_ASYNC_MAX_CONNECTIONS,
+                 idle_timeout=_DEFAULT_IDLE_TIMEOUT,
+                 max_requests=_DEFAULT_MAX_REQUESTS_PER_CONNECTION,
+                 timeout=_DEFAULT_ASYNC_TIMEOUT):
+        """Create an engine.
+
+        Arguments:
+        max_connections - The maximum number of connections open at the same
+                          time. Further requests wait for a free connection.
+        idle_timeout - The number of seconds after which an idle connection is
+                       closed rather than reused.
+        max_requests - The maximum number of requests sent over a single
+                       connection before it is closed.
+        timeout - The number of seconds after which a request fails.
+        """
+        import collections
+
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self._queue = collections.deque()
+        self._connections = {}
+        self._idle = {}
+
+    def request(self, http_method, url, body=None, headers=None, callback=None):
+        """Queue an HTTP request. Redirects are followed in the same way as
+        ConnectionPool.request.
+
+        Arguments:
+        http_method - The HTTP method, e.g. GET or POST.
+        url - The url to request.
+        body - (optional) The request body.
+        headers - (optional) A dictionary of additional request headers.
+        callback - A function called with a Response and None when the request
+                   completes, or None and an Error if it fails.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', _ACCEPT_ENCODING)
+
+        self._queue.append(_AsyncRequest(http_method, url, body, headers,
+                                         callback, time.time() + self.timeout))
+
+    def pending(self):
+        """Get the number of requests queued or in progress.
+        """
+        return len(self._queue) + sum(1 for connection in self._connections.itervalues()
+                                      if connection.request is not None)
+
+    def close(self):
+        """Close all connections. Requests in progress are abandoned.
+        """
+        for connection in self._connections.values():
+            connection.close()
 
-Arguments:
-  server-url            The url of the server where the API is running,
-                        e.g. https://resighting-api.appspot.com
-  method                The name of the API to invoke. See list below.
+        self._connections = {}
+        self._idle = {}
+
+    def run(self):
+        """Run the event loop until all queued requests have completed.
+        """
+        while self.step(None):
+            pass
+
+    def step(self, timeout=0):
+        """Make progress on the queued requests, waiting no longer than a
+        timeout for a socket to become ready. Callbacks for the requests that
+        complete are called before it returns.
+
+        Arguments:
+        timeout - (optional) The maximum number of seconds to wait, 0 to handle
+                  only the sockets that are already ready, or None to wait
+                  until a socket is ready or a request times out.
+
+        Returns:
+        The number of requests queued or in progress.
+        """
+        self._dispatch()
+
+        if self.pending():
+            self._poll(timeout)
+            self._expire()
+            self._dispatch()
+
+        return self.pending()
+
+    def select_args(self):
+        """Get the sockets an event loop running the engine should wait for
+        before calling step. Queued requests are started first.
+
+        Returns:
+        A tuple of arguments for select.select: a list of the file
+        descriptors to wait to be readable, a list of those to wait to be
+        writable, an empty list and the number of seconds until the next
+        request times out, or None if no request is in progress.
+        """
+        self._dispatch()
+
+        readers = [fd for fd, c in self._connections.iteritems() if not c.want_write]
+        writers = [fd for fd, c in self._connections.iteritems() if c.want_write]
+        deadlines = [c.request.deadline for c in self._connections.itervalues() if c.request is not None]
+        timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+
+        return readers, writers, [], timeout
+
+    def _dispatch(self):
+        """Start queued requests on idle or new connections.
+        """
+        import collections
+        import httplib
+        import socket
+
+        waiting = collections.deque()
+
+        while self._queue:
+            request = self._queue.popleft()
+            connection = None
+            idle = self._idle.get(request.key(), [])
+
+            while idle and connection is None:
+                connection = idle[-1]
+
+                if time.time() - connection.last_used <= self.idle_timeout:
+                    idle.pop()
+                else:
+                    self._discard(connection)
+                    connection = None
 
-Methods:
-  CreateLocator
-  CreateLocatorSighting
-  CreateSighting
-  GetDailySighting
-  GetSighting
-  GetUser
-  GetUserStatistics
-  ListLocators
-  ListLocatorSightings
-  ListResightings
-  ListSightingLocators
+            if connection is None:
+                if len(self._connections) >= self.max_connections and not self._close_idle():
+                    waiting.append(request)
+                    continue
+
+                connection = _AsyncConnection(request.key())
+
+                try:
+                    proxy = _proxy_for(request.parsed_url.scheme, request.parsed_url.netloc)
+                except Error:
+                    proxy = True
+
+                if proxy is not None:
+                    if request.callback is not None:
+                        request.callback(None, Error('Cannot connect to API at %s through a proxy without '
+                                                     'blocking' % request.url))
+
+                    continue
+
+            try:
+                connection.start(request)
+            except (socket.error, httplib.HTTPException):
+                self._fail(connection)
+                continue
+
+            self._connections[connection.fileno()] = connection
+
+        self._queue = waiting
+
+    def _close_idle(self):
+        """Close one idle connection to make room for a new one.
+
+        Returns:
+        True if a connection was closed.
+        """
+        for idle in self._idle.itervalues():
+            if idle:
+                self._discard(idle[0])
+                return True
+
+        return False
+
+    def _discard(self, connection):
+        """Close a connection and forget about it.
+        """
+        idle = self._idle.get(connection.key)
+
+        if idle and connection in idle:
+            idle.remove(connection)
+
+        if connection.sock is not None:
+            self._connections.pop(connection.fileno(), None)
+
+        connection.close()
+
+    def _poll(self, timeout=None):
+        """Wait for socket events and handle them.
+
+        Arguments:
+        timeout - (optional) The maximum number of seconds to wait, or None to
+                  wait until a request times out.
+        """
+        import httplib
+        import select
+        import socket
+
+        now = time.time()
+        deadlines = [c.request.deadline for c in self._connections.itervalues() if c.request is not None]
+        limit = max(0.0, min(deadlines) - now) if deadlines else self.idle_timeout
+        timeout = limit if timeout is None else min(limit, timeout)
+
+        events = []
+
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+
+            for fd, connection in self._connections.iteritems():
+                poller.register(fd, select.POLLOUT if connection.want_write else select.POLLIN)
+
+            for fd, event in poller.poll(timeout * 1000):
+                events.append((fd, bool(event & ~select.POLLOUT), bool(event & ~select.POLLIN)))
+        else:
+            readers = [fd for fd, c in self._connections.iteritems() if not c.want_write]
+            writers = [fd for fd, c in self._connections.iteritems() if c.want_write]
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+
+            events.extend((fd, True, False) for fd in readable)
+            events.extend((fd, False, True) for fd in writable)
+
+        for fd, readable, writable in events:
+            connection = self._connections.get(fd)
+
+            if connection is None:
+                continue
+
+            try:
+                if connection.handle_event(readable, writable):
+                    self._complete(connection)
+                elif connection.sock is not None and connection.fileno() != fd:
+                    # Connecting moved on to the next address of the server
+                    del self._connections[fd]
+                    self._connections[connection.fileno()] = connection
+            except (socket.error, httplib.HTTPException):
+                self._connections.pop(fd, None)
+                self._fail(connection)
+
+    def _expire(self):
+        """Fail requests that have taken too long and close connections that
+        have been idle too long.
+        """
+        now = time.time()
+
+        for connection in self._connections.values():
+            if connection.request is not None and now > connection.request.deadline:
+                request = connection.request
+                request.retried = True
+                self._fail(connection)
+            elif connection.request is None and now - connection.last_used > self.idle_timeout:
+                self._discard(connection)
+
+    def _complete(self, connection):
+        """Handle a complete response received on a connection.
+        """
+        request = connection.request
+        response = connection.parser.response()
+        will_close = connection.parser.will_close
+
+        connection.request = None
+        connection.parser = None
+        connection.requests += 1
+        connection.last_used = time.time()
+
+        if will_close or connection.requests >= self.max_requests:
+            self._discard(connection)
+        else:
+            connection.state = 'idle'
+            self._idle.setdefault(connection.key, []).append(connection)
+
+        redirect = None
+
+        if request.redirects < _MAX_REDIRECTS:
+            redirect = _follow_redirect(response, request.http_method, request.url, request.body, request.headers)
+
+        if redirect is not None:
+            http_method, url, body, headers = redirect
+            next_request = _AsyncRequest(http_method, url, body, headers, request.callback, request.deadline)
+            next_request.redirects = request.redirects + 1
+            self._queue.append(next_request)
+        elif request.callback is not None:
+            request.callback(response, None)
+
+    def _fail(self, connection):
+        """Handle a failed request on a connection.
+
+        A request that fails on a reused connection before any response is
+        received is retried once on a new connection as the server may have
+        closed the idle socket.
+        """
+        request = connection.request
+        self._discard(connection)
+
+        if request is None:
+            return
+
+        if connection.reused and not connection.parser.received and not request.retried:
+            request.retried = True
+            self._queue.append(request)
+        elif request.callback is not None:
+            request.callback(None, Error('Failed to connect to API at %s' % request.url))
+
+# The size of the chunks files are read in when uploaded
+_UPLOAD_CHUNK_SIZE = 65536
+
+# The default number of bytes sent in each request of a resumable upload
+_DEFAULT_CHUNK_SIZE = 8388608
+
+# The status code the server responds with to each chunk of a resumable
+# upload until the upload is complete
+_RESUME_INCOMPLETE = 308
+
+# The number of times in a row a chunk of a resumable upload may fail before
+# the upload is abandoned
+_RESUMABLE_MAX_FAILURES = 5
+
+# The size of the chunks of a memory-mapped file passed to the socket
+_MMAP_CHUNK_SIZE = 1048576
+
+class UploadFile(object):
+    """A file to be uploaded in a MultipartBody. The file is read in chunks as
+    the request is sent rather than being read into memory.
+
+    If the file is memory-mapped then the chunks are buffers over the mapped
+    file that are passed straight to the socket, so the file contents are
+    never copied into Python strings.
+    """
+    def __init__(self, filename, use_mmap=False):
+        """Create an upload file.
+
+        Arguments:
+        filename - The name of the file to upload.
+        use_mmap - (optional) If True the file is memory-mapped.
+
+        Raises:
+        IOError or OSError if the file cannot be read.
+        """
+        with open(filename, 'rb'):
+            pass
+
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.use_mmap = use_mmap
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        import mmap
+
+        with open(self.filename, 'rb') as f:
+            if self.use_mmap and self.size > 0:
+                # The mapping is not closed explicitly as the buffers refer to
+                # it. It is unmapped once the last buffer is released.
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                f.close()
+
+                for offset in xrange(0, len(mapped), _MMAP_CHUNK_SIZE):
+                    yield buffer(mapped, offset, _MMAP_CHUNK_SIZE)
+            else:
+                for chunk in iter(lambda: f.read(_UPLOAD_CHUNK_SIZE), ''):
+                    yield chunk
+
+class MultipartBody(object):
+    """A multipart/form-data request body that is produced in chunks as the
+    request is sent. The length of the body is known before it is produced so
+    it can be sent with a Content-Length header, and the body can be iterated
+    over more than once.
+    """
+    def __init__(self, boundary):
+        """Create an empty multipart body.
+
+        Arguments:
+        boundary - The boundary between the parts of the body.
+        """
+        self.boundary = boundary
+        self._parts = []
+
+    def add_param(self, name, value):
+        """Add an HTTP parameter to the body.
+        """
+        import urllib
+
+        self._parts.append('\r\n--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s'
+                           % (self.boundary, _quote_name(name),
+                              urllib.quote_plus(value) if value is not None else ''))
+
+    def add_file(self, name, file_data):
+        """Add a file to the body.
+
+        Arguments:
+        name - The parameter name, also used as the filename.
+        file_data - The file data as a string or an UploadFile, or None.
+        """
+        self._parts.append('\r\n--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                           'Content-Type: application/octet-stream\r\n\r\n'
+                           % (self.boundary, _quote_name(name), _quote_name(name)))
+
+        if file_data is not None:
+            self._parts.append(file_data)
+
+    def _closed_parts(self):
+        return self._parts + ['\r\n--%s--\r\n' % self.boundary]
+
+    def __len__(self):
+        return sum(len(part) for part in self._closed_parts())
+
+    def __iter__(self):
+        for part in self._closed_parts():
+            if isinstance(part, basestring):
+                yield part
+            else:
+                for chunk in part:
+                    yield chunk
+
+# Parameter names are quoted once and then looked up as the same few names are
+# used in every request
+_quoted_names = {}
+
+def _quote_name(name):
+    """Quote a parameter name for a url or POST data, caching the result.
+    """
+    import urllib
+
+    quoted = _quoted_names.get(name)
+
+    if quoted is None:
+        quoted = _quoted_names[name] = urllib.quote_plus(name)
+
+    return quoted
+
+def _encode_params(params):
+    """Encode parameters in x-www-form-urlencoded form for a query string or
+    POST data.
+
+    Arguments:
+    params - A dictionary containing the parameters, as for encode_post_data,
+             or None.
+
+    Returns:
+    The encoded parameters.
+    """
+    import urllib
+
+    if not params:
+        return ''
+
+    parts = []
+    append = parts.append
+    quote_plus = urllib.quote_plus
+
+    for name, value in params.viewitems():
+        quoted_name = _quote_name(name)
+
+        # The value can be a list or tuple of multiple values.
+        # In this case we added multiple parameters to the request, each with the
+        # same name.
+        if isinstance(value, (list, tuple)):
+            for i_value in value:
+                append('%s=%s' % (quoted_name, quote_plus(i_value) if i_value is not None else ''))
+        else:
+            append('%s=%s' % (quoted_name, quote_plus(value) if value is not None else ''))
+
+    return '&'.join(parts)
+
+def encode_post_data(params, files=None):
+    """Create POST data for an HTTP request.
+    
+    If the files argument is None then the parameters specified in the params
+    argument are added to the post data in x-www-form-urlencode form. If the
+    files argument is not None then a multipart/form-data post is constructed
+    containing the files and parameters.
+    
+    Arguments:
+    params - A dictionary containing any required HTTP parameters. The key is used
+             as the parameter name and the value is the parameter value. If the
+             parameter value is a list or a tuple then multiple parameters are
+             added to the request each with the same name, one for each value in
+             the list/tuple.
+    files - (optional) A dictionary containing files to be added to the request.
+            The key is used as the parameter name and filename in the request and the
+            value is the file data, either a string or an UploadFile. If the parameter
+            value is a list or a tuple then multiple files are added to the request each
+            with the same name, one for each value (file data) in the list/tuple.
+    
+    Returns:
+    A tuple containing first the POST data and second the content type. For a
+    multipart/form-data post the POST data is a MultipartBody.
+    """
+    data = None
+    content_type = None
+
+    if files is None:
+        # application/x-www-form-urlencoded
+        data = _encode_params(params)
+        content_type = 'application/x-www-form-urlencoded charset=utf-8'
+    else:
+        # multipart/form-data
+        boundary = 'c281a12c-c3e2-4c17-969b-9dbf859af2ee'
+        data = MultipartBody(boundary)
+        content_type = 'multipart/form-data; boundary=%s' % boundary
+
+        # Add HTTP parameters
+        if params is not None:
+            for name, value in params.viewitems():
+                # The value can be a list or tuple of multiple values.
+                # In this case we added multiple parameters to the request, each with the
+                # same name.
+                if isinstance(value, (list, tuple)):
+                    multi_value = value
+                else:
+                    multi_value = [value]
+            
+                for i_value in multi_value:
+                    data.add_param(name, i_value)
+
+        # Add any files to be uploaded
+        for name, file_data in files.viewitems():
+            # The file data can be a list or tuple of data from multiple files.
+            # In this case we added multiple files to the request, each with the
+            # same name.
+            if isinstance(file_data, (list, tuple)):
+                multi_file_data = file_data
+            else:
+                multi_file_data = [file_data]
+        
+            for i_file_data in multi_file_data:
+                data.add_file(name, i_file_data)
+
+    return data, content_type
+
+# Default settings for the on-disk response cache
+_DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.apiclient', 'cache')
+_DEFAULT_CACHE_SIZE = 52428800
+
+# The headers of a Not Modified response that are not copied to the cached
+# response when it is revalidated
+_UNREVALIDATED_HEADERS = frozenset(['content-length', 'content-encoding', 'transfer-encoding', 'connection'])
+
+# The fraction of its maximum size a cache is reduced to once it grows past
+# it, so that the stores that follow do not each need to remove a response
+_EVICTED_SIZE = 0.9
+
+class ResponseCache(object):
+    """A persistent cache of the responses to GET requests, stored as one file
+    per url in a directory.
+
+    Responses with an ETag or Last-Modified header are revalidated with a
+    conditional request, and responses with a Cache-Control max-age are used
+    without any request until they expire. The least recently used responses
+    are removed once the cache exceeds its maximum size.
+
+    The cache can be shared between threads and processes. Files are written
+    to a temporary name and renamed into place. The size of the cache is read
+    from the directory when the first response is stored and then tracked, so
+    responses stored by other processes are only counted once it is next read.
+
+    Attributes:
+    hits - The number of responses used without making a request.
+    revalidations - The number of Not Modified responses received.
+    misses - The number of requests answered with a full response.
+    """
+    def __init__(self, directory=_DEFAULT_CACHE_DIR, max_size=_DEFAULT_CACHE_SIZE):
+        """Create a cache.
+
+        Arguments:
+        directory - (optional) The directory the responses are stored in. It is
+                    created when the first response is stored.
+        max_size - (optional) The maximum total size in bytes of the stored
+                   responses.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def _path(self, url):
+        """Get the name of the file a url's response is stored in.
+
+        The parameters of the query string are put in order and the access
+        token is replaced with a digest of it, so the same request made with
+        its parameters in a different order shares an entry and no access token
+        is written to disk.
+        """
+        import hashlib
+        import urllib
+        import urlparse
+
+        parts = urlparse.urlsplit(url)
+        params = []
+
+        for name, value in urlparse.parse_qsl(parts.query, keep_blank_values=True):
+            if name == 'access_token':
+                value = hashlib.sha1(value).hexdigest()
+
+            params.append((name, value))
+
+        params.sort(key=lambda param: param[0])
+        normalised_url = urlparse.urlunsplit((parts.scheme, parts.netloc.lower(), parts.path,
+                                              urllib.urlencode(params), ''))
+
+        return os.path.join(self.directory, hashlib.sha1(normalised_url).hexdigest())
+
+    def lookup(self, url):
+        """Get the stored response for a url.
+
+        Returns:
+        A tuple containing the Response and the time at which it expires, or
+        (None, None) if there is no stored response.
+        """
+        import json
+
+        path = self._path(url)
+
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(f.readline())
+                headers = [header.encode('latin-1') for header in entry['headers']]
+                response = Response(entry['status_code'], headers, f.read())
+
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+        return response, entry.get('expires', 0)
+
+    def store(self, url, response):
+        """Store the response for a url if it can be cached.
+
+        Returns:
+        True if the response was stored.
+        """
+        import json
+
+        cache_control = [directive.strip().lower() for directive in
+                         (header_value(response.headers, 'cache-control') or '').split(',')]
+        lifetime = 0
+
+        for directive in cache_control:
+            if directive.startswith('max-age='):
+                try:
+                    lifetime = int(directive[len('max-age='):])
+                except ValueError:
+                    pass
+
+        if 'no-cache' in cache_control:
+            lifetime = 0
+
+        if (response.status_code != 200 or 'no-store' in cache_control or
+                (lifetime <= 0 and header_value(response.headers, 'etag') is None
+                 and header_value(response.headers, 'last-modified') is None)):
+            return False
+
+        # The body is stored decompressed, so the headers describing how it
+        # was sent no longer apply
+        headers = [header for header in response.headers
+                   if header.split(':', 1)[0].strip().lower() not in _UNREVALIDATED_HEADERS]
+        headers.append('Content-Length: %d\r\n' % len(response.body))
+
+        path = self._path(url)
+        temporary_file = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            with open(temporary_file, 'wb') as f:
+                f.write(json.dumps({
+                    'status_code': response.status_code,
+                    'headers': [header.decode('latin-1') for header in headers],
+                    'expires': time.time() + lifetime,
+                }) + '\n')
+                f.write(response.body)
+                size = f.tell()
+
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+
+            os.rename(temporary_file, path)
+        except (IOError, OSError, ValueError):
+            return False
+
+        self._track(size)
+
+        return True
+
+    def revalidated(self, url, cached, not_modified):
+        """Update a stored response from the Not Modified response to a
+        conditional request.
+
+        Returns:
+        The stored response with its headers updated.
+        """
+        names = set(header.split(':', 1)[0].strip().lower() for header in not_modified.headers)
+        names.difference_update(_UNREVALIDATED_HEADERS)
+
+        headers = [header for header in cached.headers
+                   if header.split(':', 1)[0].strip().lower() not in names]
+        headers.extend(header for header in not_modified.headers
+                       if header.split(':', 1)[0].strip().lower() in names)
+
+        response = Response(cached.status_code, headers, cached.body)
+        self.store(url, response)
+
+        return response
+
+    def _track(self, change):
+        """Add to the tracked size of the cache, removing the least recently used
+        responses if it has grown past its maximum size.
+
+        Arguments:
+        change - The number of bytes the cache has grown by.
+        """
+        with self._size_lock:
+            if self._size is None:
+                self._size = self._evict(self.max_size)
+            else:
+                self._size += change
+
+                if self._size > self.max_size:
+                    self._size = self._evict(self.max_size * _EVICTED_SIZE)
+
+    def _evict(self, max_size):
+        """Remove the least recently used responses until the cache is within a
+        size.
+
+        Returns:
+        The total size of the responses left in the cache.
+        """
+        entries = []
+        total_size = 0
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+
+        for _, size, path in entries:
+            if total_size <= max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            total_size -= size
+
+        return total_size
+
+    def request(self, pool, url, headers=None, timing=None):
+        """Make a GET request through a ConnectionPool, answering it from the
+        cache if possible.
+
+        Arguments:
+        pool - The ConnectionPool to make the request through.
+        url - The url to request.
+        headers - (optional) A dictionary of additional request headers.
+        timing - (optional) A RequestTiming to record the time spent in each
+                 phase of the request in.
+
+        Returns:
+        A Response.
+
+        Raises:
+        httplib.HTTPException or socket.error if the request fails.
+        """
+        if timing is not None:
+            timing.begin()
+
+        cached, expires = self.lookup(url)
+        headers = dict(headers or {})
+
+        if cached is not None:
+            if time.time() < expires:
+                self.hits += 1
+
+                if timing is not None:
+                    timing.cached = True
+                    timing.end = monotonic()
+
+                return cached
+
+            etag = header_value(cached.headers, 'etag')
+            last_modified = header_value(cached.headers, 'last-modified')
+
+            if etag is not None:
+                headers['If-None-Match'] = etag
+
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+
+        response = pool.request('GET', url, None, headers, timing)
+
+        if response.status_code == 304 and cached is not None:
+            self.revalidations += 1
+            return self.revalidated(url, cached, response)
+
+        self.misses += 1
+        self.store(url, response)
+
+        return response
+
+# The connection pool used by invoke_api when no pool is specified
+default_pool = ConnectionPool()
+
+# The engine used by invoke_api_async when no engine is specified
+default_engine = AsyncEngine()
+
+# How an option is sent as a parameter of an API method
+_VALUE = 'value'    # Sent as given, if specified
+_FLAG = 'flag'      # Sent as true, if set
+_SWITCH = 'switch'  # Sent as true or false, if specified
+
+class _MethodSpec(object):
+    """The specification of an API method, from which the function
+    constructing its request is generated.
+    """
+    def __init__(self, name, http_method, path, params, url_option=None, files=()):
+        """Create a specification.
+
+        Arguments:
+        name - The name of the API method.
+        http_method - GET or POST. The parameters of a GET request are sent in
+                      the query string and those of a POST request as POST data.
+        path - The path of the method below the API root. Each option in the
+               path is written as {option}, {option[0]} for the first of an
+               option given more than once, or {option:date} for a date given
+               as YYYY-MM-DD. The options in the path are required.
+        params - A sequence of tuples containing the name of each option sent
+                 as a parameter and how it is sent: _VALUE, _FLAG or _SWITCH.
+                 Parameters are added in this order.
+        url_option - (optional) The name of a required option holding the
+                     complete url to use instead of the path.
+        files - (optional) A sequence of tuples containing the name of a POST
+                data field and the option naming the file to upload in it.
+        """
+        self.name = name
+        self.http_method = http_method
+        self.path = path
+        self.params = params
+        self.url_option = url_option
+        self.files = files
+
+# The options of the methods that create or resight a Sighting
+_SIGHTING_PARAMS = (
+    ('access_token', _VALUE),
+    ('accuracy', _VALUE),
+    ('altitude', _VALUE),
+    ('altitude_accuracy', _VALUE),
+    ('blobtracker_id', _VALUE),
+    ('description', _VALUE),
+    ('heading', _VALUE),
+    ('hold', _FLAG),
+    ('latitude', _VALUE),
+    ('locator_id', _VALUE),
+    ('longitude', _VALUE),
+    ('publish_to_facebook', _FLAG),
+    ('sandbox', _FLAG),
+    ('speed', _VALUE),
+    ('tweet_sighting', _FLAG),
+    ('tz_offset', _VALUE),
+)
+
+# The options of the methods that list Sightings
+_SIGHTING_LIST_PARAMS = (
+    ('access_token', _VALUE),
+    ('cursor', _VALUE),
+    ('end_date', _VALUE),
+    ('fetch_size', _VALUE),
+    ('latitude', _VALUE),
+    ('list_type', _VALUE),
+    ('longitude', _VALUE),
+    ('start_date', _VALUE),
+)
+
+# The options of the other List methods
+_LIST_PARAMS = (
+    ('access_token', _VALUE),
+    ('cursor', _VALUE),
+    ('fetch_size', _VALUE),
+)
+
+_ACCESS_TOKEN_PARAMS = (
+    ('access_token', _VALUE),
+)
+
+_SANDBOX_PARAMS = (
+    ('access_token', _VALUE),
+    ('sandbox', _FLAG),
+)
+
+# The specification of every API method
+_METHOD_SPECS = [
+    _MethodSpec('CreateLocator', 'POST', '/locators', (
+        ('access_token', _VALUE),
+        ('closed', _FLAG),
+        ('description', _VALUE),
+        ('name', _VALUE),
+        ('sandbox', _FLAG),
+    )),
+    _MethodSpec('CreateLocatorSighting', 'POST', '/locators/{locator_id[0]}/sightings', (
+        ('access_token', _VALUE),
+        ('sandbox', _FLAG),
+        ('user_id', _VALUE),
+        ('sighting_id', _VALUE),
+    )),
+    _MethodSpec('CreateSighting', 'POST', '/sightings', _SIGHTING_PARAMS),
+    _MethodSpec('GetDailySighting', 'GET', '/dailysightings/{date:date}', _ACCESS_TOKEN_PARAMS),
+    _MethodSpec('GetSighting', 'GET', '/sightings/{user_id}/{sighting_id}', _ACCESS_TOKEN_PARAMS),
+    _MethodSpec('GetUser', 'GET', '/users/{user_id}', _ACCESS_TOKEN_PARAMS),
+    _MethodSpec('GetUserStatistics', 'GET', '/users/{user_id}/statistics', _ACCESS_TOKEN_PARAMS),
+    _MethodSpec('ListLocators', 'GET', '/locators', _LIST_PARAMS),
+    _MethodSpec('ListLocatorSightings', 'GET', '/locators/{locator_id[0]}/sightings', _SIGHTING_LIST_PARAMS),
+    _MethodSpec('ListResightings', 'GET', '/sightings/{user_id}/{sighting_id}/resightings', _LIST_PARAMS),
+    _MethodSpec('ListSightingLocators', 'GET', '/sightings/{user_id}/{sighting_id}/locators', _LIST_PARAMS),
+    _MethodSpec('ListSightings', 'GET', '/sightings', _SIGHTING_LIST_PARAMS),
+    _MethodSpec('ListUserCountryStatistics', 'GET', '/users/{user_id}/statistics/countries', _LIST_PARAMS),
+    _MethodSpec('ListUserLocalityStatistics', 'GET', '/users/{user_id}/statistics/localities', _LIST_PARAMS),
+    _MethodSpec('ListUserLocators', 'GET', '/users/{user_id}/locators', _LIST_PARAMS),
+    _MethodSpec('ListUserSightings', 'GET', '/users/{user_id}/sightings', _SIGHTING_LIST_PARAMS),
+    _MethodSpec('Meta', 'GET', '/meta', _ACCESS_TOKEN_PARAMS),
+    _MethodSpec('RemoveLocatorSighting', 'POST', '/locators/{locator_id[0]}/sightings/{user_id}/{sighting_id}/remove',
+                _SANDBOX_PARAMS),
+    _MethodSpec('ResightSighting', 'POST', '/sightings/{user_id}/{sighting_id}/resightings', _SIGHTING_PARAMS),
+    _MethodSpec('UpdateSighting', 'POST', '/sightings/{user_id}/{sighting_id}', (
+        ('access_token', _VALUE),
+        ('blobtracker_id', _VALUE),
+        ('description', _VALUE),
+        ('hold', _SWITCH),
+        ('publish_to_facebook', _SWITCH),
+        ('sandbox', _FLAG),
+        ('tweet_sighting', _SWITCH),
+    )),
+    _MethodSpec('Upload', 'POST', None, _SANDBOX_PARAMS, url_option='upload_url',
+                files=(('file', 'filename'),)),
+    _MethodSpec('UploadUrl', 'POST', '/uploadurl', _SANDBOX_PARAMS),
+    _MethodSpec('User', 'GET', '/user', _ACCESS_TOKEN_PARAMS),
+]
+
+# Matches an option in the path of a method specification
+_PATH_OPTION = re.compile(r'\{(\w+)(\[0\]|:date)?\}')
+
+def _required_option(lines, option):
+    """Add the source checking that an option was specified.
+    """
+    # e.g. "An upload-url" but "A user-id"
+    article = 'An' if option[0] in 'aeio' or option.startswith('up') else 'A'
+
+    lines.append('    if opts.%s is None:' % option)
+    lines.append('        raise Error(%r)' % ('%s %s is required for this API method' % (article, option.replace('_', '-'))))
+
+# The docstrings of the generated functions
+_GET_BUILDER_DOC = """Construct the url for a call to the %s API method.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    opts - The command-line options.
+
+    Returns:
+    A tuple containing the full url for invoking the API method and None for
+    the POST data and content type as this is a GET request.
+
+    Raises:
+    Error if a required option was not specified.
+    """
+
+_POST_BUILDER_DOC = """Construct the url and POST data for a call to the %s API method.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    opts - The command-line options.
+
+    Returns:
+    A tuple containing the full url for invoking the API method, the POST data
+    to be sent and the POST data content type.
+
+    Raises:
+    Error if a required option was not specified.
+    """
+
+def _compile_builder(spec):
+    """Generate the function constructing the request for an API method from
+    its specification.
+
+    The function is compiled from source, with the url template and the
+    parameters unrolled, so that nothing is looked up or interpreted from the
+    specification when a request is built.
+
+    Returns:
+    A function taking the server url and the command-line options and
+    returning a tuple containing the url for the API method, the POST data
+    and the POST data content type, or None for both for a GET request.
+    """
+    function_name = 'api_%s' % spec.name.lower()
+    lines = ['def %s(server_url, opts):' % function_name]
+    url_args = []
+
+    if spec.url_option is not None:
+        _required_option(lines, spec.url_option)
+        template = '%s'
+        url_args.append('opts.%s' % spec.url_option)
+    else:
+        url_args.append('server_url')
+        path_parts = []
+        position = 0
+
+        for match in _PATH_OPTION.finditer(spec.path):
+            option, qualifier = match.groups()
+            path_parts.append(spec.path[position:match.start()].replace('%', '%%'))
+            position = match.end()
+            _required_option(lines, option)
+
+            if qualifier == ':date':
+                lines.append('    import datetime')
+                lines.append('    try:')
+                lines.append('        %s = datetime.datetime.strptime(opts.%s, %r)' % (option, option, '%Y-%m-%d'))
+                lines.append('    except ValueError:')
+                lines.append('        raise Error(%r)' % ('The %s is invalid' % option.replace('_', '-')))
+                path_parts.append('%04d/%02d/%02d')
+                url_args.extend('%s.%s' % (option, field) for field in ('year', 'month', 'day'))
+            else:
+                path_parts.append('%s')
+                url_args.append('opts.%s%s' % (option, qualifier or ''))
+
+        path_parts.append(spec.path[position:].replace('%', '%%'))
+        template = '%%s/%s%s' % (_API_ROOT_PATH, ''.join(path_parts))
+
+    lines.append('    params = {}')
+
+    for option, encoding in spec.params:
+        if encoding == _FLAG:
+            lines.append('    if opts.%s:' % option)
+            lines.append('        params[%r] = %r' % (option, 'true'))
+        elif encoding == _SWITCH:
+            lines.append('    if opts.%s is not None:' % option)
+            lines.append('        params[%r] = %r if opts.%s else %r' % (option, 'true', option, 'false'))
+        else:
+            lines.append('    if opts.%s is not None:' % option)
+            lines.append('        params[%r] = opts.%s' % (option, option))
+
+    if spec.http_method == 'GET':
+        template += '?%s'
+        url_args.append('_encode_params(params)')
+        lines.append('    return %r %% (%s,), None, None' % (template, ', '.join(url_args)))
+    else:
+        if spec.files:
+            lines.append('    files = {}')
+
+            for field, option in spec.files:
+                lines.append('    if opts.%s is not None:' % option)
+                lines.append('        try:')
+                lines.append('            files[%r] = UploadFile(opts.%s, use_mmap=opts.mmap_upload)' % (field, option))
+                lines.append('        except (IOError, OSError) as e:')
+                lines.append('            raise Error(str(e))')
+
+            lines.append('    data, content_type = encode_post_data(params, files=files)')
+        else:
+            lines.append('    data, content_type = encode_post_data(params)')
+
+        lines.append('    return %r %% (%s,), data, content_type' % (template, ', '.join(url_args)))
+
+    namespace = {}
+    exec compile('\n'.join(lines) + '\n', '<%s>' % function_name, 'exec') in globals(), namespace
+    builder = namespace[function_name]
+    builder.__doc__ = _builder_doc(spec)
+
+    return builder
+
+def _builder_doc(spec):
+    """Get the docstring of the function constructing the request for an API
+    method.
+    """
+    if spec.http_method == 'GET':
+        return _GET_BUILDER_DOC % spec.name
+    else:
+        return _POST_BUILDER_DOC % spec.name
+
+def _lazy_builder(spec):
+    """Get a function that compiles the function constructing the request for
+    an API method the first time it is called, and then replaces itself with
+    it. Only the methods that are used are compiled, which keeps startup fast.
+    """
+    name = spec.name.lower()
+    compiled = []
+
+    def builder(server_url, opts):
+        if not compiled:
+            compiled.append(_compile_builder(spec))
+            methods[name] = compiled[0]
+            globals()[compiled[0].__name__] = compiled[0]
+
+        return compiled[0](server_url, opts)
+
+    builder.__name__ = 'api_%s' % name
+    builder.__doc__ = _builder_doc(spec)
+
+    return builder
+
+# A dictionary containing all the API methods and the function to call to
+# construct the url and optional POST data. Each function is also available
+# as api_<method>, e.g. api_getuser.
+methods = dict((spec.name.lower(), _lazy_builder(spec)) for spec in _METHOD_SPECS)
+globals().update((builder.__name__, builder) for builder in methods.itervalues())
+
+# The List API methods that return a page of results and a cursor for
+# continuing the listing from
+paged_methods = frozenset(spec.name.lower() for spec in _METHOD_SPECS
+                          if any(option == 'cursor' for option, _ in spec.params))
+
+# The keys a page of results may hold the cursor for the next page in
+_CURSOR_KEYS = ('cursor', 'next_cursor')
+
+# The formats the response can be written in, and those written as the body is
+# read rather than once it has been read in full
+_OUTPUT_FORMATS = ('compact', 'ndjson', 'pretty', 'raw')
+_STREAMED_OUTPUT_FORMATS = frozenset(['ndjson', 'raw'])
+
+def _create_option_parser():
+    """Create the parser for the command-line arguments and options.
+    
+    Returns:
+    An OptionParser.
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="""%prog server-url method [options]
+       %prog server-url --batch=FILE [options]
+       %prog server-url --ingest=FILE [options]
+       %prog server-url --sync=DATABASE --user-id=USER_ID [options]
+       %prog --serve=SOCKET [options]
+
+Arguments:
+  server-url            The url of the server where the API is running,
+                        e.g. https://resighting-api.appspot.com
+  method                The name of the API to invoke. See list below.
+                        Omitted in batch mode.
+
+Methods:
+  CreateLocator
+  CreateLocatorSighting
+  CreateSighting
+  GetDailySighting
+  GetSighting
+  GetUser
+  GetUserStatistics
+  ListLocators
+  ListLocatorSightings
+  ListResightings
+  ListSightingLocators
   ListSightings
   ListUserCountryStatistics
   ListUserLocalityStatistics
@@ -1175,39 +2902,112 @@ Methods:
   User""")
     
     parser.add_option('--access-token', help='An API access token')
+    parser.add_option('--all-pages', action='store_true', help='Follow the cursor returned by a List method and output the results from every page')
     parser.add_option('--accuracy', help='The accuracy of a latitude and longitude in metres')
     parser.add_option('--altitude', help='An altitude in metres')
     parser.add_option('--altitude-accuracy', help='The accuracy of an altitude reading in metres')
+    parser.add_option('--batch', help='Invoke the API methods listed in a file, one JSON object per line, or - to read from stdin')
     parser.add_option('--blobtracker-id', help='A blobtracker id returned by the Upload API')
+    parser.add_option('--cache', action='store_true', help='Cache responses to GET requests on disk and answer later requests from the cache')
+    parser.add_option('--cache-dir', help='The directory responses to GET requests are cached in, which turns on caching. Defaults to ~/.apiclient/cache with --cache.')
+    parser.add_option('--cache-size', type='int', default=_DEFAULT_CACHE_SIZE, help='The maximum number of bytes of responses kept in the cache. The least recently used are removed first.')
+    parser.add_option('--checkpoint-file', help='The file recording the progress of a resumable upload or of an ingest. Defaults to the file to upload or ingest with .checkpoint added.')
+    parser.add_option('--chunk-size', type='int', default=_DEFAULT_CHUNK_SIZE, help='The number of bytes sent in each request of a resumable upload')
     parser.add_option('--closed', action='store_true', help='A closed locator requiring approval to join')
+    parser.add_option('--concurrency', type='int', default=1, help='The number of API methods invoked at the same time in batch, ingest or sync mode')
     parser.add_option('--cursor', help='A cursor returned by a previous call to the method marking the point where listing should continue from')
+    parser.add_option('--daemon', metavar='SOCKET', help='The Unix socket of an apiclient.py daemon to forward the command to. Defaults to the APICLIENT_DAEMON environment variable.')
     parser.add_option('--date', help='A date in the format YYYY-MM-DD')
     parser.add_option('--description', help='A description')
     parser.add_option('--end-date', help='A date or datetime in ISO 8601 format')
+    parser.add_option('--export', metavar='PATH', help='Export the Sightings from every page of a List method as columns of numbers that NumPy can load, to a .npz file or else to a directory of .npy files')
     parser.add_option('--fetch-size', help='The number of results to retrieve')
     parser.add_option('--filename', help='A file to upload')
     parser.add_option('--heading', help='A heading')
     parser.add_option('--hold', action='store_true', help='Place a Sighting on hold')
+    parser.add_option('--ingest', metavar='FILE', help='Create a Sighting for each row of a CSV file with a header row naming the CreateSighting options, or for each point of a GPX file')
+    parser.add_option('--idle-timeout', type='float', default=_DEFAULT_IDLE_TIMEOUT, help='The number of seconds an idle connection to the server is kept open for reuse')
     parser.add_option('--latitude', help='A latitude')
     parser.add_option('--list-type', help='The type of list to request: latest or nearest Sightings')
     parser.add_option('--locator-id', action='append', help='A Locator id. Multiple can be specified.')
     parser.add_option('--longitude', help='A longitude')
+    parser.add_option('--max-per-host', type='int', help='The maximum number of requests made to a single server at the same time')
+    parser.add_option('--max-requests-per-connection', type='int', default=_DEFAULT_MAX_REQUESTS_PER_CONNECTION, help='The maximum number of requests sent over a single connection to the server')
+    parser.add_option('--mmap-upload', action='store_true', help='Memory-map the file to upload and send it without copying it into memory')
     parser.add_option('--name', help='A name')
+    parser.add_option('--no-cache', action='store_true', help='Do not cache responses to GET requests or use cached responses, even if --cache or --cache-dir is given')
     parser.add_option('--no-hold', action='store_false', help='Do not place a Sighting on hold', dest='hold')
     parser.add_option('--no-publish-to-facebook', action='store_false', help='Do not publish a Sighting to the user\'s Facebook wall', dest='publish_to_facebook')
     parser.add_option('--no-tweet-sighting', action='store_false', help='Do not tweet a Sighting', dest='tweet_sighting')
     parser.add_option('--options', action='store_true', help='Send an OPTIONS HTTP request to the server')
+    parser.add_option('--output', type='choice', choices=_OUTPUT_FORMATS, default='pretty', metavar='FORMAT', help='How the response is written: pretty (indented JSON, the default), compact (JSON on one line), ndjson (one line of JSON per result of a List method) or raw (the response body unchanged)')
+    parser.add_option('--pool-size', type='int', default=_DEFAULT_POOL_SIZE, help='The maximum number of idle connections kept open per server')
     parser.add_option('--publish-to-facebook', action='store_true', help='Publish a Sighting to the user\'s Facebook wall')
+    parser.add_option('--rate', type='float', help='The maximum number of requests made per second')
+    parser.add_option('--resumable', action='store_true', help='Upload a file in chunks that can be resumed if the upload is interrupted. The upload url must support resumable uploads.')
+    parser.add_option('--retries', type='int', default=_DEFAULT_RETRIES, help='The number of times a request the server throttles with a 429 or 503 response is retried')
+    parser.add_option('--retry-posts', action='store_true', help='Retry throttled POST requests as well as GET requests. A retried POST may create a duplicate.')
     parser.add_option('--sandbox', action='store_true', help='Invoke the API in sandbox mode')
+    parser.add_option('--serve', metavar='SOCKET', help='Run as a daemon accepting commands on a Unix socket, keeping connections open between them')
     parser.add_option('--sighting-id', help='A Sighting id')
     parser.add_option('--speed', help='A speed')
     parser.add_option('--start-date', help='A date or datetime in ISO 8601 format')
+    parser.add_option('--sync', metavar='DATABASE', help='Mirror the Sightings of the user given by --user-id, with their Resightings and Locators, into a SQLite database, fetching only those updated since the last sync')
+    parser.add_option('--timing', action='store_true', help='Write the time spent in each phase of the request, such as DNS, connect, TLS and waiting for the response, to stderr as JSON. In batch mode the times are added to each result.')
     parser.add_option('--tweet-sighting', action='store_true', help='Tweet a Sighting')
     parser.add_option('--tz-offset', help='The number of minutes that the user\'s timezone is offset from UTC. Valid values are from -720 (UTC-12:00) to 840 (UTC+14:00).')
+    parser.add_option('--unordered', action='store_true', help='Output batch or ingest results as soon as each completes rather than in order')
     parser.add_option('--upload-url', help='The url to upload the file to')
     parser.add_option('--user-id', help='A user\'s id')
     
-    opts, args = parser.parse_args()
+    return parser
+
+def parse_command_line(args=None):
+    """Parse the command-line arguments and options.
+
+    Arguments:
+    args - (optional) The arguments to parse. Defaults to sys.argv[1:].
+    
+    Returns:
+    A tuple containing the API server url, the name of the API method to call
+    and the command-line options object returned by the options parser. In
+    batch mode the name of the API method is None, when ingesting it is
+    CreateSighting, when syncing it is ListUserSightings and when serving as
+    a daemon both are None.
+    """
+    parser = _create_option_parser()
+    opts, args = parser.parse_args(args)
+
+    if opts.serve is not None:
+        # Commands are received from clients of the daemon
+        if args:
+            parser.error('Incorrect number of arguments')
+
+        return (None, None, opts)
+
+    if opts.batch is not None:
+        # The methods to invoke are read from the batch file
+        if len(args) != 1:
+            parser.error('Incorrect number of arguments')
+
+        return (args[0], None, opts)
+
+    if opts.ingest is not None:
+        # Sightings are created from the rows or points of the file
+        if len(args) != 1:
+            parser.error('Incorrect number of arguments')
+
+        return (args[0], 'CreateSighting', opts)
+
+    if opts.sync is not None:
+        # The user's Sightings are mirrored into the database
+        if len(args) != 1:
+            parser.error('Incorrect number of arguments')
+
+        if opts.user_id is None:
+            parser.error('--sync requires --user-id')
+
+        return (args[0], 'ListUserSightings', opts)
 
     # Make sure the mandatory arguments were provided
     if len(args) != 2:
@@ -1220,10 +3020,22 @@ Methods:
     if method.lower() not in methods:
         parser.error('Invalid method')
 
+    if opts.all_pages and method.lower() not in paged_methods:
+        parser.error('--all-pages can only be used with a List method')
+
+    if opts.export is not None and method.lower() not in paged_methods:
+        parser.error('--export can only be used with a List method')
+
+    if opts.resumable and method.lower() != 'upload':
+        parser.error('--resumable can only be used with the Upload method')
+
+    if opts.all_pages and opts.output == 'raw':
+        parser.error('--output=raw cannot be used with --all-pages')
+
     return (server_url, method, opts)
 
-def invoke_api(server_url, method, opts):
-    """Invoke a Resighting API method and return the response.
+def build_request(server_url, method, opts):
+    """Construct the HTTP request for invoking a Resighting API method.
     
     Arguments:
     server_url - The url of the server where the API is running.
@@ -1231,13 +3043,11 @@ def invoke_api(server_url, method, opts):
     opts - The command-line options.
     
     Returns:
-    A tuple containing the response body, the HTTP status code and the
-    response headers.
+    A tuple containing the HTTP method, the url, the request body or None and
+    a dictionary of request headers.
     
     Raises:
-    Error if an errors occurs. HTTP errors (i.e. a non 200 response) are
-    not raised an an exception but the function returns with the response
-    body and HTTP status code.
+    Error if the request cannot be constructed from the options.
     """
     # Get the API method function
     method_fn = methods[method.lower()]
@@ -1245,95 +3055,3697 @@ def invoke_api(server_url, method, opts):
     # Get the API method url and optional POST data and content type
     method_url, data, content_type = method_fn(server_url, opts)
 
-    # Open the API method url and get the response
-    status_code = 200
-    headers = None
-    f = None
-    connection = None
+    headers = {}
+
+    if opts.options:
+        # Make an OPTIONS request
+        http_method = 'OPTIONS'
+        data = None
+    elif data is not None:
+        # Make a POST request
+        http_method = 'POST'
+
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+    else:
+        # Make a GET request
+        http_method = 'GET'
+
+    return http_method, method_url, data, headers
+
+def invoke_api(server_url, method, opts, pool=None, cache=None, timing=None):
+    """Invoke a Resighting API method and return the response.
     
-    try:
-        if opts.options:
-            # Make an OPTIONS request
-            url = urlparse.urlparse(method_url)
-            
-            connection = httplib.HTTPConnection(url.netloc)
-            connection.request('OPTIONS', url.path)
-            
-            http_response = connection.getresponse()
-            
-            status_code = http_response.status
-            headers = http_response.getheaders()
-            response = http_response.read()
-            
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the API method to invoke.
+    opts - The command-line options.
+    pool - (optional) The ConnectionPool to make the request through. If not
+           specified the module's default pool is used.
+    cache - (optional) A ResponseCache used to answer GET requests. If not
+            specified responses are not cached.
+    timing - (optional) A RequestTiming to record the time spent in each
+             phase of the request in.
+    
+    Returns:
+    A tuple containing the response body, the HTTP status code and the
+    response headers.
+    
+    Raises:
+    Error if an errors occurs. HTTP errors (i.e. a non 200 response) are
+    not raised an an exception but the function returns with the response
+    body and HTTP status code.
+    """
+    request = build_request(server_url, method, opts)
+
+    return send_request(request, pool=pool, cache=cache, timing=timing)
+
+def send_request(request, pool=None, cache=None, timing=None):
+    """Send a request constructed by build_request and return the response.
+
+    Arguments:
+    request - The tuple returned by build_request.
+    pool - (optional) The ConnectionPool to make the request through. If not
+           specified the module's default pool is used.
+    cache - (optional) A ResponseCache used to answer GET requests. If not
+            specified responses are not cached.
+    timing - (optional) A RequestTiming to record the time spent in each
+             phase of the request in.
+
+    Returns:
+    A tuple containing the response body, the HTTP status code and the
+    response headers.
+
+    Raises:
+    Error if the request fails.
+    """
+    import httplib
+    import socket
+
+    if pool is None:
+        pool = default_pool
+
+    http_method, method_url, data, headers = request
+
+    try:
+        if cache is not None and http_method == 'GET':
+            http_response = cache.request(pool, method_url, headers, timing)
+        else:
+            http_response = pool.request(http_method, method_url, data, headers, timing)
+    except (httplib.HTTPException, socket.error):
+        raise Error('Failed to connect to API at %s' % method_url)
+
+    return http_response.body, http_response.status_code, http_response.headers
+
+def invoke_api_stream(server_url, method, opts, pool=None, timing=None):
+    """Invoke a Resighting API method and return the response once its headers
+    have been received, without reading the body.
+    
+    The arguments are the same as for invoke_api.
+    
+    Returns:
+    A StreamingResponse. Its body should be read in full or the response
+    closed so that the connection is released.
+    
+    Raises:
+    Error if an errors occurs. HTTP errors (i.e. a non 200 response) are
+    not raised an an exception.
+    """
+    import httplib
+    import socket
+
+    if pool is None:
+        pool = default_pool
+
+    http_method, method_url, data, headers = build_request(server_url, method, opts)
+
+    try:
+        return pool.open(http_method, method_url, data, headers, timing)
+    except (httplib.HTTPException, socket.error):
+        raise Error('Failed to connect to API at %s' % method_url)
+
+def _read_chunks(response):
+    """Read the body of a StreamingResponse in chunks, raising Error if reading
+    fails.
+    """
+    import httplib
+    import socket
+
+    try:
+        for chunk in response.iter_chunks():
+            yield chunk
+    except (httplib.HTTPException, socket.error):
+        raise Error('Failed to read the response from %s' % response.url)
+
+class JSONItemStream(object):
+    """Decodes a JSON response incrementally as the body is read, returning the
+    results of a List API method one at a time as soon as each is decoded.
+
+    The response is either a list of results or an object containing a list of
+    results along with other values, such as a cursor. The other values are
+    collected in the envelope as they are decoded.
+
+    Attributes:
+    envelope - A dictionary of the values in the response other than the list
+               of results. Complete once all the results have been returned.
+    has_items - True if the list of results is not empty, once known.
+    """
+    def __init__(self, chunks, decode_items=True):
+        """Create a stream.
+
+        Arguments:
+        chunks - An iterable of chunks of the body of the response.
+        decode_items - (optional) If False the whole body is read and the list
+                       of results is skipped over without being decoded. Use
+                       this to read just the envelope.
+        """
+        import json
+
+        self.envelope = {}
+        self.has_items = False
+        self._decoder = json.JSONDecoder()
+        self._decode_items = decode_items
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        """Add the next chunk of the body to the buffer.
+
+        Returns:
+        False if the whole body has been read.
+        """
+        chunk = next(self._chunks, None)
+
+        if chunk is None:
+            self._eof = True
+            return False
+
+        # Drop the part of the buffer that has already been decoded
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+        return True
+
+    def _next_char(self):
+        """Skip whitespace and get the next character without consuming it.
+        """
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buffer, self._pos).end()
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._more():
+                raise Error('The response is not valid JSON')
+
+    def _expect(self, chars):
+        """Consume the next character, which must be one of chars.
+        """
+        char = self._next_char()
+
+        if char not in chars:
+            raise Error('The response is not valid JSON')
+
+        self._pos += 1
+
+        return char
+
+    def _value(self):
+        """Decode the next value, reading more of the body until it is complete.
+        """
+        self._next_char()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise Error('The response is not valid JSON')
+
+            self._more()
+
+    def _skip_list(self):
+        """Skip over a list in a buffer holding the whole body.
+        """
+        depth = 0
+
+        for match in _JSON_SKIP.finditer(self._buffer, self._pos):
+            token = match.group()
+
+            if token in '[{':
+                depth += 1
+            elif token in ']}':
+                depth -= 1
+
+                if depth == 0:
+                    self._pos = match.end()
+                    return
+
+        raise Error('The response is not valid JSON')
+
+    def _items(self):
+        """Decode the list of results, returning each result as it is decoded.
+        """
+        if not self._decode_items:
+            while self._more():
+                pass
+
+            start = self._buffer.index('[', self._pos)
+            self._skip_list()
+            self.has_items = self._buffer[_JSON_WHITESPACE.match(self._buffer, start + 1).end()] != ']'
+            return
+
+        self._expect('[')
+
+        if self._next_char() == ']':
+            self._pos += 1
+            return
+
+        self.has_items = True
+
+        while True:
+            yield self._value()
+
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        if self._next_char() == '[':
+            for item in self._items():
+                yield item
+
+            return
+
+        self._expect('{')
+
+        if self._next_char() == '}':
+            self._pos += 1
+            return
+
+        found_items = False
+
+        while True:
+            key = self._value()
+            self._expect(':')
+
+            if not found_items and self._next_char() == '[':
+                found_items = True
+
+                for item in self._items():
+                    yield item
+            else:
+                self.envelope[key] = self._value()
+
+            if self._expect(',}') == '}':
+                return
+
+def invoke_api_async(server_url, method, opts, callback, engine=None):
+    """Queue an invocation of a Resighting API method on an AsyncEngine.
+    
+    The request is made when the engine's run method is called, alongside any
+    other requests queued on the engine.
+    
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the API method to invoke.
+    opts - The command-line options.
+    callback - A function called with two arguments when the method has been
+               invoked. On success the first is a tuple containing the response
+               body, the HTTP status code and the response headers, as returned
+               by invoke_api, and the second is None. On failure the first is
+               None and the second is an Error.
+    engine - (optional) The AsyncEngine to queue the request on. If not
+             specified the module's default engine is used.
+    
+    Raises:
+    Error if the request cannot be constructed from the options.
+    """
+    if engine is None:
+        engine = default_engine
+
+    http_method, method_url, data, headers = build_request(server_url, method, opts)
+
+    def on_response(http_response, error):
+        if error is not None:
+            callback(None, error)
+        else:
+            callback((http_response.body, http_response.status_code, http_response.headers), None)
+
+    engine.request(http_method, method_url, data, headers, on_response)
+
+def _load_checkpoint(checkpoint_file, upload_url, size, mtime):
+    """Get the number of bytes of a file acknowledged by the server from a
+    checkpoint file, or 0 if there is no checkpoint for the file.
+    """
+    import json
+
+    try:
+        with open(checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+
+        if (checkpoint['upload_url'] != upload_url or checkpoint['size'] != size
+                or checkpoint['mtime'] != mtime):
+            return 0
+
+        # Find the end of the acknowledged bytes from the start of the file
+        acknowledged = 0
+
+        for start, end in sorted(checkpoint['acknowledged']):
+            if start > acknowledged:
+                break
+
+            acknowledged = max(acknowledged, end)
+
+        return acknowledged
+    except (IOError, ValueError, KeyError, TypeError):
+        return 0
+
+def _save_checkpoint(checkpoint_file, upload_url, size, mtime, acknowledged):
+    """Record the number of bytes of a file acknowledged by the server in a
+    checkpoint file.
+    """
+    import json
+
+    temporary_file = '%s.tmp' % checkpoint_file
+
+    with open(temporary_file, 'w') as f:
+        json.dump({
+            'upload_url': upload_url,
+            'size': size,
+            'mtime': mtime,
+            'acknowledged': [[0, acknowledged]],
+        }, f)
+
+    os.rename(temporary_file, checkpoint_file)
+
+def _acknowledged_bytes(response):
+    """Get the number of bytes acknowledged by the server from the Range header
+    of a Resume Incomplete response.
+    """
+    value = header_value(response.headers, 'range')
+
+    if value is not None and value.startswith('bytes=0-'):
+        try:
+            return int(value[len('bytes=0-'):]) + 1
+        except ValueError:
+            pass
+
+    return 0
+
+def resumable_upload(upload_url, filename, pool=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+                     checkpoint_file=None, use_mmap=False):
+    """Upload a file in chunks to a url that supports resumable uploads.
+
+    Each chunk is sent in a PUT request with a Content-Range header. The server
+    responds to each chunk with a 308 (Resume Incomplete) response and a Range
+    header giving the bytes received so far, and to the final chunk with the
+    response for the whole upload. The bytes acknowledged are recorded in a
+    checkpoint file so that if the upload is interrupted it resumes from the
+    last acknowledged chunk the next time it is made. The checkpoint file is
+    removed when the upload completes.
+
+    Arguments:
+    upload_url - The url to upload the file to.
+    filename - The name of the file to upload.
+    pool - (optional) The ConnectionPool to make the requests through.
+    chunk_size - (optional) The number of bytes sent in each request.
+    checkpoint_file - (optional) The name of the checkpoint file. Defaults to
+                      the name of the file to upload with .checkpoint added.
+    use_mmap - (optional) If True the file is memory-mapped and the chunks are
+               sent without being copied into memory.
+
+    Returns:
+    A tuple containing the response body, the HTTP status code and the
+    response headers of the final request.
+
+    Raises:
+    Error if the file cannot be read or the upload fails repeatedly.
+    """
+    import httplib
+    import mmap
+    import socket
+
+    if pool is None:
+        pool = default_pool
+
+    if checkpoint_file is None:
+        checkpoint_file = '%s.checkpoint' % filename
+
+    def request(body, content_range):
+        try:
+            return pool.request('PUT', upload_url, body, {'Content-Range': content_range})
+        except (httplib.HTTPException, socket.error):
+            return None
+
+    try:
+        size = os.path.getsize(filename)
+        mtime = os.path.getmtime(filename)
+        f = open(filename, 'rb')
+    except (IOError, OSError) as e:
+        raise Error(str(e))
+
+    try:
+        mapped = None
+
+        if use_mmap and size > 0:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = _load_checkpoint(checkpoint_file, upload_url, size, mtime)
+        query = offset > 0
+        failures = 0
+
+        while True:
+            if query:
+                # Ask the server how much of the file it has received
+                response = request('', 'bytes */%d' % size)
+            elif size == 0:
+                response = request('', 'bytes */0')
+            else:
+                if mapped is not None:
+                    chunk = buffer(mapped, offset, chunk_size)
+                else:
+                    f.seek(offset)
+                    chunk = f.read(chunk_size)
+
+                response = request(chunk, 'bytes %d-%d/%d' % (offset, offset + len(chunk) - 1, size))
+
+            if (response is None or response.status_code >= 500
+                    or (response.status_code == _RESUME_INCOMPLETE
+                        and _acknowledged_bytes(response) <= offset and not query)):
+                # The chunk was not received so check with the server before
+                # trying again
+                failures += 1
+
+                if failures >= _RESUMABLE_MAX_FAILURES:
+                    raise Error('Failed to upload to %s' % upload_url)
+
+                query = True
+                continue
+
+            query = False
+
+            if response.status_code != _RESUME_INCOMPLETE:
+                break
+
+            acknowledged = _acknowledged_bytes(response)
+
+            if acknowledged > offset:
+                failures = 0
+
+            offset = acknowledged
+
+            try:
+                _save_checkpoint(checkpoint_file, upload_url, size, mtime, offset)
+            except (IOError, OSError) as e:
+                raise Error(str(e))
+    finally:
+        f.close()
+
+    if 200 <= response.status_code < 300:
+        try:
+            os.remove(checkpoint_file)
+        except OSError:
+            pass
+
+    return response.body, response.status_code, response.headers
+
+def invoke_resumable_upload(opts, pool=None):
+    """Upload the file named in the command-line options to the upload url as
+    a resumable upload. The access token and sandbox flag are added to the
+    query string of the upload url.
+
+    Arguments:
+    opts - The command-line options.
+    pool - (optional) The ConnectionPool to make the requests through.
+
+    Returns:
+    A tuple containing the response body, the HTTP status code and the
+    response headers, as returned by invoke_api.
+
+    Raises:
+    Error if no upload_url or filename was specified on the command-line or
+    the upload fails.
+    """
+    # The upload_url is mandatory
+    if opts.upload_url is None:
+        raise Error('An upload-url is required for this API method')
+
+    # The filename is mandatory
+    if opts.filename is None:
+        raise Error('A filename is required for a resumable upload')
+
+    params = {}
+
+    if opts.access_token is not None:
+        params['access_token'] = opts.access_token
+
+    if opts.sandbox:
+        params['sandbox'] = 'true'
+
+    upload_url = opts.upload_url
+
+    if params:
+        upload_url = '%s%s%s' % (upload_url, '&' if '?' in upload_url else '?', _encode_params(params))
+
+    return resumable_upload(upload_url, opts.filename, pool=pool, chunk_size=opts.chunk_size,
+                            checkpoint_file=opts.checkpoint_file, use_mmap=opts.mmap_upload)
+
+class _Background(object):
+    """Calls a function on a background thread and holds on to the result.
+    """
+    def __init__(self, fn, *args):
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=_inherit_streams(self._run), args=(fn, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        """Wait for the function to return and get its return value. If the
+        function raised an exception it is re-raised.
+        """
+        self._thread.join()
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+class _Flight(object):
+    """A call in progress shared by _SingleFlight.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class _SingleFlight(object):
+    """Shares the result of a call between threads making the same call at
+    the same time, so that only one of them makes it.
+
+    Attributes:
+    coalesced - The number of calls that shared another call's result.
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def call(self, key, fn, *args):
+        """Call a function, or wait for the call already in progress with the
+        same key and share its return value or exception.
+
+        Arguments:
+        key - Identifies calls that have the same result.
+        fn - The function to call.
+        args - The arguments to call the function with.
+
+        Returns:
+        The return value of the function.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                flight.result = fn(*args)
+            except:
+                flight.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._flights[key]
+
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+
+        return flight.result
+
+def _page_items(page):
+    """Get the list of results from a page returned by a List API method.
+
+    Raises:
+    Error if the page does not contain a single list of results.
+    """
+    if isinstance(page, list):
+        return page
+
+    if not isinstance(page, dict):
+        raise Error('The response is not a list of results')
+
+    lists = [value for value in page.itervalues() if isinstance(value, list)]
+
+    if len(lists) > 1:
+        raise Error('The response contains more than one list of results')
+
+    return lists[0] if lists else []
+
+def _page_cursor(page):
+    """Get the cursor marking where listing continues from a page returned by
+    a List API method, or None if it is the last page.
+    """
+    if isinstance(page, dict):
+        for key in _CURSOR_KEYS:
+            if page.get(key):
+                return page[key]
+
+    return None
+
+def iterate_pages(server_url, method, opts, pool=None, prefetch=True):
+    """Invoke a List API method repeatedly, following the cursor returned
+    with each page, and return each page as it is received.
+
+    Listing starts from the cursor in the options, if any, and finishes when a
+    page has no cursor or no results.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the List API method to invoke.
+    opts - The command-line options.
+    pool - (optional) The ConnectionPool to make the requests through.
+    prefetch - (optional) If True the next page is requested in the
+               background while the current page is being consumed.
+
+    Returns:
+    A generator yielding the JSON decoded response for each page.
+
+    Raises:
+    Error if the method is not a List method or an error occurs.
+    APIError if the API returns a response other than 200.
+    """
+    import copy
+    import json
+
+    if method.lower() not in paged_methods:
+        raise Error('%s does not return pages of results' % method)
+
+    def fetch(cursor):
+        page_opts = copy.copy(opts)
+        page_opts.cursor = cursor
+
+        response, status_code, headers = invoke_api(server_url, method, page_opts, pool=pool)
+
+        if status_code != 200:
+            raise APIError(status_code, response, headers)
+
+        try:
+            return json.loads(response)
+        except ValueError:
+            raise Error('The response is not valid JSON')
+
+    cursor = opts.cursor
+    pending = _Background(fetch, cursor)
+
+    while pending is not None:
+        page = pending.result()
+        next_cursor = _page_cursor(page)
+        more = next_cursor is not None and next_cursor != cursor and len(_page_items(page)) > 0
+        cursor = next_cursor
+        pending = None
+
+        if more and prefetch:
+            pending = _Background(fetch, cursor)
+
+        yield page
+
+        if more and not prefetch:
+            pending = _Background(fetch, cursor)
+
+def iterate_items(server_url, method, opts, pool=None, prefetch=True):
+    """Invoke a List API method repeatedly, following the cursor returned
+    with each page, and return every result from every page one at a time.
+
+    The arguments are the same as for iterate_pages.
+
+    Returns:
+    A generator yielding each JSON decoded result.
+
+    Raises:
+    Error if the method is not a List method or an error occurs.
+    APIError if the API returns a response other than 200.
+    """
+    import copy
+
+    if method.lower() not in paged_methods:
+        raise Error('%s does not return pages of results' % method)
+
+    def open_page(cursor):
+        page_opts = copy.copy(opts)
+        page_opts.cursor = cursor
+
+        response = invoke_api_stream(server_url, method, page_opts, pool=pool)
+
+        if response.status_code != 200:
+            raise APIError(response.status_code, ''.join(_read_chunks(response)), response.headers)
+
+        return response
+
+    def fetch(cursor):
+        return ''.join(_read_chunks(open_page(cursor)))
+
+    cursor = opts.cursor
+
+    if not prefetch:
+        # Decode each page as it is read from the connection so that only the
+        # current result is held in memory
+        while True:
+            stream = JSONItemStream(_read_chunks(open_page(cursor)))
+
+            for item in stream:
+                yield item
+
+            next_cursor = _page_cursor(stream.envelope)
+
+            if next_cursor is None or next_cursor == cursor or not stream.has_items:
+                return
+
+            cursor = next_cursor
+
+    # The next page is read in the background while the results of the current
+    # page are consumed, so the cursor is found by skipping over the results
+    # before they are decoded
+    pending = _Background(fetch, cursor)
+
+    while pending is not None:
+        body = pending.result()
+        envelope = JSONItemStream([body], decode_items=False)
+
+        for item in envelope:
+            pass
+
+        next_cursor = _page_cursor(envelope.envelope)
+        more = next_cursor is not None and next_cursor != cursor and envelope.has_items
+        cursor = next_cursor
+        pending = None
+
+        if more:
+            pending = _Background(fetch, cursor)
+
+        for item in JSONItemStream([body]):
+            yield item
+
+# The pattern of field names that can be Record attributes
+_IDENTIFIER = r'[A-Za-z][A-Za-z0-9_]*$'
+
+# How each field of a Record is stored
+_STRING_FIELD, _ID_FIELD, _NESTED_FIELD = range(3)
+
+def _nested_field(name, slot):
+    """Create the property decoding a nested field of a Record.
+    """
+    def get(self):
+        import json
+
+        return json.loads(getattr(self, slot))
+
+    return property(get, doc='The %s field, decoded each time it is accessed.' % name)
+
+# The Record class for each base class and set of fields, shared by every
+# Record with those fields, and the slots and storage of the fields in the
+# order they are iterated from a dictionary
+_record_shapes = {}
+_record_layouts = {}
+
+def _record_shape(record_type, names, nested):
+    """Get the Record class for a set of fields.
+
+    Arguments:
+    record_type - The Record base class, e.g. Sighting.
+    names - A sorted tuple of the names of the fields.
+    nested - A frozenset of the names of the fields kept as JSON text.
+
+    Returns:
+    A subclass of record_type with a slot for each field.
+    """
+    import keyword
+
+    key = (record_type, names, nested)
+    shape = _record_shapes.get(key)
+
+    if shape is not None:
+        return shape
+
+    namespace = {}
+    slots = []
+
+    for i, name in enumerate(names):
+        attribute = name.encode('ascii') if re.match(_IDENTIFIER, name) else None
+
+        # Fields that aren't identifiers or that hide the methods of a Record
+        # are only available by name
+        if attribute is None or keyword.iskeyword(attribute) or hasattr(record_type, attribute):
+            slot = '_field%d' % i
+        elif name in nested:
+            slot = '_json_' + attribute
+            namespace[attribute] = _nested_field(name, slot)
+        else:
+            slot = attribute
+
+        slots.append(slot)
+
+    namespace.update({
+        '__slots__': tuple(slots),
+        '__module__': record_type.__module__,
+        '__doc__': record_type.__doc__,
+        '_names': names,
+        '_slot_names': dict(zip(names, slots)),
+        '_nested': nested,
+    })
+
+    shape = type(record_type.__name__, (record_type,), namespace)
+    _record_shapes[key] = shape
+
+    return shape
+
+def _record_layout(record_type, data):
+    """Get the Record class for the fields of a dictionary, the slot of each
+    field and how each is stored, in the order the fields are iterated.
+    """
+    keys = tuple(data)
+    layout = _record_layouts.get((record_type, keys))
+
+    if layout is None:
+        # The nested fields are those declared by the Record type and those
+        # holding objects or lists in the first Record with these fields
+        nested = frozenset(name for name in keys if name in record_type._nested_fields or
+                           isinstance(data[name], (dict, list)))
+        shape = _record_shape(record_type, tuple(sorted(keys)), nested)
+        fields = []
+
+        for name in keys:
+            if name in nested:
+                storage = _NESTED_FIELD
+            elif name.endswith('_id'):
+                storage = _ID_FIELD
+            else:
+                storage = _STRING_FIELD
+
+            fields.append((shape._slot_names[name], storage))
+
+        layout = (shape, tuple(fields))
+        _record_layouts[(record_type, keys)] = layout
+
+    return layout
+
+def _record_from_dict(record_type, data):
+    """Create a Record from a dictionary, used when unpickling Records.
+    """
+    return record_type.from_dict(data)
+
+class Record(object):
+    """A compact, read-only representation of a JSON object returned by the
+    API.
+
+    Each field is held in a slot rather than a dictionary, with the field
+    names shared by every Record with the same fields. Fields holding nested
+    objects or lists, such as a user's avatar and settings, are kept as JSON
+    text and only decoded when they are accessed. Fields are available as
+    attributes, e.g. sighting.latitude, and by name, e.g.
+    sighting['latitude'], so a Record can be used where a JSON decoded
+    object is expected. The known fields of each kind of Record are None if
+    the API didn't return them.
+    """
+    __slots__ = ()
+
+    # The fields the API is known to return and the fields always kept as JSON
+    # text, set by each subclass
+    _fields = frozenset()
+    _nested_fields = frozenset()
+
+    # Set by the class for each set of fields
+    _names = ()
+    _slot_names = {}
+    _nested = frozenset()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a Record from a JSON decoded object.
+
+        Strings that are ASCII are stored as byte strings, which take a
+        quarter of the memory of unicode strings, and ids are interned so that
+        a user or locator id repeated across many Records is stored once.
+
+        Arguments:
+        data - The JSON decoded object.
+
+        Returns:
+        An instance of the class.
+        """
+        shape, fields = _record_layout(cls, data)
+        record = object.__new__(shape)
+        setter = object.__setattr__
+
+        for (slot, storage), value in zip(fields, data.itervalues()):
+            if storage == _NESTED_FIELD:
+                import json
+
+                value = json.dumps(value, separators=(',', ':'))
+            elif type(value) is unicode:
+                try:
+                    value = value.encode('ascii')
+                except UnicodeEncodeError:
+                    pass
+                else:
+                    if storage == _ID_FIELD:
+                        value = intern(value)
+
+            setter(record, slot, value)
+
+        return record
+
+    def __getattr__(self, name):
+        # Only called for fields the Record doesn't have
+        if name in self._fields:
+            return None
+
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'%s' object is read-only" % type(self).__name__)
+
+    def __getitem__(self, name):
+        import json
+
+        try:
+            value = getattr(self, self._slot_names[name])
+        except (KeyError, TypeError):
+            raise KeyError(name)
+
+        if name in self._nested:
+            return json.loads(value)
+
+        return value
+
+    def __contains__(self, name):
+        return name in self._slot_names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __reduce__(self):
+        return _record_from_dict, (type(self).__bases__[0], self.to_dict())
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+    def get(self, name, default=None):
+        """Get a field by name.
+
+        Arguments:
+        name - The name of the field.
+        default - (optional) The value if the Record doesn't have the field.
+
+        Returns:
+        The value of the field.
+        """
+        if name not in self._slot_names:
+            return default
+
+        return self[name]
+
+    def keys(self):
+        """Get the names of the fields.
+        """
+        return list(self._names)
+
+    def to_dict(self):
+        """Get the Record as a JSON decoded object.
+
+        Returns:
+        A dictionary holding every field.
+        """
+        return dict((name, self[name]) for name in self._names)
+
+class Sighting(Record):
+    """A Sighting returned by the API.
+    """
+    __slots__ = ()
+    _fields = frozenset(['user_id', 'sighting_id', 'latitude', 'longitude', 'accuracy', 'altitude',
+                         'altitude_accuracy', 'heading', 'speed', 'tz_offset', 'description',
+                         'blobtracker_id', 'hold', 'update_date'])
+
+class Locator(Record):
+    """A Locator returned by the API.
+    """
+    __slots__ = ()
+    _fields = frozenset(['locator_id', 'user_id', 'name', 'description', 'closed',
+                         'update_date'])
+
+class User(Record):
+    """A user returned by the API.
+    """
+    __slots__ = ()
+    _fields = frozenset(['user_id', 'handle', 'name', 'avatar', 'settings', 'joined_date',
+                         'update_date'])
+    _nested_fields = frozenset(['avatar', 'settings'])
+
+class CountryStatistics(Record):
+    """A row of a user's statistics for a country returned by the API.
+    """
+    __slots__ = ()
+
+class LocalityStatistics(Record):
+    """A row of a user's statistics for a locality returned by the API.
+    """
+    __slots__ = ()
+
+_RECORD_TYPES = {
+    'listlocators': Locator,
+    'listlocatorsightings': Sighting,
+    'listresightings': Sighting,
+    'listsightinglocators': Locator,
+    'listsightings': Sighting,
+    'listusercountrystatistics': CountryStatistics,
+    'listuserlocalitystatistics': LocalityStatistics,
+    'listuserlocators': Locator,
+    'listusersightings': Sighting,
+}
+
+def iterate_records(server_url, method, opts, pool=None, prefetch=True):
+    """Invoke a List API method repeatedly, following the cursor returned
+    with each page, and return every result from every page as a Record.
+
+    The arguments are the same as for iterate_pages.
+
+    Returns:
+    A generator yielding a Sighting, Locator, CountryStatistics or
+    LocalityStatistics for each result, depending on the method.
+
+    Raises:
+    Error if the method is not a List method or an error occurs.
+    APIError if the API returns a response other than 200.
+    """
+    record_type = _RECORD_TYPES.get(method.lower(), Record)
+
+    for item in iterate_items(server_url, method, opts, pool=pool, prefetch=prefetch):
+        yield record_type.from_dict(item)
+
+def _option_string(value):
+    """Convert a number passed to a ResightingClient method to a string, as if
+    it were given on the command-line. Other values are returned unchanged.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+
+    return value
+
+class ResightingClient(object):
+    """A client for the Resighting API for use as a library.
+
+    The client holds the server url, access token, connection pool and
+    response cache so that they are reused by every call. There is one method
+    per API method, taking the API method's parameters as arguments and
+    returning the JSON decoded response. A client can be shared between
+    threads.
+
+    Identical GET calls made from several threads at the same time are
+    coalesced into a single request, and every caller receives the same
+    decoded response, which should not be modified.
+
+    Example:
+
+    with ResightingClient('https://resighting-api.appspot.com', access_token=token) as client:
+        user = client.user()
+        page = client.list_user_sightings(user['user_id'], fetch_size=10)
+    """
+    def __init__(self, server_url, access_token=None, sandbox=False, pool=None, cache=None,
+                 coalesce=True, timing_hook=None):
+        """Create a client.
+
+        Arguments:
+        server_url - The url of the server where the API is running.
+        access_token - (optional) The API access token sent with every call.
+        sandbox - (optional) If True methods that change data are invoked in
+                  sandbox mode.
+        pool - (optional) The ConnectionPool to make requests through. If not
+               specified the client creates its own.
+        cache - (optional) A ResponseCache used to answer GET requests. If not
+                specified responses are not cached.
+        coalesce - (optional) If False identical GET calls made at the same
+                   time are not coalesced.
+        timing_hook - (optional) A function called with the name of the API
+                      method and a RequestTiming once each request has been
+                      made and its response decoded, including requests that
+                      fail with an APIError.
+        """
+        self.server_url = server_url
+        self.access_token = access_token
+        self.sandbox = sandbox
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.cache = cache
+        self._single_flight = _SingleFlight() if coalesce else None
+        self.timing_hook = timing_hook
+
+        # The options every call starts from
+        self._defaults = _create_option_parser().get_default_values()
+        self._defaults.access_token = access_token
+        self._defaults.sandbox = sandbox
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the client's connections.
+        """
+        self.pool.close()
+
+    def _options(self, params):
+        """Get the options for a call from the parameters passed to a method.
+        """
+        import copy
+
+        opts = copy.copy(self._defaults)
+
+        for name, value in params.iteritems():
+            if name == 'self':
+                continue
+
+            if isinstance(value, (list, tuple)):
+                value = [_option_string(item) for item in value]
+            else:
+                value = _option_string(value)
+
+            setattr(opts, name, value)
+
+        return opts
+
+    def invoke(self, method, **params):
+        """Invoke an API method by name.
+
+        Arguments:
+        method - The name of the API method, e.g. GetUser.
+        params - The parameters of the method, named as the command-line
+                 options with underscores, e.g. user_id.
+
+        Returns:
+        The JSON decoded response.
+
+        Raises:
+        Error if an error occurs.
+        APIError if the API returns a response other than 200.
+        """
+        return self._invoke(method, params)
+
+    @property
+    def coalesced(self):
+        """The number of calls that shared the response to another call.
+        """
+        if self._single_flight is None:
+            return 0
+
+        return self._single_flight.coalesced
+
+    def _invoke(self, method, params):
+        """Invoke an API method with a dictionary of parameters.
+        """
+        if method.lower() not in methods:
+            raise Error('Unknown API method %s' % method)
+
+        request = build_request(self.server_url, method, self._options(params))
+
+        if self._single_flight is not None and request[0] == 'GET':
+            # The url identifies the call, including the access token
+            return self._single_flight.call(request[1], self._send, method, request)
+
+        return self._send(method, request)
+
+    def _send(self, method, request):
+        """Send a request and decode the response.
+        """
+        import json
+
+        timing = RequestTiming() if self.timing_hook is not None else None
+
+        response, status_code, headers = send_request(request, pool=self.pool, cache=self.cache,
+                                                      timing=timing)
+
+        if status_code != 200:
+            if timing is not None:
+                self.timing_hook(method, timing)
+
+            raise APIError(status_code, response, headers)
+
+        start = monotonic() if timing is not None else None
+
+        try:
+            decoded = json.loads(response)
+        except ValueError:
+            raise Error('The response is not valid JSON')
+
+        if timing is not None:
+            timing.record('parse', start)
+            self.timing_hook(method, timing)
+
+        return decoded
+
+    def iterate(self, method, **params):
+        """Invoke a List API method for every page of results, following the
+        cursor returned with each page.
+
+        The arguments are the same as for invoke.
+
+        Returns:
+        A generator yielding each JSON decoded result from every page.
+
+        Raises:
+        Error if the method is not a List method or an error occurs.
+        APIError if the API returns a response other than 200.
+        """
+        return iterate_items(self.server_url, method, self._options(params), pool=self.pool)
+
+    def iterate_records(self, method, **params):
+        """Invoke a List API method for every page of results, following the
+        cursor returned with each page, and return each result as a Record.
+
+        The arguments are the same as for invoke.
+
+        Returns:
+        A generator yielding a Record for each result from every page.
+
+        Raises:
+        Error if the method is not a List method or an error occurs.
+        APIError if the API returns a response other than 200.
+        """
+        return iterate_records(self.server_url, method, self._options(params), pool=self.pool)
+
+    def create_locator(self, name=None, description=None, closed=False):
+        """Invoke the CreateLocator API method.
+        """
+        return self._invoke('CreateLocator', locals())
+
+    def create_locator_sighting(self, locator_id, user_id, sighting_id):
+        """Invoke the CreateLocatorSighting API method.
+        """
+        return self._invoke('CreateLocatorSighting', {
+            'locator_id': [locator_id],
+            'user_id': user_id,
+            'sighting_id': sighting_id,
+        })
+
+    def create_sighting(self, latitude=None, longitude=None, accuracy=None, altitude=None,
+                        altitude_accuracy=None, heading=None, speed=None, tz_offset=None,
+                        description=None, blobtracker_id=None, locator_ids=None, hold=False,
+                        publish_to_facebook=False, tweet_sighting=False):
+        """Invoke the CreateSighting API method.
+        """
+        params = locals()
+        params['locator_id'] = params.pop('locator_ids')
+
+        return self._invoke('CreateSighting', params)
+
+    def get_daily_sighting(self, date=None):
+        """Invoke the GetDailySighting API method.
+        """
+        return self._invoke('GetDailySighting', locals())
+
+    def get_sighting(self, user_id, sighting_id):
+        """Invoke the GetSighting API method.
+        """
+        return self._invoke('GetSighting', locals())
+
+    def get_user(self, user_id):
+        """Invoke the GetUser API method.
+        """
+        return self._invoke('GetUser', locals())
+
+    def get_user_statistics(self, user_id):
+        """Invoke the GetUserStatistics API method.
+        """
+        return self._invoke('GetUserStatistics', locals())
+
+    def list_locators(self, cursor=None, fetch_size=None):
+        """Invoke the ListLocators API method.
+        """
+        return self._invoke('ListLocators', locals())
+
+    def list_locator_sightings(self, locator_id, list_type=None, start_date=None, end_date=None,
+                               latitude=None, longitude=None, cursor=None, fetch_size=None):
+        """Invoke the ListLocatorSightings API method.
+        """
+        params = locals()
+        params['locator_id'] = [locator_id]
+
+        return self._invoke('ListLocatorSightings', params)
+
+    def list_resightings(self, user_id, sighting_id, cursor=None, fetch_size=None):
+        """Invoke the ListResightings API method.
+        """
+        return self._invoke('ListResightings', locals())
+
+    def list_sighting_locators(self, user_id, sighting_id, cursor=None, fetch_size=None):
+        """Invoke the ListSightingLocators API method.
+        """
+        return self._invoke('ListSightingLocators', locals())
+
+    def list_sightings(self, list_type=None, start_date=None, end_date=None, latitude=None,
+                       longitude=None, cursor=None, fetch_size=None):
+        """Invoke the ListSightings API method.
+        """
+        return self._invoke('ListSightings', locals())
+
+    def list_user_country_statistics(self, user_id, cursor=None, fetch_size=None):
+        """Invoke the ListUserCountryStatistics API method.
+        """
+        return self._invoke('ListUserCountryStatistics', locals())
+
+    def list_user_locality_statistics(self, user_id, cursor=None, fetch_size=None):
+        """Invoke the ListUserLocalityStatistics API method.
+        """
+        return self._invoke('ListUserLocalityStatistics', locals())
+
+    def list_user_locators(self, user_id, cursor=None, fetch_size=None):
+        """Invoke the ListUserLocators API method.
+        """
+        return self._invoke('ListUserLocators', locals())
+
+    def list_user_sightings(self, user_id, list_type=None, start_date=None, end_date=None,
+                            latitude=None, longitude=None, cursor=None, fetch_size=None):
+        """Invoke the ListUserSightings API method.
+        """
+        return self._invoke('ListUserSightings', locals())
+
+    def meta(self):
+        """Invoke the Meta API method.
+        """
+        return self._invoke('Meta', {})
+
+    def remove_locator_sighting(self, locator_id, user_id, sighting_id):
+        """Invoke the RemoveLocatorSighting API method.
+        """
+        return self._invoke('RemoveLocatorSighting', {
+            'locator_id': [locator_id],
+            'user_id': user_id,
+            'sighting_id': sighting_id,
+        })
+
+    def resight_sighting(self, user_id, sighting_id, latitude=None, longitude=None, accuracy=None,
+                         altitude=None, altitude_accuracy=None, heading=None, speed=None,
+                         tz_offset=None, description=None, blobtracker_id=None, locator_ids=None,
+                         hold=False, publish_to_facebook=False, tweet_sighting=False):
+        """Invoke the ResightSighting API method.
+        """
+        params = locals()
+        params['locator_id'] = params.pop('locator_ids')
+
+        return self._invoke('ResightSighting', params)
+
+    def update_sighting(self, user_id, sighting_id, description=None, blobtracker_id=None,
+                        hold=None, publish_to_facebook=None, tweet_sighting=None):
+        """Invoke the UpdateSighting API method.
+        """
+        return self._invoke('UpdateSighting', locals())
+
+    def upload(self, upload_url, filename=None, mmap_upload=False):
+        """Invoke the Upload API method.
+        """
+        return self._invoke('Upload', locals())
+
+    def upload_url(self):
+        """Invoke the UploadUrl API method.
+        """
+        return self._invoke('UploadUrl', {})
+
+    def user(self):
+        """Invoke the User API method.
+        """
+        return self._invoke('User', {})
+
+class Executor(object):
+    """Runs a function over many items concurrently on a bounded pool of
+    worker threads.
+    """
+    def __init__(self, max_workers):
+        """Create an executor.
+
+        Arguments:
+        max_workers - The maximum number of items processed at the same time.
+        """
+        self.max_workers = max_workers
+
+    def map(self, fn, items, ordered=True):
+        """Call a function for each item on the worker threads.
+
+        Items are read from the iterable as workers become free, so only a
+        bounded number of items and results are held in memory at any time.
+
+        Arguments:
+        fn - The function to call with each item.
+        items - An iterable of items.
+        ordered - (optional) If True results are returned in the order of the
+                  items, otherwise as soon as each call completes.
+
+        Returns:
+        A generator yielding the return value of the function for each item.
+        If the function raises an exception it is re-raised by the generator.
+        """
+        import Queue
+
+        # Limit the number of items that have been taken from the iterable
+        # but whose results have not yet been returned
+        window = threading.Semaphore(self.max_workers * 4)
+        pending = Queue.Queue()
+        completed = Queue.Queue()
+        cancelled = threading.Event()
+
+        def produce():
+            count = 0
+
+            try:
+                for item in items:
+                    window.acquire()
+
+                    if cancelled.is_set():
+                        break
+
+                    pending.put((count, item))
+                    count += 1
+            except Exception:
+                completed.put((None, False, sys.exc_info()))
+            finally:
+                # Tell the workers and the consumer there are no more items
+                for _ in range(self.max_workers):
+                    pending.put(None)
+
+                completed.put((None, True, count))
+
+        def work():
+            while True:
+                task = pending.get()
+
+                if task is None or cancelled.is_set():
+                    return
+
+                index, item = task
+
+                try:
+                    completed.put((index, True, fn(item)))
+                except Exception:
+                    completed.put((index, False, sys.exc_info()))
+
+        producer = threading.Thread(target=_inherit_streams(produce))
+        workers = [threading.Thread(target=_inherit_streams(work)) for _ in range(self.max_workers)]
+
+        for thread in [producer] + workers:
+            thread.daemon = True
+            thread.start()
+
+        total = None
+        returned = 0
+        buffered = {}
+
+        try:
+            while total is None or returned < total:
+                index, succeeded, value = completed.get()
+
+                if index is None:
+                    if not succeeded:
+                        raise value[0], value[1], value[2]
+
+                    total = value
+                    continue
+
+                buffered[index] = (succeeded, value)
+
+                if ordered:
+                    ready = []
+
+                    while returned + len(ready) in buffered:
+                        ready.append(buffered.pop(returned + len(ready)))
+                else:
+                    ready = [buffered.pop(index)]
+
+                for succeeded, value in ready:
+                    returned += 1
+                    window.release()
+
+                    if not succeeded:
+                        raise value[0], value[1], value[2]
+
+                    yield value
+        finally:
+            cancelled.set()
+
+            # Unblock the producer if it is waiting for space in the window
+            for _ in range(self.max_workers * 4):
+                window.release()
+
+            # Wait for the workers to finish any calls in progress. The
+            # producer is not waited for as it may be blocked reading items.
+            for _ in workers:
+                pending.put(None)
+
+            for thread in workers:
+                thread.join()
+
+def _batch_string(value):
+    """Convert a scalar value from a batch file to a string as it would be
+    given on the command-line.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, bool):
+        return str(value).lower()
+
+    return str(value)
+
+# The strings accepted for a flag in a batch file or an ingested CSV file
+_BATCH_FLAG_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+
+def _batch_option_value(option, value):
+    """Convert a value from a batch file to the type optparse would produce
+    for the option.
+
+    Raises:
+    ValueError if the value is not valid for the option.
+    """
+    if value is None:
+        return None
+
+    if option.action in ('store_true', 'store_false'):
+        # JSON true or false, 1 or 0, or a string such as "false" from a CSV
+        # file, which bool would take to be true
+        if isinstance(value, basestring):
+            flag = _BATCH_FLAG_VALUES.get(value.strip().lower())
+        elif isinstance(value, (bool, int, long)) and value in (0, 1):
+            flag = bool(value)
+        else:
+            flag = None
+
+        if flag is None:
+            raise ValueError('Not a flag value: %r' % (value,))
+
+        return flag == (option.action == 'store_true')
+
+    if option.action == 'append':
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+
+        return [_batch_string(v) for v in value]
+
+    if option.type == 'int':
+        return int(value)
+    elif option.type == 'float':
+        return float(value)
+
+    return _batch_string(value)
+
+def batch_options(parser, defaults, options):
+    """Create the options for one invocation in a batch.
+
+    Arguments:
+    parser - The command-line option parser.
+    defaults - The command-line options, used for any option not specified.
+    options - A dictionary of option names, with either dashes or underscores,
+              and values.
+
+    Returns:
+    An options object suitable for passing to invoke_api.
+
+    Raises:
+    Error if an option is unknown or has an invalid value.
+    """
+    import copy
+
+    opts = copy.copy(defaults)
+
+    for name, value in (options or {}).viewitems():
+        option = parser.get_option('--%s' % name.replace('_', '-'))
+
+        if option is None or option.dest is None:
+            raise Error('Unknown option: %s' % name)
+
+        try:
+            setattr(opts, option.dest, _batch_option_value(option, value))
+        except (TypeError, ValueError):
+            raise Error('Invalid value for option: %s' % name)
+
+    return opts
+
+def _invoke_batch_line(server_url, line_number, line, parser, defaults, pool, cache):
+    """Invoke the API method described by a line of a batch.
+
+    Returns:
+    The result dictionary for the line.
+    """
+    import json
+
+    result = {'line': line_number}
+    start = time.time()
+
+    try:
+        try:
+            invocation = json.loads(line)
+        except ValueError:
+            raise Error('Invalid JSON')
+
+        if not isinstance(invocation, dict):
+            raise Error('Invalid JSON')
+
+        if 'id' in invocation:
+            result['id'] = invocation['id']
+
+        method = invocation.get('method')
+        result['method'] = method
+
+        if not isinstance(method, basestring) or method.lower() not in methods:
+            raise Error('Invalid method')
+
+        opts = batch_options(parser, defaults, invocation.get('options'))
+        timing = RequestTiming() if opts.timing else None
+
+        response, status_code, headers = invoke_api(server_url, method, opts, pool=pool, cache=cache,
+                                                     timing=timing)
+    except Error as e:
+        result['error'] = e.message
+        result['elapsed'] = time.time() - start
+        return result
+
+    result['elapsed'] = time.time() - start
+    result['status_code'] = status_code
+    parse_start = monotonic() if timing is not None else None
+
+    try:
+        result['response'] = json.loads(response)
+
+        if timing is not None:
+            timing.record('parse', parse_start)
+    except ValueError:
+        result['response'] = response
+
+    if timing is not None:
+        result['timing'] = timing.to_dict()
+
+    return result
+
+def invoke_batch(server_url, lines, parser, defaults, pool=None, executor=None, ordered=True,
+                 cache=None):
+    """Invoke the API methods described by lines of JSON.
+
+    Each line is a JSON object containing the name of the API method to invoke
+    in "method", and optionally its options in "options" and an identifier in
+    "id" that is copied to the result, e.g.
+
+    {"id": 1, "method": "GetUser", "options": {"user_id": "abc"}}
+
+    Blank lines are ignored.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    lines - An iterable of lines of JSON.
+    parser - The command-line option parser.
+    defaults - The command-line options, used for any option not specified on
+               a line.
+    pool - (optional) The ConnectionPool to make the requests through.
+    executor - (optional) An Executor used to invoke the methods concurrently.
+               If not specified the methods are invoked one at a time.
+    ordered - (optional) If False and an executor is specified then results
+              are returned as soon as each method completes rather than in the
+              order of the lines.
+    cache - (optional) A ResponseCache used to answer GET requests.
+
+    Returns:
+    A generator yielding a result dictionary for each line as soon as the API
+    method has been invoked. The result contains the line number, the method,
+    the HTTP status code, the elapsed time in seconds and the response, or an
+    error message if the method could not be invoked. If the timing option is
+    set the result also contains the time spent in each phase of the request,
+    in milliseconds, as returned by RequestTiming.to_dict.
+    """
+    numbered_lines = ((line_number, line) for line_number, line in enumerate(lines, 1) if line.strip())
+
+    def invoke(numbered_line):
+        return _invoke_batch_line(server_url, numbered_line[0], numbered_line[1], parser, defaults, pool, cache)
+
+    if executor is None:
+        return (invoke(numbered_line) for numbered_line in numbered_lines)
+
+    return executor.map(invoke, numbered_lines, ordered=ordered)
+
+# Column names accepted in CSV files besides the CreateSighting options
+_INGEST_COLUMN_ALIASES = {
+    'lat': 'latitude',
+    'lon': 'longitude',
+    'lng': 'longitude',
+    'long': 'longitude',
+    'ele': 'altitude',
+    'elevation': 'altitude',
+    'course': 'heading',
+}
+
+# Values of a CSV column for a flag option that set the flag
+_INGEST_TRUE_VALUES = frozenset(['1', 'true', 'yes', 'y'])
+
+# The GPX elements that are each ingested as a Sighting, and the child
+# elements of them that are mapped to CreateSighting options
+_GPX_POINTS = frozenset(['wpt', 'trkpt', 'rtept'])
+_GPX_OPTIONS = {
+    'ele': 'altitude',
+    'course': 'heading',
+    'speed': 'speed',
+    'desc': 'description',
+}
+
+def read_csv_sightings(f):
+    """Read the Sightings to create from a CSV file with a header row.
+
+    Columns are named as the CreateSighting options, e.g. latitude or
+    altitude-accuracy, or lat, lon or ele. Other columns and empty values are
+    ignored.
+
+    Arguments:
+    f - The CSV file, opened in binary mode.
+
+    Returns:
+    A generator yielding a dictionary of CreateSighting options for each row.
+
+    Raises:
+    Error if the file is not valid CSV.
+    """
+    import csv
+
+    encodings = dict(_SIGHTING_PARAMS)
+    reader = csv.reader(f)
+
+    try:
+        header = next(reader, [])
+        columns = []
+
+        for name in header:
+            name = name.strip().lower().replace('-', '_').replace(' ', '_')
+            name = _INGEST_COLUMN_ALIASES.get(name, name)
+            columns.append(name if name in encodings else None)
+
+        for row in reader:
+            params = {}
+
+            for name, value in zip(columns, row):
+                value = value.strip()
+
+                if name is None or not value:
+                    continue
+
+                if encodings[name] == _FLAG:
+                    value = value.lower() in _INGEST_TRUE_VALUES
+
+                params[name] = value
+
+            yield params
+    except csv.Error as e:
+        raise Error('Invalid CSV on line %d: %s' % (reader.line_num, e))
+
+def read_gpx_sightings(f):
+    """Read the Sightings to create from the waypoints, track points and route
+    points of a GPX file. The file is parsed as it is read so that large
+    tracks are not held in memory.
+
+    Arguments:
+    f - The GPX file.
+
+    Returns:
+    A generator yielding a dictionary of CreateSighting options for each
+    point.
+
+    Raises:
+    Error if the file is not valid XML.
+    """
+    import xml.etree.cElementTree as ElementTree
+
+    try:
+        for event, element in ElementTree.iterparse(f):
+            tag = element.tag.rpartition('}')[2]
+
+            if tag not in _GPX_POINTS:
+                if tag in ('trkseg', 'trk', 'rte'):
+                    element.clear()
+
+                continue
+
+            params = {}
+
+            for name in ('lat', 'lon'):
+                if element.get(name) is not None:
+                    params[_INGEST_COLUMN_ALIASES[name]] = element.get(name).strip()
+
+            for child in element:
+                option = _GPX_OPTIONS.get(child.tag.rpartition('}')[2])
+
+                if option is not None and child.text and child.text.strip():
+                    params[option] = child.text.strip()
+
+            if 'description' not in params:
+                for child in element:
+                    if child.tag.rpartition('}')[2] == 'name' and child.text and child.text.strip():
+                        params['description'] = child.text.strip()
+
+            element.clear()
+
+            yield params
+    except SyntaxError as e:
+        raise Error('Invalid GPX: %s' % e)
+
+def _ingest_key(params, occurrences):
+    """Get the key identifying a Sighting to create in an ingest journal.
+
+    The key is a hash of the Sighting's options along with the number of
+    identical Sightings before it, so that a file can be edited or added to
+    between runs without Sightings being created twice.
+
+    Arguments:
+    params - The CreateSighting options.
+    occurrences - A dictionary counting the Sightings read so far by hash.
+    """
+    import hashlib
+    import json
+
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+    occurrence = occurrences.get(digest, 0)
+    occurrences[digest] = occurrence + 1
+
+    return '%s-%d' % (digest, occurrence)
+
+def _load_ingest_journal(journal_file):
+    """Get the keys of the Sightings recorded as created in an ingest journal.
+
+    Returns:
+    A dictionary of the ids of the created Sightings by key.
+    """
+    import json
+
+    created = {}
+
+    try:
+        with open(journal_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    created[entry['key']] = entry.get('sighting_id')
+                except (ValueError, KeyError, TypeError):
+                    # A line left incomplete by a crash
+                    continue
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise Error('Cannot read the journal %s: %s' % (journal_file, e))
+
+    return created
+
+def _ingest_sighting(server_url, record, parser, defaults, pool):
+    """Create one Sighting being ingested.
+
+    Returns:
+    The result dictionary for the Sighting.
+    """
+    import json
+
+    record_number, key, params = record
+    result = {'record': record_number}
+    start = time.time()
+
+    try:
+        opts = batch_options(parser, defaults, params)
+        response, status_code, headers = invoke_api(server_url, 'CreateSighting', opts, pool=pool)
+    except Error as e:
+        result['error'] = e.message
+        result['elapsed'] = time.time() - start
+        return key, result
+
+    result['elapsed'] = time.time() - start
+    result['status_code'] = status_code
+
+    try:
+        result['response'] = json.loads(response)
+    except ValueError:
+        result['response'] = response
+
+    return key, result
+
+def ingest_sightings(server_url, filename, parser, defaults, journal_file=None, pool=None,
+                     executor=None, ordered=True):
+    """Create a Sighting for each row of a CSV file or each point of a GPX
+    file, recording the Sightings created in a journal.
+
+    Rows or points already recorded in the journal by an earlier run, which
+    may have been interrupted, are skipped so that they are not created
+    twice. The journal is kept once every Sighting has been created so that
+    running the ingest again does not create duplicates.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    filename - The name of the file. A file ending .gpx is read as GPX and
+               any other file as CSV.
+    parser - The command-line option parser.
+    defaults - The command-line options, used for any CreateSighting option
+               not in the file.
+    journal_file - (optional) The name of the journal. Defaults to the name of
+                   the file with .checkpoint added.
+    pool - (optional) The ConnectionPool to make the requests through.
+    executor - (optional) An Executor used to create Sightings concurrently.
+               If not specified they are created one at a time.
+    ordered - (optional) If False and an executor is specified then results
+              are returned as soon as each Sighting is created rather than in
+              the order of the file.
+
+    Returns:
+    A generator yielding a result dictionary for each row or point. The
+    result contains the record number, counted from 1, and either the HTTP
+    status code, the elapsed time in seconds and the response, an error
+    message if the Sighting could not be created, or skipped and the id of
+    the Sighting if the journal records it as created.
+
+    Raises:
+    Error if the file or the journal cannot be read or written.
+    """
+    import json
+
+    if journal_file is None:
+        journal_file = '%s.checkpoint' % filename
+
+    created = _load_ingest_journal(journal_file)
+
+    try:
+        f = open(filename, 'rb')
+        journal = open(journal_file, 'a')
+    except IOError as e:
+        raise Error('Cannot open %s: %s' % (e.filename, e.strerror))
+
+    if filename.lower().endswith('.gpx'):
+        sightings = read_gpx_sightings(f)
+    else:
+        sightings = read_csv_sightings(f)
+
+    occurrences = {}
+
+    def records():
+        for record_number, params in enumerate(sightings, 1):
+            yield record_number, _ingest_key(params, occurrences), params
+
+    def ingest(record):
+        record_number, key, params = record
+
+        # Skipped Sightings pass through the results like any other so that
+        # none are lost between the threads reading the file and the caller
+        if key in created:
+            return key, {'record': record_number, 'skipped': True, 'sighting_id': created[key]}
+
+        return _ingest_sighting(server_url, record, parser, defaults, pool)
+
+    if executor is None:
+        results = (ingest(record) for record in records())
+    else:
+        results = executor.map(ingest, records(), ordered=ordered)
+
+    try:
+        for key, result in results:
+            if result.get('status_code') == 200:
+                response = result['response']
+                sighting_id = response.get('sighting_id') if isinstance(response, dict) else None
+
+                # Flush each entry so it survives the process being killed
+                journal.write(json.dumps({'key': key, 'record': result['record'],
+                                          'sighting_id': sighting_id}) + '\n')
+                journal.flush()
+
+            yield result
+    finally:
+        f.close()
+        journal.close()
+
+# The tables of a database mirroring a user's Sightings. Each row keeps the
+# JSON returned by the API in data, with commonly queried fields in columns.
+_SYNC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sightings (
+    user_id TEXT NOT NULL,
+    sighting_id TEXT NOT NULL,
+    update_date TEXT,
+    latitude REAL,
+    longitude REAL,
+    altitude REAL,
+    accuracy REAL,
+    description TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, sighting_id)
+);
+CREATE TABLE IF NOT EXISTS resightings (
+    user_id TEXT NOT NULL,
+    sighting_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    resighting_user_id TEXT,
+    resighting_id TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, sighting_id, position)
+);
+CREATE TABLE IF NOT EXISTS sighting_locators (
+    user_id TEXT NOT NULL,
+    sighting_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    locator_id TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, sighting_id, position)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id TEXT PRIMARY KEY,
+    high_water_mark TEXT,
+    synced TEXT
+);
+"""
+
+def _sync_detail_defaults(parser, defaults):
+    """Create the options that the Resightings and Locators of each Sighting
+    are listed with.
+
+    They start from a clean parse rather than the command-line options, which
+    describe the listing of the Sightings, so that options such as the cursor
+    are not passed on. Only the access token and fetch size are kept.
+    """
+    opts, _ = parser.parse_args([])
+    opts.access_token = defaults.access_token
+    opts.fetch_size = defaults.fetch_size
+
+    return opts
+
+def _fetch_sighting_details(server_url, sighting, user_id, parser, detail_defaults, pool):
+    """Fetch the Resightings of a Sighting and the Locators it belongs to.
+
+    Returns:
+    A tuple containing the Sighting, the list of Resightings and the list of
+    Locators.
+    """
+    params = {'user_id': sighting.get('user_id') or user_id,
+              'sighting_id': sighting['sighting_id']}
+    opts = batch_options(parser, detail_defaults, params)
+
+    resightings = list(iterate_items(server_url, 'ListResightings', opts, pool=pool, prefetch=False))
+    locators = list(iterate_items(server_url, 'ListSightingLocators', opts, pool=pool, prefetch=False))
+
+    return sighting, resightings, locators
+
+def _store_sighting(connection, user_id, sighting, resightings, locators):
+    """Insert or replace a Sighting, its Resightings and its Locators in the
+    mirror database.
+    """
+    import json
+
+    key = (sighting.get('user_id') or user_id, sighting['sighting_id'])
+
+    connection.execute(
+        'INSERT OR REPLACE INTO sightings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        key + (sighting.get('update_date'), sighting.get('latitude'), sighting.get('longitude'),
+               sighting.get('altitude'), sighting.get('accuracy'), sighting.get('description'),
+               json.dumps(sighting)))
+
+    connection.execute('DELETE FROM resightings WHERE user_id = ? AND sighting_id = ?', key)
+    connection.executemany(
+        'INSERT INTO resightings VALUES (?, ?, ?, ?, ?, ?)',
+        (key + (position, item.get('user_id'), item.get('sighting_id'), json.dumps(item))
+         for position, item in enumerate(resightings)))
+
+    connection.execute('DELETE FROM sighting_locators WHERE user_id = ? AND sighting_id = ?', key)
+    connection.executemany(
+        'INSERT INTO sighting_locators VALUES (?, ?, ?, ?, ?)',
+        (key + (position, item.get('locator_id'), json.dumps(item))
+         for position, item in enumerate(locators)))
+
+def sync_sightings(server_url, database, user_id, parser, defaults, pool=None, executor=None):
+    """Mirror a user's Sightings, with their Resightings and the Locators they
+    belong to, into a SQLite database.
+
+    The first sync fetches every Sighting. Later syncs only fetch the
+    Sightings updated since the latest update date already mirrored, passing
+    it as the start date, along with their Resightings and Locators. The
+    database is updated in a single transaction so that an interrupted sync
+    leaves it as it was.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    database - The file name of the SQLite database, which is created if it
+               does not exist.
+    user_id - The id of the user whose Sightings are mirrored.
+    parser - The command-line option parser.
+    defaults - The command-line options, used to list the Sightings. Only
+               the access token and fetch size are used to list their
+               Resightings and Locators.
+    pool - (optional) The ConnectionPool to make the requests through.
+    executor - (optional) An Executor used to fetch the Resightings and
+               Locators of several Sightings at the same time.
+
+    Returns:
+    A dictionary containing the numbers of Sightings, Resightings and Locator
+    memberships stored and the new high-water mark.
+
+    Raises:
+    Error if an error occurs.
+    APIError if the API returns a response other than 200.
+    """
+    import datetime
+    import sqlite3
+
+    try:
+        connection = sqlite3.connect(database)
+    except sqlite3.Error as e:
+        raise Error('Cannot open the database %s: %s' % (database, e))
+
+    try:
+        connection.executescript(_SYNC_SCHEMA)
+        row = connection.execute('SELECT high_water_mark FROM sync_state WHERE user_id = ?',
+                                 (user_id,)).fetchone()
+        high_water_mark = row[0] if row is not None else None
+
+        params = {'user_id': user_id}
+
+        if high_water_mark is not None:
+            # Sightings updated at the high-water mark itself are fetched again
+            # in case others were updated at the same time
+            params['start_date'] = high_water_mark
+
+        sightings = iterate_items(server_url, 'ListUserSightings', batch_options(parser, defaults, params),
+                                  pool=pool)
+
+        detail_defaults = _sync_detail_defaults(parser, defaults)
+
+        def fetch(sighting):
+            return _fetch_sighting_details(server_url, sighting, user_id, parser, detail_defaults, pool)
+
+        if executor is None:
+            details = (fetch(sighting) for sighting in sightings)
+        else:
+            details = executor.map(fetch, sightings, ordered=False)
+
+        counts = {'sightings': 0, 'resightings': 0, 'locators': 0}
+
+        for sighting, resightings, locators in details:
+            _store_sighting(connection, user_id, sighting, resightings, locators)
+            counts['sightings'] += 1
+            counts['resightings'] += len(resightings)
+            counts['locators'] += len(locators)
+
+            update_date = sighting.get('update_date')
+
+            if update_date is not None and (high_water_mark is None or update_date > high_water_mark):
+                high_water_mark = update_date
+
+        connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                           (user_id, high_water_mark, datetime.datetime.utcnow().isoformat()))
+        connection.commit()
+    except sqlite3.Error as e:
+        connection.rollback()
+        raise Error('Cannot update the database %s: %s' % (database, e))
+    except:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    counts['high_water_mark'] = high_water_mark
+
+    return counts
+
+# The default size in degrees of the cells of a SightingIndex, about 1 km
+# north to south
+_DEFAULT_INDEX_CELL_SIZE = 0.01
+
+# The mean radius of the earth in metres
+_EARTH_RADIUS = 6371008.8
+
+def _distance(latitude1, longitude1, latitude2, longitude2):
+    """Get the great-circle distance in metres between two points given in
+    degrees.
+    """
+    import math
+
+    latitude1 = math.radians(latitude1)
+    latitude2 = math.radians(latitude2)
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2 + math.cos(latitude1) * math.cos(latitude2) *
+         math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+class SightingIndex(object):
+    """A spatial index of Sightings answering nearest and bounding box queries
+    locally.
+
+    Sightings are kept in a grid of cells of equal size in degrees. A nearest
+    query searches rings of cells outwards from the point until no unsearched
+    cell can be closer than the Sightings found. Adding a Sighting that is
+    already in the index, identified by its user and Sighting ids, replaces
+    it, so the index can be refreshed with each page of results as it
+    arrives.
+    """
+    def __init__(self, cell_size=_DEFAULT_INDEX_CELL_SIZE):
+        """Create an empty index.
+
+        Arguments:
+        cell_size - (optional) The size of the cells in degrees. Queries are
+                    fastest when cells hold a few Sightings each.
+        """
+        self.cell_size = cell_size
+        self._columns = int(round(360.0 / cell_size))
+        self._cells = {}
+        self._entries = {}
+        self._min_row = self._max_row = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cell(self, latitude, longitude):
+        """Get the row and column of the cell containing a point.
+        """
+        import math
+
+        row = int(math.floor((latitude + 90) / self.cell_size))
+        column = int(math.floor((longitude + 180) / self.cell_size)) % self._columns
+
+        return row, column
+
+    def add(self, sighting):
+        """Add a Sighting to the index, replacing any with the same ids.
+
+        Arguments:
+        sighting - The JSON decoded Sighting. Sightings without a latitude
+                   and longitude are ignored.
+
+        Returns:
+        True if the Sighting was added.
+        """
+        try:
+            latitude = float(sighting['latitude'])
+            longitude = float(sighting['longitude'])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        key = (sighting.get('user_id'), sighting.get('sighting_id'))
+        self.remove(key)
+
+        cell = self._cell(latitude, longitude)
+        entry = (latitude, longitude, sighting)
+        self._cells.setdefault(cell, []).append(entry)
+        self._entries[key] = (cell, entry)
+
+        if self._min_row is None or cell[0] < self._min_row:
+            self._min_row = cell[0]
+
+        if self._max_row is None or cell[0] > self._max_row:
+            self._max_row = cell[0]
+
+        return True
+
+    def update(self, sightings):
+        """Add Sightings to the index, e.g. from iterate_items.
+
+        Returns:
+        The number of Sightings added.
+        """
+        return sum(1 for sighting in sightings if self.add(sighting))
+
+    def remove(self, key):
+        """Remove a Sighting from the index.
+
+        Arguments:
+        key - A tuple containing the user id and the Sighting id.
+
+        Returns:
+        True if the Sighting was in the index.
+        """
+        found = self._entries.pop(key, None)
+
+        if found is None:
+            return False
+
+        cell, entry = found
+        entries = self._cells[cell]
+        entries.remove(entry)
+
+        if not entries:
+            del self._cells[cell]
+
+        return True
+
+    def _ring(self, row, column, radius):
+        """Get the cells at a Chebyshev distance from a cell.
+        """
+        if radius == 0:
+            yield row, column
+            return
+
+        columns = range(column - radius, column + radius + 1)
+
+        if len(columns) >= self._columns:
+            columns = range(self._columns)
+            sides = []
+        else:
+            sides = [column - radius, column + radius]
+
+        for ring_row in (row - radius, row + radius):
+            for ring_column in columns:
+                yield ring_row, ring_column % self._columns
+
+        for ring_row in range(row - radius + 1, row + radius):
+            for ring_column in sides:
+                yield ring_row, ring_column % self._columns
+
+    def nearest(self, latitude, longitude, k=1, max_distance=None):
+        """Find the Sightings nearest to a point.
+
+        Arguments:
+        latitude - The latitude of the point in degrees.
+        longitude - The longitude of the point in degrees.
+        k - (optional) The number of Sightings to find.
+        max_distance - (optional) The maximum distance in metres of the
+                       Sightings found.
+
+        Returns:
+        A list of up to k tuples containing the distance in metres and the
+        Sighting, nearest first.
+        """
+        import heapq
+        import math
+
+        if not self._entries or k < 1:
+            return []
+
+        row, column = self._cell(latitude, longitude)
+        found = []
+        radius = 0
+        searched = 0
+
+        def search(cell):
+            for entry_latitude, entry_longitude, sighting in self._cells.get(cell, ()):
+                distance = _distance(latitude, longitude, entry_latitude, entry_longitude)
+
+                if max_distance is not None and distance > max_distance:
+                    continue
+
+                item = (-distance, id(sighting), sighting)
+
+                if len(found) < k:
+                    heapq.heappush(found, item)
+                elif item > found[0]:
+                    heapq.heapreplace(found, item)
+
+        while True:
+            for cell in self._ring(row, column, radius):
+                search(cell)
+                searched += 1
+
+            # Every unsearched cell is at least this far away. Its points may
+            # differ in longitude alone, nearer a pole where cells are narrower.
+            near = math.radians(radius * self.cell_size)
+            pole = math.radians(min(90.0, abs(latitude) + (radius + 1) * self.cell_size))
+            bound = 2 * _EARTH_RADIUS * math.asin(math.cos(pole) * math.sin(near / 2))
+
+            if len(found) == k and -found[0][0] <= bound:
+                break
+
+            if max_distance is not None and bound > max_distance:
+                break
+
+            if searched >= len(self._cells):
+                # The Sightings are sparse around the point, so searching the
+                # remaining occupied cells is quicker than more rings
+                for cell in self._cells.keys():
+                    columns = abs(cell[1] - column)
+
+                    if max(abs(cell[0] - row), min(columns, self._columns - columns)) > radius:
+                        search(cell)
+
+                break
+
+            radius += 1
+
+        return [(-distance, sighting) for distance, _, sighting in sorted(found, reverse=True)]
+
+    def within(self, south, west, north, east):
+        """Find the Sightings within a bounding box. A box with its west edge
+        greater than its east edge crosses the 180th meridian.
+
+        Returns:
+        A list of the Sightings.
+        """
+        import math
+
+        if self._min_row is None:
+            return []
+
+        south_row = self._cell(south, west)[0]
+        north_row = self._cell(north, east)[0]
+        crosses = west > east
+
+        # Columns are counted from the west edge without wrapping at the 180th
+        # meridian, which would put an east edge of 180 before the west edge
+        west_column = int(math.floor((west + 180) / self.cell_size))
+        east_column = int(math.floor((east + 180) / self.cell_size))
+
+        if crosses:
+            east_column += self._columns
+
+        if east_column - west_column + 1 >= self._columns:
+            columns = range(self._columns)
+        else:
+            columns = [column % self._columns for column in range(west_column, east_column + 1)]
+
+        rows = range(max(south_row, self._min_row), min(north_row, self._max_row) + 1)
+
+        if not rows:
+            return []
+
+        if len(rows) * len(columns) > len(self._cells):
+            # The box covers more cells than are occupied, e.g. the whole
+            # world, so check the occupied cells instead
+            column_set = set(columns)
+            cells = [cell for cell in self._cells
+                     if rows[0] <= cell[0] <= rows[-1] and cell[1] in column_set]
+        else:
+            cells = [(row, column) for row in rows for column in columns]
+
+        found = []
+
+        for cell in cells:
+            for latitude, longitude, sighting in self._cells.get(cell, ()):
+                if not south <= latitude <= north:
+                    continue
+
+                if crosses:
+                    if west <= longitude or longitude <= east:
+                        found.append(sighting)
+                elif west <= longitude <= east:
+                    found.append(sighting)
+
+        return found
+
+def load_sighting_index(database, user_id=None, cell_size=_DEFAULT_INDEX_CELL_SIZE):
+    """Build a SightingIndex from the Sightings mirrored into a SQLite
+    database by sync_sightings.
+
+    Arguments:
+    database - The file name of the SQLite database.
+    user_id - (optional) Only index the Sightings of this user.
+    cell_size - (optional) The size of the cells of the index in degrees.
+
+    Returns:
+    A SightingIndex.
+
+    Raises:
+    Error if the database cannot be read.
+    """
+    import json
+    import sqlite3
+
+    index = SightingIndex(cell_size)
+
+    try:
+        connection = sqlite3.connect(database)
+
+        try:
+            if user_id is None:
+                rows = connection.execute('SELECT data FROM sightings')
+            else:
+                rows = connection.execute('SELECT data FROM sightings WHERE user_id = ?', (user_id,))
+
+            index.update(json.loads(data) for data, in rows)
+        finally:
             connection.close()
+    except sqlite3.Error as e:
+        raise Error('Cannot read the database %s: %s' % (database, e))
+
+    return index
+
+# The numeric fields of a Sighting exported as columns of 64-bit floats, with
+# NaN where a Sighting has no value
+_EXPORT_FLOAT_COLUMNS = ('latitude', 'longitude', 'altitude', 'accuracy', 'altitude_accuracy',
+                         'heading', 'speed')
+
+# The id fields of a Sighting exported as columns of 32-bit indexes into a
+# table of the distinct ids, named by the second item
+_EXPORT_ID_COLUMNS = (('user_id', 'user_ids'), ('sighting_id', 'sighting_ids'))
+
+# The number of values buffered for each column before it is written
+_EXPORT_BUFFER_SIZE = 65536
+
+# The start of every .npy file, followed by the version and the header length
+_NPY_MAGIC = '\x93NUMPY\x01\x00'
+
+def _npy_header(descr, length):
+    """Get the header of a version 1.0 .npy file holding a one dimensional
+    array. The header is padded to the same size whatever the length.
+    """
+    import struct
+
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, length)
+
+    # Leave room for the longest shape and align the data to 64 bytes
+    size = len(header) - len(str(length)) + 20 + 1
+    size += -(len(_NPY_MAGIC) + 2 + size) % 64
+    header = header.ljust(size - 1) + '\n'
+
+    return _NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+class _NpyColumn(object):
+    """Writes a column of numbers to a .npy file in batches, so that only a
+    buffer of them is held in memory. Values are appended to the values
+    array, which is written out by flush.
+    """
+    def __init__(self, filename, typecode, descr):
+        import array
+
+        self.filename = filename
+        self.length = 0
+        self.values = array.array(typecode)
+        self._descr = descr
+        self._file = open(filename, 'wb')
+        self._file.write(_npy_header(descr, 0))
+
+    def flush(self):
+        """Write the buffered values to the file.
+        """
+        # .npy files written here are little-endian
+        if sys.byteorder == 'big':
+            self.values.byteswap()
+
+        self.values.tofile(self._file)
+        self.length += len(self.values)
+        del self.values[:]
+
+    def close(self):
+        """Write the remaining values and the final length to the file.
+        """
+        self.flush()
+        self._file.seek(0)
+        self._file.write(_npy_header(self._descr, self.length))
+        self._file.close()
+
+def _write_npy_strings(filename, strings):
+    """Write a list of strings to a .npy file as fixed-width byte strings.
+    """
+    width = max([len(string) for string in strings] or [1])
+
+    with open(filename, 'wb') as f:
+        f.write(_npy_header('|S%d' % width, len(strings)))
+
+        for string in strings:
+            f.write(string.ljust(width, '\0'))
+
+def _epoch_seconds(value):
+    """Convert an ISO 8601 datetime in UTC to seconds since the epoch, or NaN
+    if it is not one.
+    """
+    import calendar
+
+    # Slicing the fields out is several times quicker than time.strptime
+    try:
+        if value[4] != '-' or value[7] != '-' or value[10] != 'T' or value[13] != ':' or value[16] != ':':
+            return float('nan')
+
+        seconds = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                   int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    except (TypeError, ValueError, IndexError):
+        return float('nan')
+
+    fraction = value[19:].rstrip('Z')
+
+    if fraction.startswith('.') and fraction[1:].isdigit():
+        seconds += float(fraction)
+
+    return float(seconds)
+
+def export_sightings(sightings, path):
+    """Write Sightings as columns of numbers to .npy files that NumPy can load
+    or memory-map, without requiring NumPy.
+
+    The columns are the latitude, longitude, altitude, accuracy,
+    altitude_accuracy, heading and speed as 64-bit floats, the update_date
+    as 64-bit float seconds since the epoch, and the user_id and sighting_id
+    as 32-bit indexes into the user_ids and sighting_ids tables of distinct
+    ids. A missing number is NaN and a missing id is -1.
+
+    Sightings are written as they are read, so only the distinct ids are
+    held in memory.
+
+    Arguments:
+    sightings - An iterable of JSON decoded Sightings, e.g. from
+                iterate_items.
+    path - A .npz file to write the columns to as one archive, or else a
+           directory, which is created if necessary, to write each column to
+           as a .npy file named after it.
+
+    Returns:
+    The number of Sightings written.
+
+    Raises:
+    Error if the files cannot be written.
+    """
+    import array
+    import shutil
+    import tempfile
+    import zipfile
+
+    archive = path.lower().endswith('.npz')
+    directory = None
+
+    try:
+        if archive:
+            directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        else:
+            directory = path
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        columns = {}
+        int_typecode = 'i' if array.array('i').itemsize == 4 else 'l'
+
+        try:
+            for name in _EXPORT_FLOAT_COLUMNS + ('update_date',):
+                columns[name] = _NpyColumn(os.path.join(directory, '%s.npy' % name), 'd', '<f8')
+
+            for name, _ in _EXPORT_ID_COLUMNS:
+                columns[name] = _NpyColumn(os.path.join(directory, '%s.npy' % name), int_typecode, '<i4')
+
+            ids = dict((name, {}) for name, _ in _EXPORT_ID_COLUMNS)
+            float_columns = [(name, columns[name].values) for name in _EXPORT_FLOAT_COLUMNS]
+            id_columns = [(name, columns[name].values, ids[name]) for name, _ in _EXPORT_ID_COLUMNS]
+            update_dates = columns['update_date'].values
+            nan = float('nan')
+            count = 0
+
+            for sighting in sightings:
+                get = sighting.get
+
+                for name, values in float_columns:
+                    value = get(name)
+
+                    try:
+                        values.append(nan if value is None else float(value))
+                    except (TypeError, ValueError):
+                        values.append(nan)
+
+                update_dates.append(_epoch_seconds(get('update_date')))
+
+                for name, values, table in id_columns:
+                    value = get(name)
+
+                    if value is None:
+                        values.append(-1)
+                        continue
+
+                    if isinstance(value, unicode):
+                        value = value.encode('utf-8')
+
+                    # Intern the id so that every Sighting with it shares one entry
+                    values.append(table.setdefault(value, len(table)))
+
+                count += 1
+
+                if count % _EXPORT_BUFFER_SIZE == 0:
+                    for column in columns.values():
+                        column.flush()
+        finally:
+            for column in columns.values():
+                column.close()
+
+        for name, table in _EXPORT_ID_COLUMNS:
+            strings = sorted(ids[name], key=ids[name].get)
+            _write_npy_strings(os.path.join(directory, '%s.npy' % table), strings)
+
+        if archive:
+            # Store the columns uncompressed so that they can be read in place
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True) as f:
+                for filename in sorted(os.listdir(directory)):
+                    f.write(os.path.join(directory, filename), filename)
+    except (IOError, OSError) as e:
+        raise Error('Cannot export to %s: %s' % (path, e))
+    finally:
+        if archive and directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return count
+
+def create_cache(opts):
+    """Create the ResponseCache named in the command-line options. Responses
+    are only cached if --cache or --cache-dir is given, since they may hold
+    private data.
+
+    Returns:
+    A ResponseCache, or None if caching is turned off.
+    """
+    if opts.no_cache or not (opts.cache or opts.cache_dir):
+        return None
+
+    return ResponseCache(opts.cache_dir or _DEFAULT_CACHE_DIR, opts.cache_size)
+
+def _command_pool(opts, pool, pool_size=None, max_per_host=None):
+    """Get the ConnectionPool to run a command through.
+
+    Returns:
+    A tuple containing the pool and True if it was created for the command
+    and should be closed once the command completes, or False if it is the
+    shared pool that was passed in.
+    """
+    if pool is not None:
+        return pool, False
+
+    pool = ConnectionPool(pool_size=pool_size or opts.pool_size,
+                          idle_timeout=opts.idle_timeout,
+                          max_requests=opts.max_requests_per_connection,
+                          max_per_host=max_per_host,
+                          rate_limiter=RateLimiter(rate=opts.rate),
+                          retries=opts.retries,
+                          retry_posts=opts.retry_posts)
+
+    return pool, True
+
+def write_response(chunks, output, f, list_method=False, timing=None):
+    """Write the body of a response in one of the output formats.
+
+    Arguments:
+    chunks - An iterable of chunks of the body.
+    output - The format: pretty, compact, ndjson or raw. Bodies that are not
+             JSON are written unchanged in every format.
+    f - The file to write to.
+    list_method - (optional) True if the body is a page of results of a List
+                  method. In ndjson format each result is written on its own
+                  line as soon as it is decoded and the other values in the
+                  page, such as the cursor, are written to stderr. Otherwise
+                  the whole body is written on one line.
+    timing - (optional) A RequestTiming to record the time taken to decode
+             the body in.
+
+    Raises:
+    Error if the body of a page of results is not valid JSON.
+    """
+    import json
+
+    if output == 'raw':
+        for chunk in chunks:
+            f.write(chunk)
+
+        return
+
+    if output == 'ndjson' and list_method:
+        chunks = iter(chunks)
+        stream = JSONItemStream(chunks)
+
+        # json.dumps creates an encoder for every call when given separators
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+
+        for item in stream:
+            f.write(encode(item) + '\n')
+
+        # Read to the end of the body so that the connection can be reused
+        for chunk in chunks:
+            pass
+
+        if stream.envelope:
+            print >> sys.stderr, 'Page: %s' % json.dumps(stream.envelope, separators=(',', ':'))
+
+        return
+
+    body = ''.join(chunks)
+    start = monotonic() if timing is not None else None
+
+    try:
+        json_response = json.loads(body)
+
+        if timing is not None:
+            timing.record('parse', start)
+    except ValueError:
+        # Not a JSON response
+        # Could be blob upload error message directly from App Engine
+        f.write(body + '\n')
+        return
+
+    if output == 'pretty':
+        f.write(json.dumps(json_response, indent=4) + '\n')
+    else:
+        f.write(json.dumps(json_response, separators=(',', ':')) + '\n')
+
+def print_transfer_sizes(pool, start=(0, 0)):
+    """Write the number of bytes of response bodies received through a
+    ConnectionPool to stderr, if any of them were compressed.
+
+    Arguments:
+    pool - The ConnectionPool.
+    start - (optional) The pool's compressed_bytes and uncompressed_bytes when
+            the command started, for a pool shared between commands.
+    """
+    compressed_bytes = pool.compressed_bytes - start[0]
+    uncompressed_bytes = pool.uncompressed_bytes - start[1]
+
+    if compressed_bytes != uncompressed_bytes:
+        print >> sys.stderr, 'Received %d bytes compressed, %d bytes uncompressed' % (
+            compressed_bytes, uncompressed_bytes)
+
+def run_batch(server_url, opts, pool=None):
+    """Invoke the API methods in the batch file named in the command-line
+    options and write one line of JSON per result to stdout.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    0 if every method returned a 200 response, -1 if any method could not be
+    invoked and -2 otherwise.
+    """
+    import json
+
+    # Keep enough idle connections for every concurrent request to reuse one
+    pool_size = max(opts.pool_size, min(opts.concurrency, opts.max_per_host or opts.concurrency))
+
+    pool, owned = _command_pool(opts, pool, pool_size=pool_size, max_per_host=opts.max_per_host)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+
+    executor = None
+
+    if opts.concurrency > 1:
+        executor = Executor(opts.concurrency)
+
+    if opts.batch == '-':
+        f = sys.stdin
+    else:
+        try:
+            f = open(opts.batch, 'r')
+        except IOError as e:
+            print >> sys.stdout, 'error: %s' % e
+            return -1
+
+    exit_code = 0
+
+    try:
+        results = invoke_batch(server_url, iter(f.readline, ''), _create_option_parser(), opts,
+                               pool=pool, executor=executor, ordered=not opts.unordered,
+                               cache=create_cache(opts))
+
+        for result in results:
+            if 'error' in result:
+                exit_code = -1
+            elif result['status_code'] != 200 and exit_code == 0:
+                exit_code = -2
+
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    finally:
+        if owned:
+            pool.close()
+
+        if f is not sys.stdin:
+            f.close()
+
+    print_transfer_sizes(pool, start)
+
+    return exit_code
+
+def run_ingest(server_url, opts, pool=None):
+    """Create a Sighting for each row or point of the file named in the
+    command-line options and write one line of JSON per result to stdout.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    0 if every Sighting was created, -1 if any could not be and -2 if any
+    request returned a response other than 200.
+    """
+    import json
+
+    pool_size = max(opts.pool_size, min(opts.concurrency, opts.max_per_host or opts.concurrency))
+
+    pool, owned = _command_pool(opts, pool, pool_size=pool_size, max_per_host=opts.max_per_host)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+
+    executor = None
+
+    if opts.concurrency > 1:
+        executor = Executor(opts.concurrency)
+
+    exit_code = 0
+    skipped = 0
+
+    try:
+        results = ingest_sightings(server_url, opts.ingest, _create_option_parser(), opts,
+                                   journal_file=opts.checkpoint_file, pool=pool,
+                                   executor=executor, ordered=not opts.unordered)
+
+        for result in results:
+            if result.get('skipped'):
+                skipped += 1
+                continue
+
+            if 'error' in result:
+                exit_code = -1
+            elif result['status_code'] != 200 and exit_code == 0:
+                exit_code = -2
+
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    except Error as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        return -1
+    finally:
+        if owned:
+            pool.close()
+
+    if skipped:
+        print >> sys.stderr, 'Skipped %d Sightings created by an earlier run' % skipped
+
+    print_transfer_sizes(pool, start)
+
+    return exit_code
+
+def run_sync(server_url, opts, pool=None):
+    """Mirror the Sightings of the user given in the command-line options into
+    the SQLite database named in them and write a JSON summary to stdout.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    0 on success, -1 if an error occurs and -2 if a response other than 200
+    is received.
+    """
+    import json
+
+    pool_size = max(opts.pool_size, min(opts.concurrency, opts.max_per_host or opts.concurrency))
+
+    pool, owned = _command_pool(opts, pool, pool_size=pool_size, max_per_host=opts.max_per_host)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+
+    executor = None
+
+    if opts.concurrency > 1:
+        executor = Executor(opts.concurrency)
+
+    try:
+        counts = sync_sightings(server_url, opts.sync, opts.user_id, _create_option_parser(), opts,
+                                pool=pool, executor=executor)
+    except APIError as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        print >> sys.stderr, e.response
+        return -2
+    except Error as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        return -1
+    finally:
+        if owned:
+            pool.close()
+
+    print json.dumps(counts)
+    print_transfer_sizes(pool, start)
+
+    return 0
+
+def run_export(server_url, method, opts, pool=None):
+    """Invoke a List API method for every page of results and export the
+    Sightings to the .npz file or directory named in the command-line
+    options.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the List API method to invoke.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    0 on success, -1 if an error occurs and -2 if a response other than 200
+    is received.
+    """
+    pool, owned = _command_pool(opts, pool)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+
+    try:
+        count = export_sightings(iterate_items(server_url, method, opts, pool=pool), opts.export)
+    except APIError as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        print >> sys.stderr, e.response
+        return -2
+    except Error as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        return -1
+    finally:
+        if owned:
+            pool.close()
+
+    print >> sys.stderr, 'Exported %d Sightings to %s' % (count, opts.export)
+    print_transfer_sizes(pool, start)
+
+    return 0
+
+def run_all_pages(server_url, method, opts, pool=None):
+    """Invoke a List API method for every page of results and write the
+    results from all the pages to stdout as a single JSON list, or one result
+    per line in ndjson output. Results are written as each page is received.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the List API method to invoke.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    0 on success, -1 if an error occurs and -2 if a response other than 200
+    is received. If an error occurs once results have been written the list
+    is closed before the error is written.
+    """
+    import json
+
+    pool, owned = _command_pool(opts, pool)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    written = False
+
+    def end_list():
+        if opts.output == 'ndjson':
+            pass
+        elif not written:
+            print '[]'
+        elif opts.output == 'compact':
+            print ']'
         else:
-            # Make a GET or a POST request
-            request = urllib2.Request(method_url, data=data)
-            
-            if content_type is not None:
-                request.add_header('Content-Type', content_type)
-            
-            f = urllib2.urlopen(request)
-            response = f.readline()
-            headers = f.info().headers 
-            f.close()
-    except urllib2.HTTPError as e:
-        status_code = e.code
-        response = e.readline()
-        headers = e.info().headers 
-        e.close()
-    except urllib2.URLError:
-        if f is not None:
-            f.close()
-        raise Error('Failed to connect to API at %s' % method_url)
-    except httplib.HTTPException:
-        if connection is not None:
-            connection.close()
-        raise Error('Failed to connect to API at %s' % method_url)
+            print '\n]'
+
+    try:
+        for item in iterate_items(server_url, method, opts, pool=pool):
+            if opts.output == 'ndjson':
+                sys.stdout.write(encode(item) + '\n')
+            elif opts.output == 'compact':
+                sys.stdout.write((',' if written else '[') + encode(item))
+            else:
+                text = json.dumps(item, indent=4)
+                sys.stdout.write((',\n' if written else '[\n') + '    ' + text.replace('\n', '\n    '))
+
+            written = True
+    except APIError as e:
+        if written:
+            end_list()
+
+        print >> sys.stderr, 'HTTP Response Code: %d' % e.status_code
+        print >> sys.stderr, 'Headers: %s' % e.headers
+        print e.response
+        return -2
+    except Error as e:
+        if written:
+            end_list()
+
+        print >> sys.stdout, 'error: %s' % e.message
+        return -1
+    finally:
+        if owned:
+            pool.close()
+
+    end_list()
+    print_transfer_sizes(pool, start)
+
+    return 0
+
+def run(server_url, method, opts, pool=None):
+    """Run the command given on the command-line and write its output to
+    stdout and stderr.
+
+    Arguments:
+    server_url - The url of the server where the API is running.
+    method - The name of the API method to invoke, or None in batch mode.
+    opts - The command-line options.
+    pool - (optional) A shared ConnectionPool to make the requests through. If
+           not specified a pool is created from the options.
+
+    Returns:
+    The exit code, as for main.
+    """
+    if method is None:
+        return run_batch(server_url, opts, pool=pool)
+
+    if opts.ingest is not None:
+        return run_ingest(server_url, opts, pool=pool)
+
+    if opts.sync is not None:
+        return run_sync(server_url, opts, pool=pool)
+
+    if opts.export is not None:
+        return run_export(server_url, method, opts, pool=pool)
+
+    if opts.all_pages:
+        return run_all_pages(server_url, method, opts, pool=pool)
+
+    import json
+
+    pool, owned = _command_pool(opts, pool)
+    start = (pool.compressed_bytes, pool.uncompressed_bytes)
+    cache = create_cache(opts)
+    timing = RequestTiming() if opts.timing and not opts.resumable else None
+    streamed = None
+
+    try:
+        if opts.resumable:
+            response, status_code, headers = invoke_resumable_upload(opts, pool=pool)
+            chunks = [response]
+        elif cache is None and opts.output in _STREAMED_OUTPUT_FORMATS:
+            # Write the body as it is read rather than once it has all arrived
+            streamed = invoke_api_stream(server_url, method, opts, pool=pool, timing=timing)
+            status_code, headers = streamed.status_code, streamed.headers
+            chunks = _read_chunks(streamed)
+        else:
+            response, status_code, headers = invoke_api(server_url, method, opts, pool=pool,
+                                                        cache=cache, timing=timing)
+            chunks = [response]
+
+        if status_code != 200:
+            print >> sys.stderr, 'HTTP Response Code: %d' % status_code
+
+        print >> sys.stderr, 'Headers: %s' % headers
+
+        # Output the response
+        write_response(chunks, opts.output, sys.stdout,
+                       list_method=status_code == 200 and method.lower() in paged_methods,
+                       timing=timing)
+
+        if timing is not None:
+            print >> sys.stderr, 'Timing: %s' % json.dumps(timing.to_dict(), sort_keys=True)
+    except Error as e:
+        print >> sys.stdout, 'error: %s' % e.message
+        return -1
+    finally:
+        # Release the connection if writing the response failed part of the way
+        # through its body
+        if streamed is not None:
+            streamed.close()
+
+        if owned:
+            pool.close()
+
+    print_transfer_sizes(pool, start)
+
+    # A completed resumable upload is answered with 201 Created
+    if 200 <= status_code < 300:
+        return 0
+    else:
+        return -2
+
+# The options whose values are file names, which the daemon resolves against
+# the working directory of the client since it runs in a different one
+_DAEMON_PATH_OPTIONS = ('batch', 'cache_dir', 'checkpoint_file', 'export', 'filename', 'ingest', 'sync')
+
+# The options configuring the ConnectionPool, which the daemon shares between
+# every command so they are given to --serve rather than to each command
+_DAEMON_POOL_OPTIONS = ('idle_timeout', 'max_per_host', 'max_requests_per_connection', 'pool_size', 'rate',
+                        'retries', 'retry_posts')
+
+# Frames exchanged with the daemon start with one of these channel characters
+# followed by the length of the payload
+_FRAME_REQUEST = 'r'
+_FRAME_STDIN = 'i'
+_FRAME_STDOUT = 'o'
+_FRAME_STDERR = 'e'
+_FRAME_EXIT = 'x'
+_FRAME_HEADER_SIZE = 5
+_DAEMON_OUTPUT_BUFFER_SIZE = 65536
+
+def _write_frame(f, channel, payload):
+    """Write a frame to the daemon socket.
+    """
+    import struct
+
+    f.write(struct.pack('!cI', channel, len(payload)) + payload)
+
+def _read_frame(f):
+    """Read a frame from the daemon socket.
+
+    Returns:
+    A tuple containing the channel and the payload of the frame, or None if
+    the connection was closed.
+
+    Raises:
+    Error if the connection was closed part of the way through a frame.
+    """
+    import struct
+
+    header = f.read(_FRAME_HEADER_SIZE)
+
+    if not header:
+        return None
+
+    if len(header) != _FRAME_HEADER_SIZE:
+        raise Error('Connection to the daemon closed in a frame header')
+
+    channel, length = struct.unpack('!cI', header)
+    payload = f.read(length)
+
+    if len(payload) != length:
+        raise Error('Connection to the daemon closed in a frame')
+
+    return channel, payload
+
+class _ThreadLocalStream(object):
+    """Stands in for sys.stdin, sys.stdout or sys.stderr in the daemon and
+    delegates to the stream set for the current thread, so that commands for
+    several clients can run at once.
+
+    Attributes are both read from and set on the current thread's stream, so
+    that state such as the softspace used by print is kept for each command.
+    """
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def set(self, stream):
+        """Set the stream for the current thread, or go back to the default
+        stream if stream is None.
+        """
+        self._local.stream = stream
+
+    def current(self):
+        """Get the stream set for the current thread, or None if it uses the
+        default stream.
+        """
+        return getattr(self._local, 'stream', None)
+
+    def _stream(self):
+        stream = self.current()
+
+        if stream is None:
+            stream = self._default
+
+        return stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._stream(), name, value)
+
+def _inherit_streams(fn):
+    """Wrap a function to be run on a new thread so that it writes to the
+    streams of the thread starting it, which in the daemon are those of the
+    command that the thread is started by.
+    """
+    streams = [(stream, stream.current()) for stream in (sys.stdin, sys.stdout, sys.stderr)
+               if isinstance(stream, _ThreadLocalStream) and stream.current() is not None]
+
+    if not streams:
+        return fn
+
+    def run(*args):
+        for stream, inherited in streams:
+            stream.set(inherited)
+
+        try:
+            return fn(*args)
+        finally:
+            for stream, _ in streams:
+                stream.set(None)
+
+    return run
+
+class _DaemonOutput(object):
+    """Buffers the output written to stdout and stderr by a command run by the
+    daemon and sends it to the client in frames, in the order it was written.
+    """
+    def __init__(self, f):
+        self._f = f
+        self._frames = []
+        self._buffered = 0
+
+    def write(self, channel, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        if self._frames and self._frames[-1][0] == channel:
+            self._frames[-1][1].append(data)
+        else:
+            self._frames.append((channel, [data]))
+
+        self._buffered += len(data)
+
+        if self._buffered >= _DAEMON_OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        for channel, data in self._frames:
+            _write_frame(self._f, channel, ''.join(data))
+
+        self._frames = []
+        self._buffered = 0
+
+class _DaemonStream(object):
+    """A file-like object standing in for stdout or stderr in a command run by
+    the daemon, writing to the command's _DaemonOutput.
+    """
+    softspace = 0
+
+    def __init__(self, output, channel):
+        self._output = output
+        self._channel = channel
+
+    def write(self, data):
+        self._output.write(self._channel, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._output.flush()
+
+    def isatty(self):
+        return False
+
+def _given_options(args, dests):
+    """Find which of a set of options are given in command-line arguments.
+
+    Returns:
+    A list of the options given, such as --rate.
+    """
+    parser = _create_option_parser()
+    parser.set_defaults(**dict.fromkeys(dests))
+    opts, _ = parser.parse_args(args)
+
+    return ['--%s' % dest.replace('_', '-') for dest in dests if getattr(opts, dest) is not None]
+
+def _resolve_paths(opts, directory):
+    """Make the file names in the options of a command run by the daemon
+    absolute, relative to the working directory of the client.
+    """
+    for dest in _DAEMON_PATH_OPTIONS:
+        value = getattr(opts, dest)
+
+        if value is None or (dest == 'batch' and value == '-'):
+            continue
+
+        setattr(opts, dest, os.path.normpath(os.path.join(directory, os.path.expanduser(value))))
+
+def _run_daemon_command(pool, f_in, f_out):
+    """Run one command received by the daemon and send its output and exit
+    code back to the client.
+
+    Arguments:
+    pool - The ConnectionPool shared by every command the daemon runs.
+    f_in - A file to read the request from.
+    f_out - A file to write the output to.
+    """
+    import StringIO
+    import traceback
+
+    try:
+        request = _read_frame(f_in)
+        stdin = _read_frame(f_in)
+    except Error:
+        return
+
+    if request is None or request[0] != _FRAME_REQUEST or stdin is None or stdin[0] != _FRAME_STDIN:
+        return
+
+    stdin = stdin[1]
+
+    # The client's working directory is followed by the arguments, separated
+    # by NUL characters, which cannot appear in them
+    args = request[1].split('\0')
+    directory = args.pop(0)
+
+    output = _DaemonOutput(f_out)
+    sys.stdin.set(StringIO.StringIO(stdin))
+    sys.stdout.set(_DaemonStream(output, _FRAME_STDOUT))
+    sys.stderr.set(_DaemonStream(output, _FRAME_STDERR))
+
+    try:
+        try:
+            server_url, method, opts = parse_command_line(args)
+            pool_options = _given_options(args, _DAEMON_POOL_OPTIONS)
+            _resolve_paths(opts, directory)
+
+            if opts.serve is not None:
+                print >> sys.stdout, 'error: The daemon cannot run --serve'
+                exit_code = -1
+            elif pool_options:
+                print >> sys.stdout, ('error: The daemon shares its connection pool between commands, give %s '
+                                      'to --serve' % ', '.join(pool_options))
+                exit_code = -1
+            else:
+                exit_code = run(server_url, method, opts, pool=pool)
+        except SystemExit as e:
+            exit_code = e.code
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+
+        if exit_code is None:
+            exit_code = 0
+        elif not isinstance(exit_code, (int, long)):
+            print >> sys.stderr, exit_code
+            exit_code = 1
+
+        output.flush()
+        _write_frame(f_out, _FRAME_EXIT, str(exit_code))
+    except (IOError, EnvironmentError):
+        # The client went away
+        pass
+    finally:
+        sys.stdin.set(None)
+        sys.stdout.set(None)
+        sys.stderr.set(None)
+
+def _remove_stale_socket(socket_path):
+    """Remove a socket file left behind by a daemon that is no longer running.
+
+    Raises:
+    Error if a daemon is still listening on the socket.
+    """
+    import socket
+
+    if not os.path.exists(socket_path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        probe.connect(socket_path)
     except socket.error:
-        if connection is not None:
-            connection.close()
-        raise Error('Failed to connect to API at %s' % method_url)
+        os.remove(socket_path)
+    else:
+        raise Error('A daemon is already listening on %s' % socket_path)
+    finally:
+        probe.close()
 
-    return response, status_code, headers
-    
-def main():
+def serve(socket_path, pool):
+    """Run as a daemon accepting commands from thin clients on a Unix socket
+    until interrupted or terminated. Connections, TLS sessions and the compiled
+    request builders stay warm between commands.
+
+    Each command is run on its own thread with its stdin, stdout and stderr
+    connected to the client, and exits with the same code it would if run
+    directly. The options configuring the pool, such as --rate, are those the
+    daemon was started with, and a command given any of them is rejected.
+
+    Arguments:
+    socket_path - The path of the Unix socket to listen on. Only the user
+                  running the daemon can connect to it.
+    pool - The ConnectionPool to make every request through.
+
+    Raises:
+    Error if the socket cannot be created.
+    """
+    import signal
+    import socket
+    import SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            _run_daemon_command(pool, self.rfile, self.wfile)
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    _remove_stale_socket(socket_path)
+    umask = os.umask(0077)
+
+    try:
+        server = Server(socket_path, Handler)
+    except socket.error as e:
+        raise Error('Cannot listen on %s: %s' % (socket_path, e))
+    finally:
+        os.umask(umask)
+
+    streams = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = [_ThreadLocalStream(stream) for stream in streams]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print >> sys.stderr, 'Serving on %s' % socket_path
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        sys.stdin, sys.stdout, sys.stderr = streams
+
+def _daemon_socket(args):
+    """Find the daemon socket to forward a command to.
+
+    Arguments:
+    args - The command-line arguments.
+
+    Returns:
+    A tuple containing the path of the socket, or None if the command should
+    be run in this process, and the arguments with any --daemon option
+    removed.
+    """
+    socket_path = os.environ.get('APICLIENT_DAEMON') or None
+    remaining = []
+    i = 0
+
+    while i < len(args):
+        arg = args[i]
+
+        if arg == '--daemon' and i + 1 < len(args):
+            socket_path = args[i + 1]
+            i += 1
+        elif arg.startswith('--daemon='):
+            socket_path = arg[len('--daemon='):]
+        elif arg == '--':
+            remaining.extend(args[i:])
+            break
+        else:
+            remaining.append(arg)
+
+        i += 1
+
+    if any(arg == '--serve' or arg.startswith('--serve=') for arg in remaining):
+        # Never forward a daemon to a daemon
+        return None, args
+
+    return socket_path, remaining
+
+def _daemon_request(args):
+    """Create the request forwarding a command to the daemon.
+
+    Returns:
+    A tuple containing the payload of the request frame, which is the working
+    directory followed by the arguments, and True if the command reads from
+    stdin.
+    """
+    opts, _ = _create_option_parser().parse_args(args)
+
+    return '\0'.join([os.getcwd()] + args), opts.batch == '-'
+
+def invoke_daemon(socket_path, args):
+    """Forward a command to a daemon started with --serve and write its output
+    to stdout and stderr.
+
+    Arguments:
+    socket_path - The path of the daemon's Unix socket.
+    args - The command-line arguments, without --daemon.
+
+    Returns:
+    The exit code of the command.
+
+    Raises:
+    Error if the daemon cannot be reached or the connection to it is lost.
+    """
+    import socket
+
+    request, reads_stdin = _daemon_request(args)
+    stdin = sys.stdin.read() if reads_stdin else ''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(socket_path)
+    except socket.error as e:
+        client.close()
+        raise Error('Cannot connect to the daemon on %s: %s' % (socket_path, e))
+
+    outputs = {_FRAME_STDOUT: sys.stdout, _FRAME_STDERR: sys.stderr}
+
+    try:
+        f = client.makefile('rwb', 0)
+        _write_frame(f, _FRAME_REQUEST, request)
+        _write_frame(f, _FRAME_STDIN, stdin)
+
+        while True:
+            frame = _read_frame(f)
+
+            if frame is None:
+                raise Error('The daemon closed the connection')
+
+            channel, payload = frame
+
+            if channel == _FRAME_EXIT:
+                return int(payload)
+
+            output = outputs.get(channel)
+
+            if output is not None:
+                output.write(payload)
+                output.flush()
+    except socket.error as e:
+        raise Error('Lost the connection to the daemon: %s' % e)
+    finally:
+        client.close()
+
+def main(args=None):
     """The main function.
+
+    If a daemon socket is given with --daemon or in the APICLIENT_DAEMON
+    environment variable the command is forwarded to the daemon rather than
+    run in this process.
+
+    Arguments:
+    args - (optional) The command-line arguments. Defaults to sys.argv[1:].
     
     Returns:
     0 on success and non-zero otherwise.
     -1 indicates a connection error or that the url for the connection
        could not be constructed from the specified command-line parameters.
-    -2 indicates that a response code other than 200 was received.
+    -2 indicates that a response code other than 2xx was received.
     2 indicates a command-line syntax error
     """
-    server_url, method, opts = parse_command_line()
+    if args is None:
+        args = sys.argv[1:]
 
-    try:
-        response, status_code, headers = invoke_api(server_url, method, opts)
-    except Error as e:
-        print >> sys.stdout, 'error: %s' % e.message
-        return -1
+    socket_path, args = _daemon_socket(args)
 
-    if status_code != 200:
-        print >> sys.stderr, 'HTTP Response Code: %d' % status_code
+    if socket_path is not None:
+        try:
+            return invoke_daemon(socket_path, args)
+        except Error as e:
+            print >> sys.stdout, 'error: %s' % e.message
+            return -1
 
-    print >> sys.stderr, 'Headers: %s' % headers
-    
-    # Output the response
-    try:
-        # Pretty-print the JSON response
-        json_response = json.loads(response)
-        print json.dumps(json_response, indent=4)
-    except ValueError:
-        # Not a JSON response
-        # Could be blob upload error message directly from App Engine
-        print response
+    server_url, method, opts = parse_command_line(args)
+
+    if opts.serve is not None:
+        pool, _ = _command_pool(opts, None, max_per_host=opts.max_per_host)
+
+        try:
+            serve(opts.serve, pool)
+        except Error as e:
+            print >> sys.stdout, 'error: %s' % e.message
+            return -1
+        finally:
+            pool.close()
 
-    if status_code == 200:
         return 0
-    else:
-        return -2
+
+    return run(server_url, method, opts)
 
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,195 @@
+"""A local stand-in for the servers apiclient.py talks to, used by the tests.
+
+Routes are added as functions taking a StandInRequest and returning a tuple
+containing the status code, a dictionary of headers and the body. A JSON
+body is gzip compressed if the request accepts it. Every request is recorded
+so that tests can check what was sent.
+
+Run it to serve a resumable upload endpoint at /upload for trying out
+--resumable by hand:
+
+    $ python stand_in_server.py 8080 &
+    $ ./apiclient.py http://127.0.0.1:8080 Upload --resumable --upload-url=http://127.0.0.1:8080/upload --filename=photo.jpg
+"""
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import json
+import re
+import StringIO
+import sys
+import threading
+import urlparse
+
+class StandInRequest(object):
+    """A request received by a StandInServer.
+
+    Attributes:
+    method - The HTTP method.
+    url - The url as requested, which is absolute for a request to a proxy.
+    path - The path of the url.
+    query - A dictionary of the query parameters, each a list of values.
+    headers - A mimetools.Message of the request headers.
+    body - The request body.
+    """
+    def __init__(self, method, url, headers, body):
+        parsed_url = urlparse.urlparse(url)
+        self.method = method
+        self.url = url
+        self.path = parsed_url.path
+        self.query = urlparse.parse_qs(parsed_url.query)
+        self.headers = headers
+        self.body = body
+
+    def param(self, name, default=None):
+        """Get the first value of a query parameter.
+        """
+        return self.query.get(name, [default])[0]
+
+def json_response(value, status_code=200, headers=None):
+    """Get the response for a route returning JSON.
+    """
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+
+    return status_code, headers, json.dumps(value)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one write rather than a line at a time, which
+    # delayed acknowledgements would hold up on a kept-alive connection
+    wbufsize = -1
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = StandInRequest(self.command, self.path, self.headers, self.rfile.read(length))
+        self.server.received.append(request)
+
+        route = self.server.route(request)
+
+        if route is None:
+            status_code, headers, body = json_response({'error': 'Not found'}, 404)
+        else:
+            status_code, headers, body = route(request)
+
+        if (headers.get('Content-Type') == 'application/json' and
+                'gzip' in (self.headers.get('Accept-Encoding') or '')):
+            compressed = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=compressed, mode='wb')
+            f.write(body)
+            f.close()
+            body = compressed.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status_code)
+
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_OPTIONS = do_CONNECT = _handle
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An HTTP server on a free local port answering requests from routes.
+
+    Use it in a with statement to serve requests in a background thread.
+
+    Attributes:
+    url - The url of the server.
+    received - A list of the StandInRequests received.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.received = []
+        self._routes = []
+        self._thread = None
+
+    def add_route(self, method, path, fn):
+        """Answer requests with an HTTP method whose path starts with a prefix.
+        Routes added later take precedence.
+        """
+        self._routes.insert(0, (method, path, fn))
+
+    def route(self, request):
+        for method, path, fn in self._routes:
+            if request.method == method and request.path.startswith(path):
+                return fn
+
+        return None
+
+    def __enter__(self):
+        # Poll for shutdown often so that each test stops its server quickly
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+# A Content-Range header of a chunk, or of a request for the upload status
+_CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+)$')
+
+class ResumableUpload(object):
+    """A route receiving resumable uploads as apiclient.resumable_upload sends
+    them.
+
+    Each chunk is a PUT with a Content-Range header. A chunk that continues
+    the bytes received so far is kept. The response is a 308 (Resume
+    Incomplete) with a Range header giving the bytes received, or once the
+    whole file has arrived a 201 (Created) with its size and MD5 as JSON. A
+    PUT of "bytes */SIZE" asks for the upload status without sending data.
+
+    Attributes:
+    uploads - A dictionary of the bytes received for each path.
+    """
+    def __init__(self):
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        match = _CONTENT_RANGE.match(request.headers.get('Content-Range') or '')
+
+        if match is None:
+            return json_response({'error': 'Invalid Content-Range'}, 400)
+
+        start, end, size = match.groups()
+        size = int(size)
+
+        with self._lock:
+            received = self.uploads.setdefault(request.path, '')
+
+            if start is not None and int(start) == len(received) and int(end) - int(start) + 1 == len(request.body):
+                received += request.body
+                self.uploads[request.path] = received
+
+        if len(received) >= size:
+            return json_response({'size': len(received), 'md5': hashlib.md5(received).hexdigest()}, 201)
+
+        headers = {}
+
+        if received:
+            headers['Range'] = 'bytes=0-%d' % (len(received) - 1)
+
+        return 308, headers, ''
+
+if __name__ == '__main__':
+    server = StandInServer(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    server.add_route('PUT', '/upload', ResumableUpload())
+    print 'Serving a resumable upload endpoint at %s/upload' % server.url
+    server.serve_forever()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Measures the cold-start time of apiclient.py and checks it against the budget
+recorded in startup_budget.json.
+
+Each case is run repeatedly in a new interpreter and the fastest run is taken,
+less the time for the interpreter to start and do nothing, so the budget
+measures the cost of apiclient.py itself rather than of the machine. The
+command-line cases run the apiclient launcher, which loads the module from
+its cached bytecode, as a user running the commands would. Running
+apiclient.py itself is also timed, for comparison, but has no budget since the
+interpreter compiles the whole script on every run.
+
+Usage: startup_benchmark.py [--runs=N] [--record]
+
+Exits with a non-zero status if any case is over budget. Use --record to write
+the current times, plus a margin, as the new budget.
+
+Licenced under the The MIT License
+
+Copyright (c) 2012 Matthew Neale
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from optparse import OptionParser
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+_LAUNCHER = os.path.join(_DIRECTORY, 'apiclient')
+_SCRIPT = os.path.join(_DIRECTORY, 'apiclient.py')
+_BUDGET_FILE = os.path.join(_DIRECTORY, 'startup_budget.json')
+
+# The margin added to the measured times when a budget is recorded, as a
+# factor and a number of milliseconds to allow for noise in the fastest cases
+_RECORD_MARGIN = 1.5
+_RECORD_SLACK = 2.0
+
+# The commands timed, by name
+_CASES = [
+    ('help', [_LAUNCHER, '--help']),
+    ('bad-method', [_LAUNCHER, 'http://127.0.0.1:9', 'NoSuchMethod']),
+    ('import', ['-c', 'import sys; sys.path.insert(0, %r); import apiclient' % _DIRECTORY]),
+]
+
+# The commands timed without a budget, by name
+_UNBUDGETED_CASES = [
+    ('script-help', [_SCRIPT, '--help']),
+    ('script-bad-method', [_SCRIPT, 'http://127.0.0.1:9', 'NoSuchMethod']),
+]
+
+def time_command(args, runs):
+    """Get the fastest time in milliseconds to run the interpreter with the
+    given arguments.
+    """
+    best = None
+
+    # Let the module's compiled bytecode be cached, as it is for users
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call([sys.executable] + args, stdout=devnull, stderr=devnull, env=env)
+            elapsed = (time.time() - start) * 1000
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+    return best
+
+def main():
+    """The main function.
+
+    Returns:
+    0 if every case is within budget and 1 otherwise.
+    """
+    parser = OptionParser(usage='%prog [--runs=N] [--record]')
+    parser.add_option('--record', action='store_true', help='Record the measured times as the budget')
+    parser.add_option('--runs', type='int', default=20, help='The number of times each case is run')
+    opts, _ = parser.parse_args()
+
+    interpreter = time_command(['-c', 'pass'], opts.runs)
+    print 'interpreter: %.1f ms' % interpreter
+
+    timings = {}
+
+    for name, args in _CASES + _UNBUDGETED_CASES:
+        timings[name] = time_command(args, opts.runs) - interpreter
+
+    if opts.record:
+        with open(_BUDGET_FILE, 'w') as f:
+            json.dump(dict((name, round(timings[name] * _RECORD_MARGIN + _RECORD_SLACK, 1)) for name, _ in _CASES),
+                      f, indent=4, sort_keys=True)
+            f.write('\n')
+
+        for name, _ in _CASES + _UNBUDGETED_CASES:
+            print '%-17s %6.1f ms' % (name, timings[name])
+
+        print 'Recorded budget in %s' % _BUDGET_FILE
+        return 0
+
+    try:
+        with open(_BUDGET_FILE, 'r') as f:
+            budget = json.load(f)
+    except (IOError, ValueError) as e:
+        print >> sys.stderr, 'error: Cannot read the budget: %s' % e
+        return 1
+
+    exit_code = 0
+
+    for name, _ in _CASES + _UNBUDGETED_CASES:
+        if name not in budget:
+            print '%-17s %6.1f ms  (no budget)' % (name, timings[name])
+            continue
+
+        over = timings[name] > budget[name]
+
+        if over:
+            exit_code = 1
+
+        print '%-17s %6.1f ms  budget %6.1f ms%s' % (name, timings[name], budget[name], '  OVER' if over else '')
+
+    return exit_code
+
+if __name__ == '__main__':
+    exit(main())
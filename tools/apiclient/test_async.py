@@ -0,0 +1,120 @@
+"""Tests of the asynchronous engine against a local stand-in server.
+"""
+
+import os
+import select
+import socket
+import time
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+def _slow_meta(request):
+    time.sleep(0.2)
+    return json_response({'name': request.param('n')})
+
+class AsyncEngineTest(unittest.TestCase):
+    def test_compressed_response(self):
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/meta', lambda request: json_response({'name': 'meta'}))
+
+            engine = apiclient.AsyncEngine()
+            results = []
+            engine.request('GET', server.url + '/api/1/meta',
+                           callback=lambda response, error: results.append((response, error)))
+            engine.run()
+            engine.close()
+
+        response, error = results[0]
+
+        self.assertIsNone(error)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, '{"name": "meta"}')
+        self.assertLess(response.compressed_bytes, 40)
+
+        # The only Accept-Encoding header is the one the engine adds
+        headers = server.received[0].headers
+        self.assertEqual(headers.getheaders('Accept-Encoding'), [apiclient._ACCEPT_ENCODING])
+
+    def test_host_event_loop(self):
+        results = []
+
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/meta', _slow_meta)
+            engine = apiclient.AsyncEngine()
+
+            for n in xrange(5):
+                engine.request('GET', '%s/api/1/meta?n=%d' % (server.url, n),
+                               callback=lambda response, error: results.append(response.body))
+
+            # step(0) returns at once although no response has arrived
+            start = time.time()
+            self.assertEqual(engine.step(0), 5)
+            self.assertLess(time.time() - start, 0.1)
+
+            while engine.pending():
+                readers, writers, errors, timeout = engine.select_args()
+                self.assertIsNotNone(timeout)
+                select.select(readers, writers, errors, timeout)
+                engine.step(0)
+
+            # Only idle connections are left, which are read from to notice
+            # the server closing them
+            readers, writers, errors, timeout = engine.select_args()
+            self.assertEqual((len(readers), writers, timeout), (5, [], None))
+            engine.close()
+
+        self.assertEqual(sorted(results), ['{"name": "%d"}' % n for n in xrange(5)])
+
+    def test_connect_tries_each_address(self):
+        # A port that nothing listens on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+
+        getaddrinfo = socket.getaddrinfo
+        results = []
+
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/meta', lambda request: json_response({'name': 'meta'}))
+            port = int(server.url.rpartition(':')[2])
+            addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', closed_port)),
+                         (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+            socket.getaddrinfo = lambda *args: list(addresses)
+
+            try:
+                engine = apiclient.AsyncEngine()
+                engine.request('GET', 'http://api.example.com:%d/api/1/meta' % port,
+                               callback=lambda response, error: results.append((response, error)))
+                engine.run()
+                engine.close()
+            finally:
+                socket.getaddrinfo = getaddrinfo
+
+        response, error = results[0]
+        self.assertIsNone(error)
+        self.assertEqual(response.body, '{"name": "meta"}')
+
+    def test_proxy_fails(self):
+        environ = os.environ.copy()
+        os.environ['http_proxy'] = 'http://127.0.0.1:3128'
+        os.environ.pop('no_proxy', None)
+        results = []
+
+        try:
+            engine = apiclient.AsyncEngine()
+            engine.request('GET', 'http://api.example.com/api/1/meta',
+                           callback=lambda response, error: results.append((response, error)))
+            engine.run()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+        response, error = results[0]
+        self.assertIsNone(response)
+        self.assertIn('through a proxy', error.message)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Tests of invoking API methods from lines of a batch file.
+"""
+
+import unittest
+import urlparse
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class BatchOptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = apiclient._create_option_parser()
+        self.defaults, _ = self.parser.parse_args([])
+
+    def _option(self, name, value):
+        opts = apiclient.batch_options(self.parser, self.defaults, {name: value})
+
+        return getattr(opts, self.parser.get_option('--' + name.replace('_', '-')).dest)
+
+    def test_flags(self):
+        for value in (True, 1, 'true', 'True', 'yes', '1', ' 1 '):
+            self.assertIs(self._option('hold', value), True)
+            self.assertIs(self._option('no-hold', value), False)
+
+        for value in (False, 0, 'false', 'FALSE', 'no', '0'):
+            self.assertIs(self._option('hold', value), False)
+            self.assertIs(self._option('no-hold', value), True)
+
+    def test_invalid_flags(self):
+        for value in ('maybe', '', 2, 0.5, [], {}):
+            with self.assertRaises(apiclient.Error) as raised:
+                self._option('hold', value)
+
+            self.assertEqual(raised.exception.message, 'Invalid value for option: hold')
+
+    def test_values(self):
+        self.assertEqual(self._option('fetch-size', 10), '10')
+        self.assertEqual(self._option('latitude', 51.5), '51.5')
+        self.assertEqual(self._option('locator_id', 7), ['7'])
+        self.assertEqual(self._option('retries', '2'), 2)
+
+        with self.assertRaises(apiclient.Error):
+            self._option('colour', 'red')
+
+class InvokeBatchTest(unittest.TestCase):
+    def test_lines(self):
+        lines = [
+            '{"id": "a", "method": "CreateSighting", "options": {"latitude": 1, "longitude": 2, "hold": "false"}}',
+            '',
+            '{"method": "CreateSighting", "options": {"latitude": 3, "longitude": 4, "hold": true}}',
+            '{"method": "CreateSighting", "options": {"hold": "perhaps"}}',
+            'not json',
+        ]
+        parser = apiclient._create_option_parser()
+        defaults, _ = parser.parse_args(['--retries=0'])
+
+        with StandInServer() as server:
+            server.add_route('POST', '/api/1/sightings', lambda request: json_response({'sighting_id': 's1'}))
+            pool = apiclient.ConnectionPool()
+
+            try:
+                results = list(apiclient.invoke_batch(server.url, lines, parser, defaults, pool=pool))
+            finally:
+                pool.close()
+
+        self.assertEqual([result['line'] for result in results], [1, 3, 4, 5])
+        self.assertEqual(results[0]['id'], 'a')
+        self.assertEqual(results[0]['response'], {'sighting_id': 's1'})
+        self.assertEqual(results[2]['error'], 'Invalid value for option: hold')
+        self.assertIn('error', results[3])
+
+        bodies = [urlparse.parse_qs(request.body) for request in server.received]
+        self.assertEqual([body.get('hold') for body in bodies], [None, ['true']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Tests of the response cache against a local stand-in server.
+"""
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class _Sighting(object):
+    """A route answering with a Sighting and its ETag, or Not Modified if the
+    request has the current ETag.
+    """
+    def __init__(self):
+        self.version = 1
+
+    def __call__(self, request):
+        etag = '"v%d"' % self.version
+
+        if request.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag, 'X-Checked': 'yes'}, ''
+
+        return json_response({'sighting_id': request.path.rpartition('/')[2], 'version': self.version},
+                             headers={'ETag': etag})
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.route = _Sighting()
+        self.server = StandInServer()
+        self.server.add_route('GET', '/api/1/sightings', self.route)
+        self.server.add_route('GET', '/api/1/meta', lambda request: json_response(
+            {'name': 'meta'}, headers={'Cache-Control': 'max-age=60'}))
+        self.server.__enter__()
+        self.pool = apiclient.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def _get(self, cache, path):
+        return cache.request(self.pool, self.server.url + path)
+
+    def test_revalidation(self):
+        cache = apiclient.ResponseCache(self.directory)
+
+        first = self._get(cache, '/api/1/sightings/user/a')
+        second = self._get(cache, '/api/1/sightings/user/a')
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual((cache.misses, cache.revalidations, cache.hits), (1, 1, 0))
+        self.assertEqual(self.server.received[1].headers.get('If-None-Match'), '"v1"')
+
+        # Headers sent with the Not Modified response replace the stored ones
+        self.assertEqual(apiclient.header_value(second.headers, 'x-checked'), 'yes')
+        stored, _ = cache.lookup(self.server.url + '/api/1/sightings/user/a')
+        self.assertEqual(apiclient.header_value(stored.headers, 'x-checked'), 'yes')
+
+        self.route.version = 2
+        third = self._get(cache, '/api/1/sightings/user/a')
+
+        self.assertIn('"version": 2', third.body)
+        self.assertEqual(cache.misses, 2)
+
+    def test_max_age(self):
+        cache = apiclient.ResponseCache(self.directory)
+
+        self._get(cache, '/api/1/meta?b=2&a=1')
+        response = self._get(cache, '/api/1/meta?a=1&b=2')
+
+        self.assertEqual(response.body, '{"name": "meta"}')
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_stored_headers_describe_decompressed_body(self):
+        cache = apiclient.ResponseCache(self.directory)
+
+        response = self._get(cache, '/api/1/sightings/user/a')
+        stored, _ = cache.lookup(self.server.url + '/api/1/sightings/user/a')
+
+        # The stand-in server compresses the response
+        self.assertEqual(apiclient.header_value(response.headers, 'content-encoding'), 'gzip')
+        self.assertIsNone(apiclient.header_value(stored.headers, 'content-encoding'))
+        self.assertEqual(apiclient.header_value(stored.headers, 'content-length'), str(len(stored.body)))
+        self.assertEqual(stored.body, response.body)
+
+    def test_eviction(self):
+        cache = apiclient.ResponseCache(self.directory, max_size=2000)
+        scans = []
+        evict = cache._evict
+
+        def counting_evict(max_size):
+            scans.append(max_size)
+            return evict(max_size)
+
+        cache._evict = counting_evict
+
+        for sighting in xrange(40):
+            self._get(cache, '/api/1/sightings/user/%d' % sighting)
+
+            # Keep the first response recently used
+            cache.lookup(self.server.url + '/api/1/sightings/user/0')
+
+            size = sum(os.path.getsize(os.path.join(self.directory, name))
+                       for name in os.listdir(self.directory))
+            self.assertLessEqual(size, 2000)
+
+        # The directory is only read when the cache grows past its size
+        self.assertLess(len(scans), 20)
+        self.assertIsNotNone(cache.lookup(self.server.url + '/api/1/sightings/user/0')[0])
+        self.assertIsNone(cache.lookup(self.server.url + '/api/1/sightings/user/1')[0])
+        self.assertIsNotNone(cache.lookup(self.server.url + '/api/1/sightings/user/39')[0])
+
+class CreateCacheTest(unittest.TestCase):
+    def _cache(self, args):
+        opts, _ = apiclient._create_option_parser().parse_args(args)
+
+        return apiclient.create_cache(opts)
+
+    def test_off_by_default(self):
+        self.assertIsNone(self._cache([]))
+        self.assertIsNone(self._cache(['--cache', '--no-cache']))
+
+    def test_turned_on(self):
+        self.assertEqual(self._cache(['--cache']).directory, apiclient._DEFAULT_CACHE_DIR)
+        self.assertEqual(self._cache(['--cache-dir=/tmp/responses']).directory, '/tmp/responses')
+        self.assertEqual(self._cache(['--cache', '--cache-size=10']).max_size, 10)
+
+    def test_command_line(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            with StandInServer() as server:
+                server.add_route('GET', '/api/1/meta', lambda request: json_response(
+                    {'name': 'meta'}, headers={'Cache-Control': 'max-age=60'}))
+                stdout, stderr = sys.stdout, sys.stderr
+                sys.stdout = sys.stderr = StringIO.StringIO()
+
+                try:
+                    for args in ([], [], ['--cache-dir=' + directory], ['--cache-dir=' + directory]):
+                        self.assertEqual(apiclient.main([server.url, 'Meta'] + args), 0)
+                finally:
+                    sys.stdout, sys.stderr = stdout, stderr
+
+            # Only the cached response is answered without a request
+            self.assertEqual(len(server.received), 3)
+            self.assertEqual(len(os.listdir(directory)), 1)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+"""Tests of ResightingClient against a local stand-in server.
+"""
+
+import threading
+import time
+import unittest
+import urlparse
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class ResightingClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.add_route('POST', '/api/1/sightings', lambda request: json_response({'sighting_id': 's1'}))
+        self.server.add_route('GET', '/api/1/locators', lambda request: json_response({'results': []}))
+        self.server.__enter__()
+        self.client = apiclient.ResightingClient(self.server.url, cache=None)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.__exit__(None, None, None)
+
+    def test_numbers_as_options(self):
+        self.client.create_sighting(51.5, -1, accuracy=10L, locator_ids=[1, 2], hold=True)
+
+        params = urlparse.parse_qs(self.server.received[0].body)
+        self.assertEqual(params['latitude'], ['51.5'])
+        self.assertEqual(params['longitude'], ['-1'])
+        self.assertEqual(params['accuracy'], ['10'])
+        self.assertEqual(params['locator_id'], ['1', '2'])
+
+    def test_tuple_of_numbers(self):
+        self.client.invoke('ListLocatorSightings', locator_id=(7,), fetch_size=5)
+
+        request = self.server.received[0]
+        self.assertEqual(request.path, '/api/1/locators/7/sightings')
+        self.assertEqual(request.param('fetch_size'), '5')
+
+def _wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+
+        time.sleep(0.005)
+
+class SingleFlightTest(unittest.TestCase):
+    def test_calls_with_same_key_share_result(self):
+        single_flight = apiclient._SingleFlight()
+        gate = threading.Event()
+        calls = []
+        results = []
+
+        def fetch(key):
+            calls.append(key)
+            gate.wait()
+            return {'key': key}
+
+        def call(key):
+            results.append(single_flight.call(key, fetch, key))
+
+        threads = [threading.Thread(target=call, args=(key,)) for key in ['a'] * 4 + ['b']]
+
+        for thread in threads:
+            thread.start()
+
+        _wait_until(lambda: single_flight.coalesced == 3 and len(calls) == 2)
+        gate.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), ['a', 'b'])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(id(result) for result in results if result['key'] == 'a')), 1)
+
+        # A call made once the first has finished is made again
+        self.assertEqual(single_flight.call('a', fetch, 'a'), {'key': 'a'})
+        self.assertEqual(calls.count('a'), 2)
+
+    def test_exception_shared(self):
+        single_flight = apiclient._SingleFlight()
+        gate = threading.Event()
+        errors = []
+
+        def fail():
+            gate.wait()
+            raise apiclient.Error('Unavailable')
+
+        def call():
+            try:
+                single_flight.call('a', fail)
+            except apiclient.Error as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+
+        for thread in threads:
+            thread.start()
+
+        _wait_until(lambda: single_flight.coalesced == 2)
+        gate.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(set(id(error) for error in errors)), 1)
+
+class CoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.gate = threading.Event()
+        self.server = StandInServer()
+        self.server.add_route('GET', '/api/1/users', self._user)
+        self.server.add_route('POST', '/api/1/sightings', lambda request: json_response({'sighting_id': 's1'}))
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.gate.set()
+        self.server.__exit__(None, None, None)
+
+    def _user(self, request):
+        self.gate.wait()
+        return json_response({'user_id': request.path.rpartition('/')[2]})
+
+    def _concurrently(self, client, fn, count):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn(client))) for _ in range(count)]
+
+        for thread in threads:
+            thread.start()
+
+        return threads, results
+
+    def test_identical_gets_coalesced(self):
+        client = apiclient.ResightingClient(self.server.url, cache=None)
+
+        try:
+            threads, results = self._concurrently(client, lambda client: client.get_user('u1'), 5)
+            _wait_until(lambda: client.coalesced == 4)
+            self.gate.set()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            client.close()
+
+        self.assertEqual(len(self.server.received), 1)
+        self.assertEqual(results, [{'user_id': 'u1'}] * 5)
+
+    def test_posts_and_uncoalesced_clients_send_every_call(self):
+        self.gate.set()
+
+        for coalesce, fn in ((True, lambda client: client.create_sighting(51.5, -1)),
+                             (False, lambda client: client.get_user('u1'))):
+            del self.server.received[:]
+            client = apiclient.ResightingClient(self.server.url, cache=None, coalesce=coalesce)
+
+            try:
+                threads, _ = self._concurrently(client, fn, 3)
+
+                for thread in threads:
+                    thread.join()
+            finally:
+                client.close()
+
+            self.assertEqual(len(self.server.received), 3)
+            self.assertEqual(client.coalesced, 0)
+
+if __name__ == '__main__':
+    unittest.main()
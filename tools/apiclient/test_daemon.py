@@ -0,0 +1,169 @@
+"""Tests of running commands in the daemon.
+"""
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+def _frames(data):
+    f = StringIO.StringIO(data)
+    frames = []
+
+    while True:
+        frame = apiclient._read_frame(f)
+
+        if frame is None:
+            return frames
+
+        frames.append(frame)
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.add_route('GET', '/api/1/meta', lambda request: json_response(
+            {'name': 'meta'}, headers={'Cache-Control': 'max-age=60'}))
+        self.server.__enter__()
+        self.pool = apiclient.ConnectionPool()
+
+        self.streams = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = [apiclient._ThreadLocalStream(stream) for stream in self.streams]
+
+    def tearDown(self):
+        sys.stdin, sys.stdout, sys.stderr = self.streams
+        self.pool.close()
+        self.server.__exit__(None, None, None)
+
+    def _run(self, args, directory=None):
+        """Run a command as the daemon would for a client running in a
+        directory, by default the current one.
+
+        Returns:
+        The frames sent to the client.
+        """
+        cwd = os.getcwd()
+
+        if directory is not None:
+            os.chdir(directory)
+
+        try:
+            request, _ = apiclient._daemon_request(args)
+        finally:
+            os.chdir(cwd)
+
+        f_in = StringIO.StringIO()
+        apiclient._write_frame(f_in, apiclient._FRAME_REQUEST, request)
+        apiclient._write_frame(f_in, apiclient._FRAME_STDIN, '')
+        f_in.seek(0)
+        f_out = StringIO.StringIO()
+
+        apiclient._run_daemon_command(self.pool, f_in, f_out)
+
+        return _frames(f_out.getvalue())
+
+    def test_output_order(self):
+        f = StringIO.StringIO()
+        output = apiclient._DaemonOutput(f)
+        stdout = apiclient._DaemonStream(output, apiclient._FRAME_STDOUT)
+        stderr = apiclient._DaemonStream(output, apiclient._FRAME_STDERR)
+
+        print >> stdout, 'one'
+        print >> stdout, 'two'
+        print >> stderr, 'three'
+        print >> stdout, 'four'
+        stdout.flush()
+
+        self.assertEqual(_frames(f.getvalue()), [('o', 'one\ntwo\n'), ('e', 'three\n'), ('o', 'four\n')])
+
+    def test_command(self):
+        frames = self._run([self.server.url, 'Meta', '--no-cache', '--output=compact', '--timing'])
+
+        # The headers are written to stderr before the response and the timing
+        # after it
+        self.assertEqual([channel for channel, _ in frames], ['e', 'o', 'e', 'x'])
+        self.assertTrue(frames[0][1].startswith('Headers: '))
+        self.assertEqual(frames[1][1], '{"name":"meta"}\n')
+        self.assertTrue(frames[2][1].startswith('Timing: '))
+        self.assertEqual(frames[3][1], '0')
+
+    def test_pool_options_rejected(self):
+        frames = self._run([self.server.url, 'Meta', '--no-cache', '--rate=5', '--retri=1'])
+
+        self.assertEqual(frames, [('o', 'error: The daemon shares its connection pool between commands, '
+                                        'give --rate, --retries to --serve\n'), ('x', '-1')])
+        self.assertEqual(self.server.received, [])
+
+    def test_relative_paths(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            # Abbreviated options are resolved as optparse resolves them
+            frames = self._run([self.server.url, 'Meta', '--cache-d=responses'], directory)
+
+            self.assertEqual(frames[-1], ('x', '0'))
+            self.assertEqual(os.listdir(directory), ['responses'])
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertTrue(apiclient._daemon_request(['--bat', '-', self.server.url])[1])
+        self.assertFalse(apiclient._daemon_request(['--bat', 'batch.jsonl', self.server.url])[1])
+
+class ThreadLocalStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.default = StringIO.StringIO()
+        self.stdout = sys.stdout
+        sys.stdout = apiclient._ThreadLocalStream(self.default)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def _in_thread(self, fn):
+        thread = threading.Thread(target=fn)
+        thread.start()
+        thread.join()
+
+    def test_softspace_kept_for_each_thread(self):
+        first, second = StringIO.StringIO(), StringIO.StringIO()
+
+        def write_second():
+            sys.stdout.set(second)
+            print 'two'
+
+        sys.stdout.set(first)
+        print 'one',
+        self._in_thread(write_second)
+        print 'three'
+        sys.stdout.set(None)
+
+        self.assertEqual(first.getvalue(), 'one three\n')
+        self.assertEqual(second.getvalue(), 'two\n')
+
+    def test_threads_started_by_command(self):
+        command = StringIO.StringIO()
+
+        def write(item):
+            sys.stdout.write('%s\n' % item)
+            return item
+
+        sys.stdout.set(command)
+
+        try:
+            apiclient._Background(write, 'background').result()
+            self.assertEqual(list(apiclient.Executor(2).map(write, ['a', 'b'])), ['a', 'b'])
+        finally:
+            sys.stdout.set(None)
+
+        # Threads started outside of a command use the default stream
+        self._in_thread(lambda: write('default'))
+
+        self.assertEqual(sorted(command.getvalue().splitlines()), ['a', 'b', 'background'])
+        self.assertEqual(self.default.getvalue(), 'default\n')
+
+if __name__ == '__main__':
+    unittest.main()
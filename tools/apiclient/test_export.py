@@ -0,0 +1,163 @@
+"""Tests of exporting Sightings as .npy columns, read back without NumPy.
+"""
+
+import ast
+import math
+import os
+import shutil
+import StringIO
+import struct
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+_SIGHTINGS = [
+    {'sighting_id': 's1', 'user_id': 'u1', 'latitude': 51.5, 'longitude': -0.125, 'altitude': 12,
+     'accuracy': 5.0, 'altitude_accuracy': 3, 'heading': 90.0, 'speed': 1.5,
+     'update_date': '2012-04-26T15:47:51.250000Z'},
+    {'sighting_id': u's2\xe9', 'user_id': 'u2', 'latitude': '48.8', 'longitude': 2.35,
+     'update_date': '2012-04-27T00:00:00Z'},
+    {'sighting_id': 's3', 'user_id': 'u1', 'latitude': 'north', 'longitude': None,
+     'update_date': 'yesterday'},
+    {'latitude': -33.9},
+]
+
+_FLOAT_COLUMNS = ('latitude', 'longitude', 'altitude', 'accuracy', 'altitude_accuracy', 'heading', 'speed',
+                  'update_date')
+
+def _load_npy(data):
+    """Read a one dimensional array from the contents of a .npy file.
+
+    Returns:
+    A tuple containing the dtype descr and a list of the values.
+    """
+    assert data[:8] == '\x93NUMPY\x01\x00'
+    header_length, = struct.unpack('<H', data[8:10])
+    header = ast.literal_eval(data[10:10 + header_length])
+    offset = 10 + header_length
+    descr = header['descr']
+    length, = header['shape']
+
+    assert offset % 64 == 0
+    assert header['fortran_order'] is False
+
+    width = int(descr[2:])
+    assert len(data) == offset + length * width
+
+    if descr == '<f8':
+        values = struct.unpack('<%dd' % length, data[offset:])
+    elif descr == '<i4':
+        values = struct.unpack('<%di' % length, data[offset:])
+    else:
+        assert descr.startswith('|S')
+        values = [data[offset + i * width:offset + (i + 1) * width].rstrip('\0') for i in xrange(length)]
+
+    return descr, list(values)
+
+def _nan_safe(values):
+    return ['nan' if math.isnan(value) else value for value in values]
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_columns(self, files):
+        self.assertEqual(sorted(files), sorted(['%s.npy' % name for name in _FLOAT_COLUMNS] +
+                                               ['user_id.npy', 'sighting_id.npy', 'user_ids.npy',
+                                                'sighting_ids.npy']))
+
+        columns = dict((name[:-4], _load_npy(data)) for name, data in files.iteritems())
+
+        for name in _FLOAT_COLUMNS:
+            self.assertEqual(columns[name][0], '<f8')
+
+        self.assertEqual(_nan_safe(columns['latitude'][1]), [51.5, 48.8, 'nan', -33.9])
+        self.assertEqual(_nan_safe(columns['longitude'][1]), [-0.125, 2.35, 'nan', 'nan'])
+        self.assertEqual(_nan_safe(columns['altitude'][1]), [12.0, 'nan', 'nan', 'nan'])
+        self.assertEqual(_nan_safe(columns['speed'][1]), [1.5, 'nan', 'nan', 'nan'])
+        self.assertEqual(_nan_safe(columns['update_date'][1]), [1335455271.25, 1335484800.0, 'nan', 'nan'])
+
+        self.assertEqual(columns['user_id'], ('<i4', [0, 1, 0, -1]))
+        self.assertEqual(columns['sighting_id'], ('<i4', [0, 1, 2, -1]))
+        self.assertEqual(columns['user_ids'], ('|S2', ['u1', 'u2']))
+        self.assertEqual(columns['sighting_ids'], ('|S4', ['s1', 's2\xc3\xa9', 's3']))
+
+    def _read_directory(self, directory):
+        files = {}
+
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[name] = f.read()
+
+        return files
+
+    def test_directory(self):
+        path = os.path.join(self.directory, 'sightings')
+
+        self.assertEqual(apiclient.export_sightings(iter(_SIGHTINGS), path), 4)
+        self._check_columns(self._read_directory(path))
+
+    def test_archive(self):
+        path = os.path.join(self.directory, 'sightings.npz')
+
+        self.assertEqual(apiclient.export_sightings(iter(_SIGHTINGS), path), 4)
+
+        # The columns are stored uncompressed and nothing else is left behind
+        with zipfile.ZipFile(path) as f:
+            self.assertEqual(set(info.compress_type for info in f.infolist()), set([zipfile.ZIP_STORED]))
+            self._check_columns(dict((name, f.read(name)) for name in f.namelist()))
+
+        self.assertEqual(os.listdir(self.directory), ['sightings.npz'])
+
+    def test_columns_written_in_batches(self):
+        buffer_size = apiclient._EXPORT_BUFFER_SIZE
+        apiclient._EXPORT_BUFFER_SIZE = 3
+
+        try:
+            path = os.path.join(self.directory, 'sightings')
+            apiclient.export_sightings(iter(_SIGHTINGS), path)
+        finally:
+            apiclient._EXPORT_BUFFER_SIZE = buffer_size
+
+        self._check_columns(self._read_directory(path))
+
+    def test_no_sightings(self):
+        path = os.path.join(self.directory, 'sightings')
+
+        self.assertEqual(apiclient.export_sightings([], path), 0)
+
+        files = self._read_directory(path)
+        self.assertEqual(_load_npy(files['latitude.npy']), ('<f8', []))
+        self.assertEqual(_load_npy(files['user_ids.npy']), ('|S1', []))
+
+    def test_command_line(self):
+        path = os.path.join(self.directory, 'sightings')
+
+        def pages(request):
+            if request.param('cursor') is None:
+                return json_response({'sightings': _SIGHTINGS[:2], 'cursor': '2'})
+
+            return json_response({'sightings': _SIGHTINGS[2:]})
+
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/sightings', pages)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = StringIO.StringIO()
+
+            try:
+                exit_code = apiclient.main([server.url, 'ListSightings', '--no-cache', '--export=' + path])
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+        self.assertEqual(exit_code, 0)
+        self._check_columns(self._read_directory(path))
+
+if __name__ == '__main__':
+    unittest.main()
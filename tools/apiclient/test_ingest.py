@@ -0,0 +1,107 @@
+"""Tests of resuming an ingest from its journal.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urlparse
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class _CreateSighting(object):
+    """A CreateSighting route failing for the latitudes given.
+    """
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.latitudes = []
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        latitude = float(urlparse.parse_qs(request.body)['latitude'][0])
+
+        with self._lock:
+            self.latitudes.append(latitude)
+
+        if latitude in self.failing:
+            return json_response({'error': 'Unavailable'}, 503)
+
+        return json_response({'sighting_id': 'sighting-%g' % latitude, 'latitude': latitude})
+
+class IngestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'survey.csv')
+
+        with open(self.filename, 'wb') as f:
+            f.write('lat,lon\n')
+
+            for row in xrange(200):
+                f.write('%d,%d\n' % (row % 90, row % 180))
+
+        self.parser = apiclient._create_option_parser()
+        self.defaults, _ = self.parser.parse_args(['--retries=0'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _ingest(self, route, executor=None):
+        with StandInServer() as server:
+            server.add_route('POST', '/api/1/sightings', route)
+
+            pool = apiclient.ConnectionPool()
+
+            try:
+                return list(apiclient.ingest_sightings(server.url, self.filename, self.parser, self.defaults,
+                                                       pool=pool, executor=executor))
+            finally:
+                pool.close()
+
+    def _check_resume(self, executor):
+        # The first run fails for three latitudes, each used by two or three rows
+        results = self._ingest(_CreateSighting(failing=(5, 50, 89)), executor)
+
+        self.assertEqual([result['record'] for result in results], range(1, 201))
+        failed = [result['record'] for result in results if result['status_code'] != 200]
+        self.assertEqual(failed, [6, 51, 90, 96, 141, 180, 186])
+
+        route = _CreateSighting()
+        results = self._ingest(route, executor)
+
+        # Only the failed rows are sent again and every other row is reported
+        # as skipped, in the order of the file
+        self.assertEqual(sorted(route.latitudes), [5, 5, 5, 50, 50, 89, 89])
+        self.assertEqual([result['record'] for result in results], range(1, 201))
+        self.assertEqual([result['record'] for result in results if not result.get('skipped')], failed)
+        self.assertEqual(results[0]['sighting_id'], 'sighting-0')
+
+        route = _CreateSighting()
+        results = self._ingest(route, executor)
+
+        self.assertEqual(route.latitudes, [])
+        self.assertTrue(all(result['skipped'] for result in results))
+        self.assertEqual(len(results), 200)
+
+    def test_resume(self):
+        self._check_resume(None)
+
+    def test_resume_concurrently(self):
+        self._check_resume(apiclient.Executor(8))
+
+    def test_rows_added_after_interruption(self):
+        self._ingest(_CreateSighting())
+
+        with open(self.filename, 'ab') as f:
+            f.write('0,0\n1,2\n')
+
+        route = _CreateSighting()
+        results = self._ingest(route, apiclient.Executor(4))
+
+        # Row 201 repeats row 1, so only its third occurrence is new
+        self.assertEqual(sorted(route.latitudes), [0, 1])
+        self.assertEqual([result['record'] for result in results if not result.get('skipped')], [201, 202])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Tests of decoding the results of List methods incrementally with
+JSONItemStream as the body of a response is read.
+"""
+
+import json
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+_PAGE = ('{"cursor": "c1", "sightings": [{"sighting_id": "s0", "tags": ["a]", "\\"b\\""]}, '
+         '{"sighting_id": "s1", "altitude": 2.5e3}, 12345, [], {}], "more": true}')
+
+class _Chunks(object):
+    """Splits a body into chunks, counting how many have been read.
+    """
+    def __init__(self, body, size):
+        self.chunks = [body[i:i + size] for i in xrange(0, len(body), size)]
+        self.read = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+class JSONItemStreamTest(unittest.TestCase):
+    def test_every_split(self):
+        expected = json.loads(_PAGE)
+
+        for split in xrange(len(_PAGE) + 1):
+            stream = apiclient.JSONItemStream([_PAGE[:split], _PAGE[split:]])
+
+            self.assertEqual(list(stream), expected['sightings'], split)
+            self.assertEqual(stream.envelope, {'cursor': 'c1', 'more': True})
+            self.assertTrue(stream.has_items)
+
+    def test_items_returned_as_decoded(self):
+        chunks = _Chunks(_PAGE, 8)
+        stream = iter(apiclient.JSONItemStream(chunks))
+
+        self.assertEqual(next(stream)['sighting_id'], 's0')
+
+        # Only the chunks up to the end of the first result have been read
+        end = _PAGE.index('}, {') + 1
+        self.assertLessEqual(chunks.read, end // 8 + 1)
+
+        list(stream)
+        self.assertEqual(chunks.read, len(chunks.chunks))
+
+    def test_list_body(self):
+        stream = apiclient.JSONItemStream(['[1, ', '{"a": 2}', ' ]'])
+
+        self.assertEqual(list(stream), [1, {'a': 2}])
+        self.assertEqual(stream.envelope, {})
+
+    def test_no_results(self):
+        for body in ('[]', ' [ ] ', '{}', '{"sightings": [], "cursor": "c"}'):
+            stream = apiclient.JSONItemStream([body])
+
+            self.assertEqual(list(stream), [])
+            self.assertFalse(stream.has_items)
+
+    def test_envelope_only(self):
+        stream = apiclient.JSONItemStream(_Chunks(_PAGE, 5), decode_items=False)
+
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.envelope, {'cursor': 'c1', 'more': True})
+        self.assertTrue(stream.has_items)
+
+        stream = apiclient.JSONItemStream(['{"sightings": [ ], "cursor": "c"}'], decode_items=False)
+        list(stream)
+        self.assertFalse(stream.has_items)
+
+    def test_invalid(self):
+        for body in ('', '{"sightings": [1, 2', '{"sightings": [1 2]}', '"text"', '{"a" 1}', '[1, oops]'):
+            with self.assertRaises(apiclient.Error):
+                list(apiclient.JSONItemStream([body]))
+
+    def test_streamed_response(self):
+        sightings = [{'sighting_id': 's%d' % i, 'latitude': i / 3.0} for i in xrange(200)]
+        pool = apiclient.ConnectionPool()
+
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/sightings', lambda request: json_response(
+                {'sightings': sightings, 'cursor': 'next'}))
+
+            # The body is compressed and decompressed as it is read
+            response = pool.open('GET', server.url + '/api/1/sightings')
+            stream = apiclient.JSONItemStream(response.iter_chunks(100))
+
+            self.assertEqual(list(stream), sightings)
+            self.assertEqual(stream.envelope, {'cursor': 'next'})
+            self.assertLess(response.compressed_bytes, response.uncompressed_bytes)
+            pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+"""Tests of following the cursors of List methods against a local stand-in
+server.
+"""
+
+import json
+import StringIO
+import sys
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class _Pages(object):
+    """A List method route returning Sightings a page at a time, failing for
+    the page starting at a position if given.
+    """
+    def __init__(self, count, failing=None):
+        self.sightings = [{'sighting_id': 's%d' % position, 'latitude': position} for position in xrange(count)]
+        self.failing = failing
+
+    def __call__(self, request):
+        position = int(request.param('cursor', '0'))
+        fetch_size = int(request.param('fetch_size', '20'))
+
+        if position == self.failing:
+            return json_response({'error': 'Unavailable'}, 503)
+
+        page = {'sightings': self.sightings[position:position + fetch_size]}
+
+        if position + fetch_size < len(self.sightings):
+            page['cursor'] = str(position + fetch_size)
+
+        return json_response(page)
+
+class PaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.__enter__()
+        self.pool = apiclient.ConnectionPool()
+        self.opts, _ = apiclient._create_option_parser().parse_args(['--fetch-size=3', '--retries=0'])
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.__exit__(None, None, None)
+
+    def _cursors(self):
+        return [request.param('cursor') for request in self.server.received]
+
+    def test_pages(self):
+        route = _Pages(8)
+        self.server.add_route('GET', '/api/1/sightings', route)
+
+        for prefetch in (True, False):
+            del self.server.received[:]
+            pages = list(apiclient.iterate_pages(self.server.url, 'ListSightings', self.opts, pool=self.pool,
+                                                 prefetch=prefetch))
+
+            self.assertEqual([page['sightings'] for page in pages],
+                             [route.sightings[0:3], route.sightings[3:6], route.sightings[6:8]])
+            self.assertEqual(self._cursors(), [None, '3', '6'])
+
+    def test_items(self):
+        route = _Pages(10)
+        self.server.add_route('GET', '/api/1/sightings', route)
+
+        for prefetch in (True, False):
+            items = list(apiclient.iterate_items(self.server.url, 'ListSightings', self.opts, pool=self.pool,
+                                                 prefetch=prefetch))
+
+            self.assertEqual(items, route.sightings)
+
+    def test_start_from_cursor(self):
+        route = _Pages(8)
+        self.server.add_route('GET', '/api/1/sightings', route)
+        self.opts.cursor = '5'
+
+        items = list(apiclient.iterate_items(self.server.url, 'ListSightings', self.opts, pool=self.pool))
+
+        self.assertEqual(items, route.sightings[5:])
+
+    def test_repeated_cursor_or_empty_page_ends_listing(self):
+        self.server.add_route('GET', '/api/1/sightings', lambda request: json_response(
+            {'sightings': [{'sighting_id': 's0'}], 'cursor': 'same'}))
+        self.server.add_route('GET', '/api/1/users', lambda request: json_response(
+            {'sightings': [], 'cursor': 'more'}))
+
+        for prefetch in (True, False):
+            items = list(apiclient.iterate_items(self.server.url, 'ListSightings', self.opts, pool=self.pool,
+                                                 prefetch=prefetch))
+            self.assertEqual(len(items), 2)
+
+            self.opts.user_id = 'u1'
+            pages = list(apiclient.iterate_pages(self.server.url, 'ListUserSightings', self.opts,
+                                                 pool=self.pool, prefetch=prefetch))
+            self.assertEqual(pages, [{'sightings': [], 'cursor': 'more'}])
+
+    def test_errors(self):
+        self.server.add_route('GET', '/api/1/sightings', _Pages(8, failing=3))
+
+        with self.assertRaises(apiclient.APIError) as raised:
+            list(apiclient.iterate_items(self.server.url, 'ListSightings', self.opts, pool=self.pool))
+
+        self.assertEqual(raised.exception.status_code, 503)
+
+        with self.assertRaises(apiclient.Error):
+            list(apiclient.iterate_items(self.server.url, 'GetSighting', self.opts, pool=self.pool))
+
+class AllPagesTest(unittest.TestCase):
+    def _run(self, route, output, *args):
+        """Run ListSightings --all-pages on the command-line.
+
+        Returns:
+        A tuple containing the exit code and what was written to stdout.
+        """
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/sightings', route)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+
+            try:
+                exit_code = apiclient.main([server.url, 'ListSightings', '--all-pages', '--no-cache',
+                                            '--retries=0', '--fetch-size=3', '--output=' + output] + list(args))
+                return exit_code, sys.stdout.getvalue()
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+    def test_formats(self):
+        route = _Pages(8)
+
+        for output in ('pretty', 'compact'):
+            exit_code, written = self._run(route, output)
+
+            self.assertEqual(exit_code, 0)
+            self.assertEqual(json.loads(written), route.sightings)
+
+        exit_code, written = self._run(route, 'compact')
+        self.assertTrue(written.startswith('[{'))
+        self.assertEqual(written.count('\n'), 1)
+
+        exit_code, written = self._run(route, 'ndjson')
+        self.assertEqual([json.loads(line) for line in written.splitlines()], route.sightings)
+
+    def test_no_results(self):
+        for output in ('pretty', 'compact'):
+            self.assertEqual(self._run(_Pages(0), output), (0, '[]\n'))
+
+    def test_error_closes_list(self):
+        route = _Pages(8, failing=6)
+
+        for output in ('pretty', 'compact'):
+            exit_code, written = self._run(route, output)
+
+            # The list of the results received is closed before the response
+            self.assertEqual(exit_code, -2)
+            decoder = json.JSONDecoder()
+            results, end = decoder.raw_decode(written)
+            self.assertEqual(results, route.sightings[:6])
+            self.assertEqual(json.loads(written[end:]), {'error': 'Unavailable'})
+
+class _ClosedPipe(object):
+    """A stream that fails to be written to, as stdout does once the reader
+    of a pipe has gone away.
+    """
+    def write(self, data):
+        raise IOError(32, 'Broken pipe')
+
+class StreamedOutputTest(unittest.TestCase):
+    def test_failed_write_releases_connection(self):
+        pool = apiclient.ConnectionPool(max_per_host=1)
+
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/sightings', _Pages(8))
+            opts, _ = apiclient._create_option_parser().parse_args(['--output=ndjson', '--retries=0'])
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = _ClosedPipe(), StringIO.StringIO()
+
+            try:
+                with self.assertRaises(IOError):
+                    apiclient.run(server.url, 'ListSightings', opts, pool=pool)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+
+            # No request to the host is left in progress
+            limit = pool._host_limit(server.url.partition('//')[2])
+            self.assertTrue(limit.acquire(False))
+            limit.release()
+            pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests of making requests through a proxy given in the environment.
+"""
+
+import os
+import socket
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+_PROXY_VARIABLES = ('http_proxy', 'https_proxy', 'no_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY')
+
+class ProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict((name, os.environ.pop(name)) for name in _PROXY_VARIABLES if name in os.environ)
+        self.proxy = StandInServer()
+        self.proxy.add_route('GET', '/', lambda request: json_response({'forwarded': request.url}))
+        self.proxy.add_route('CONNECT', '', lambda request: (403, {}, ''))
+        self.proxy.__enter__()
+        self.proxy_address = self.proxy.url[len('http://'):]
+        self.pool = apiclient.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.proxy.__exit__(None, None, None)
+
+        for name in _PROXY_VARIABLES:
+            os.environ.pop(name, None)
+
+        os.environ.update(self.environ)
+
+    def test_http(self):
+        os.environ['http_proxy'] = 'http://user:p%40ss@' + self.proxy_address
+
+        for timing in (None, apiclient.RequestTiming()):
+            response = self.pool.request('GET', 'http://api.example.com/api/1/meta?a=1', timing=timing)
+
+            self.assertEqual(response.body, '{"forwarded": "http://api.example.com/api/1/meta?a=1"}')
+
+        request = self.proxy.received[0]
+        self.assertEqual(request.headers['Host'], 'api.example.com')
+        self.assertEqual(request.headers['Proxy-Authorization'], 'Basic dXNlcjpwQHNz')
+
+        # The connection to the proxy is reused
+        self.assertEqual(timing.reused, True)
+
+    def test_https_tunnel(self):
+        os.environ['https_proxy'] = 'user:secret@' + self.proxy_address
+
+        for timing in (None, apiclient.RequestTiming()):
+            with self.assertRaises(socket.error) as raised:
+                self.pool.request('GET', 'https://api.example.com/api/1/meta', timing=timing)
+
+            self.assertIn('Tunnel connection failed: 403', str(raised.exception))
+
+        request = self.proxy.received[0]
+        self.assertEqual(request.method, 'CONNECT')
+        self.assertEqual(request.url, 'api.example.com:443')
+        self.assertEqual(request.headers['Proxy-Authorization'], 'Basic dXNlcjpzZWNyZXQ=')
+
+    def test_no_proxy(self):
+        with StandInServer() as server:
+            server.add_route('GET', '/', lambda request: json_response({'direct': True}))
+            os.environ['http_proxy'] = self.proxy.url
+            os.environ['no_proxy'] = 'example.com,127.0.0.1'
+
+            response = self.pool.request('GET', server.url + '/api/1/meta')
+
+        self.assertEqual(response.body, '{"direct": true}')
+        self.assertEqual(self.proxy.received, [])
+
+    def test_unsupported_proxy(self):
+        os.environ['http_proxy'] = 'socks5://' + self.proxy_address
+
+        with self.assertRaises(apiclient.Error):
+            self.pool.request('GET', 'http://api.example.com/api/1/meta')
+
+if __name__ == '__main__':
+    unittest.main()
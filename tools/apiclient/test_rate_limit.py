@@ -0,0 +1,163 @@
+"""Tests of pacing requests with RateLimiter and retrying throttled requests
+against a local stand-in server.
+"""
+
+import threading
+import time
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class RateLimiterTest(unittest.TestCase):
+    def test_pacing(self):
+        limiter = apiclient.RateLimiter(rate=50)
+        start = time.time()
+
+        for _ in range(6):
+            limiter.release(limiter.acquire(), 200)
+
+        # The first request is made at once and the others a fiftieth of a
+        # second apart
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_throttling_halves_window_and_rate_once(self):
+        limiter = apiclient.RateLimiter(rate=100, burst=4, max_concurrency=8)
+        tickets = [limiter.acquire() for _ in range(4)]
+
+        limiter.release(tickets[0], 429)
+        self.assertEqual((limiter.concurrency, limiter.rate), (4.0, 50.0))
+
+        # Requests made before backing off do not back off again
+        limiter.release(tickets[1], 503)
+        self.assertEqual((limiter.concurrency, limiter.rate, limiter.throttled), (4.0, 50.0, 2))
+
+        # Other responses grow the window by one for every window's worth
+        limiter.release(tickets[2], 200)
+        self.assertEqual(limiter.concurrency, 4.25)
+        self.assertAlmostEqual(limiter.rate, 50.2)
+
+        # A failed request neither backs off nor grows
+        limiter.release(tickets[3])
+        self.assertEqual(limiter.concurrency, 4.25)
+
+        ticket = limiter.acquire()
+        limiter.release(ticket, 429)
+        self.assertEqual(limiter.concurrency, 2.125)
+
+    def test_window_unlimited_until_throttled(self):
+        limiter = apiclient.RateLimiter()
+        tickets = [limiter.acquire() for _ in range(6)]
+
+        self.assertIsNone(limiter.concurrency)
+
+        # The window starts from the number of requests that were in progress
+        limiter.release(tickets[0], 429)
+        self.assertEqual(limiter.concurrency, 3.0)
+
+    def test_window_limits_requests_in_progress(self):
+        limiter = apiclient.RateLimiter(max_concurrency=1)
+        ticket = limiter.acquire()
+        acquired = []
+
+        def acquire():
+            acquired.append(limiter.acquire())
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join(0.05)
+
+        self.assertEqual(acquired, [])
+
+        limiter.release(ticket, 200)
+        thread.join()
+        self.assertEqual(len(acquired), 1)
+
+    def test_retry_after_holds_back_requests(self):
+        limiter = apiclient.RateLimiter()
+        limiter.release(limiter.acquire(), 503, retry_after=0.1)
+        start = time.time()
+
+        limiter.acquire()
+
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_retry_after_header(self):
+        self.assertEqual(apiclient._retry_after(['Retry-After: 5\r\n']), 5.0)
+        self.assertEqual(apiclient._retry_after(['Retry-After: Wed, 21 Oct 2015 07:28:00 GMT\r\n']), 0.0)
+        self.assertIsNone(apiclient._retry_after(['Retry-After: soon\r\n']))
+        self.assertIsNone(apiclient._retry_after([]))
+
+class _Throttling(object):
+    """A route throttling the first requests it receives.
+    """
+    def __init__(self, throttled, status_code=429, retry_after='0'):
+        self.throttled = throttled
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def __call__(self, request):
+        if self.throttled > 0:
+            self.throttled -= 1
+            return json_response({'error': 'Slow down'}, self.status_code, headers={'Retry-After': self.retry_after})
+
+        return json_response({'name': 'meta'})
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff = apiclient._RETRY_BACKOFF
+        apiclient._RETRY_BACKOFF = 0
+        self.server = StandInServer()
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        apiclient._RETRY_BACKOFF = self.backoff
+
+    def _request(self, pool, http_method='GET'):
+        try:
+            return pool.request(http_method, self.server.url + '/api/1/meta', '' if http_method == 'POST' else None)
+        finally:
+            pool.close()
+
+    def test_throttled_requests_retried(self):
+        for status_code in (429, 503):
+            del self.server.received[:]
+            self.server.add_route('GET', '/api/1/meta', _Throttling(2, status_code))
+            limiter = apiclient.RateLimiter()
+
+            response = self._request(apiclient.ConnectionPool(rate_limiter=limiter, retries=3))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(self.server.received), 3)
+            self.assertEqual(limiter.throttled, 2)
+
+    def test_last_throttled_response_returned(self):
+        self.server.add_route('GET', '/api/1/meta', _Throttling(10))
+
+        response = self._request(apiclient.ConnectionPool(retries=2))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(self.server.received), 3)
+
+    def test_posts_only_retried_if_asked(self):
+        self.server.add_route('POST', '/api/1/meta', _Throttling(1))
+        self.assertEqual(self._request(apiclient.ConnectionPool(retries=3), 'POST').status_code, 429)
+        self.assertEqual(len(self.server.received), 1)
+
+        self.server.add_route('POST', '/api/1/meta', _Throttling(1))
+        self.assertEqual(self._request(apiclient.ConnectionPool(retries=3, retry_posts=True), 'POST').status_code,
+                         200)
+        self.assertEqual(len(self.server.received), 3)
+
+    def test_retry_waits_for_retry_after(self):
+        self.server.add_route('GET', '/api/1/meta', _Throttling(1, retry_after='0.2'))
+        start = time.time()
+
+        response = self._request(apiclient.ConnectionPool(retries=1))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Tests of the compact Record types holding the results of the API.
+"""
+
+import json
+import pickle
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+_SIGHTING = ('{"user_id": "u1", "sighting_id": "s1", "latitude": 51.5, "longitude": -0.125, '
+             '"description": "Caf\\u00e9", "hold": false, "photo": {"width": 640, "sizes": [1, 2]}}')
+
+_USER = ('{"user_id": "u1", "name": "Matt", "avatar": {"url": "http://example.com/a.png"}, '
+         '"settings": {"tweet_by_default": false}}')
+
+class RecordTest(unittest.TestCase):
+    def test_fields(self):
+        data = json.loads(_SIGHTING)
+        sighting = apiclient.Sighting.from_dict(data)
+
+        self.assertIsInstance(sighting, apiclient.Sighting)
+        self.assertEqual(sighting.to_dict(), data)
+        self.assertEqual(sighting.latitude, 51.5)
+        self.assertEqual(sighting['sighting_id'], 's1')
+        self.assertEqual(sighting.description, u'Caf\xe9')
+        self.assertIs(sighting.hold, False)
+        self.assertEqual(sighting.photo, {'width': 640, 'sizes': [1, 2]})
+        self.assertEqual(sorted(sighting.keys()), sorted(data))
+        self.assertEqual(sorted(sighting), sorted(data))
+        self.assertEqual(len(sighting), len(data))
+        self.assertIn('photo', sighting)
+
+        # Known fields the API didn't return are None, other fields are missing
+        self.assertIsNone(sighting.altitude)
+        self.assertNotIn('altitude', sighting)
+        self.assertIsNone(sighting.get('altitude'))
+        self.assertEqual(sighting.get('altitude', 0), 0)
+
+        with self.assertRaises(AttributeError):
+            sighting.colour
+
+        with self.assertRaises(KeyError):
+            sighting['altitude']
+
+    def test_compact(self):
+        first = apiclient.Sighting.from_dict(json.loads(_SIGHTING))
+        second = apiclient.Sighting.from_dict(json.loads(_SIGHTING))
+
+        # Records with the same fields share a class and have no dictionary
+        self.assertIs(type(first), type(second))
+        self.assertFalse(hasattr(first, '__dict__'))
+
+        # ASCII strings are byte strings and ids are stored once
+        self.assertIs(type(first.sighting_id), str)
+        self.assertIs(first.user_id, second.user_id)
+
+        with self.assertRaises(AttributeError):
+            first.latitude = 0
+
+    def test_nested_fields(self):
+        user = apiclient.User.from_dict(json.loads(_USER))
+
+        self.assertEqual(user.avatar, {'url': 'http://example.com/a.png'})
+        self.assertEqual(user['settings'], {'tweet_by_default': False})
+
+        # Decoded each time, so changing the result doesn't change the Record
+        user.avatar['url'] = None
+        self.assertEqual(user.avatar['url'], 'http://example.com/a.png')
+
+        self.assertIsNone(apiclient.User.from_dict({'user_id': 'u2'}).avatar)
+
+    def test_fields_only_available_by_name(self):
+        record = apiclient.Record.from_dict({'keys': 1, 'not-a-name': 2, 'class': 3, u'caf\xe9': 4})
+
+        self.assertEqual(set(record.keys()), set(['class', 'keys', 'not-a-name', u'caf\xe9']))
+        self.assertEqual((record['keys'], record['not-a-name'], record['class'], record[u'caf\xe9']), (1, 2, 3, 4))
+
+    def test_pickle(self):
+        records = [apiclient.Sighting.from_dict(json.loads(_SIGHTING)), apiclient.User.from_dict(json.loads(_USER))]
+
+        for record in records:
+            copy = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+            self.assertIs(type(copy), type(record))
+            self.assertEqual(copy.to_dict(), record.to_dict())
+
+    def test_sighting_index(self):
+        index = apiclient.SightingIndex()
+        index.update([apiclient.Sighting.from_dict(json.loads(_SIGHTING))])
+
+        self.assertEqual([sighting['sighting_id'] for sighting in index.within(50, -1, 52, 1)], ['s1'])
+
+class IterateRecordsTest(unittest.TestCase):
+    def test_record_types(self):
+        with StandInServer() as server:
+            server.add_route('GET', '/api/1/users/u1/sightings', lambda request: json_response(
+                {'sightings': [json.loads(_SIGHTING)]}))
+            server.add_route('GET', '/api/1/users/u1/statistics/countries', lambda request: json_response(
+                {'statistics': [{'country': 'GB', 'count': 3}]}))
+            client = apiclient.ResightingClient(server.url, cache=None)
+
+            try:
+                sightings = list(client.iterate_records('ListUserSightings', user_id='u1'))
+                statistics = list(client.iterate_records('ListUserCountryStatistics', user_id='u1'))
+            finally:
+                client.close()
+
+        self.assertEqual([type(sighting).__bases__ for sighting in sightings], [(apiclient.Sighting,)])
+        self.assertEqual(sightings[0].to_dict(), json.loads(_SIGHTING))
+        self.assertIsInstance(statistics[0], apiclient.CountryStatistics)
+        self.assertEqual(statistics[0].count, 3)
+
+if __name__ == '__main__':
+    unittest.main()
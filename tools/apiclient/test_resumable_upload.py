@@ -0,0 +1,129 @@
+"""Tests of resumable uploads against the stand-in upload endpoint.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import apiclient
+from stand_in_server import ResumableUpload, StandInServer
+
+_CHUNK_SIZE = 1000000
+
+class _Crash(Exception):
+    pass
+
+class _CrashingPool(apiclient.ConnectionPool):
+    """A pool that fails as if the process was killed after a number of
+    requests.
+    """
+    def __init__(self, requests):
+        apiclient.ConnectionPool.__init__(self)
+        self.remaining = requests
+
+    def request(self, *args, **kwargs):
+        if self.remaining == 0:
+            raise _Crash()
+
+        self.remaining -= 1
+
+        return apiclient.ConnectionPool.request(self, *args, **kwargs)
+
+class ResumableUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'photo.jpg')
+        self.checkpoint_file = self.filename + '.checkpoint'
+        self.data = os.urandom(2500000)
+
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+
+        self.upload = ResumableUpload()
+        self.server = StandInServer()
+        self.server.add_route('PUT', '/upload', self.upload)
+        self.server.__enter__()
+        self.upload_url = self.server.url + '/upload'
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def _content_ranges(self, start=0):
+        return [request.headers['Content-Range'] for request in self.server.received[start:]]
+
+    def _interrupt(self):
+        """Start the upload and crash when sending the third chunk.
+        """
+        pool = _CrashingPool(2)
+
+        with self.assertRaises(_Crash):
+            apiclient.resumable_upload(self.upload_url, self.filename, pool=pool, chunk_size=_CHUNK_SIZE)
+
+        pool.close()
+
+    def _check_complete(self, result):
+        body, status_code, _ = result
+
+        self.assertEqual(status_code, 201)
+        self.assertEqual(json.loads(body)['md5'], hashlib.md5(self.data).hexdigest())
+        self.assertEqual(self.upload.uploads['/upload'], self.data)
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+
+    def test_upload(self):
+        pool = apiclient.ConnectionPool()
+        result = apiclient.resumable_upload(self.upload_url, self.filename, pool=pool,
+                                            chunk_size=_CHUNK_SIZE, use_mmap=True)
+        pool.close()
+
+        self._check_complete(result)
+        self.assertEqual(self._content_ranges(), ['bytes 0-999999/2500000', 'bytes 1000000-1999999/2500000',
+                                                  'bytes 2000000-2499999/2500000'])
+
+    def test_resume_from_checkpoint(self):
+        self._interrupt()
+
+        with open(self.checkpoint_file) as f:
+            self.assertEqual(json.load(f)['acknowledged'], [[0, 2000000]])
+
+        sent = len(self.server.received)
+        pool = apiclient.ConnectionPool()
+        result = apiclient.resumable_upload(self.upload_url, self.filename, pool=pool, chunk_size=_CHUNK_SIZE)
+        pool.close()
+
+        # Only the status and the chunk the server had not received are sent
+        self._check_complete(result)
+        self.assertEqual(self._content_ranges(sent), ['bytes */2500000', 'bytes 2000000-2499999/2500000'])
+
+    def test_changed_file_ignores_checkpoint(self):
+        self._interrupt()
+        os.utime(self.filename, (0, 0))
+
+        sent = len(self.server.received)
+        pool = apiclient.ConnectionPool()
+        result = apiclient.resumable_upload(self.upload_url, self.filename, pool=pool, chunk_size=_CHUNK_SIZE)
+        pool.close()
+
+        self._check_complete(result)
+        self.assertEqual(self._content_ranges(sent)[0], 'bytes 0-999999/2500000')
+
+    def test_command_line_exit_code(self):
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO.StringIO()
+
+        try:
+            exit_code = apiclient.main([self.server.url, 'Upload', '--resumable', '--no-cache',
+                                        '--upload-url=' + self.upload_url, '--filename=' + self.filename])
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(self.upload.uploads['/upload'], self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Tests of SightingIndex against a brute-force search of the same Sightings.
+
+Run with: python -m unittest discover -s tools/apiclient
+"""
+
+import random
+import unittest
+
+import apiclient
+
+def _sighting(i, latitude, longitude):
+    return {'user_id': 'u1', 'sighting_id': 's%d' % i, 'latitude': latitude, 'longitude': longitude}
+
+def _ids(sightings):
+    return sorted(sighting['sighting_id'] for sighting in sightings)
+
+def _brute_within(sightings, south, west, north, east):
+    found = []
+
+    for sighting in sightings:
+        latitude, longitude = sighting['latitude'], sighting['longitude']
+
+        if not south <= latitude <= north:
+            continue
+
+        if west > east:
+            if west <= longitude or longitude <= east:
+                found.append(sighting)
+        elif west <= longitude <= east:
+            found.append(sighting)
+
+    return found
+
+class SightingIndexTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(21)
+        self.sightings = [_sighting(i, generator.uniform(-90, 90), generator.uniform(-180, 180))
+                          for i in range(2000)]
+
+        # Points on the edges of the world
+        self.sightings += [_sighting(2000 + i, latitude, longitude) for i, (latitude, longitude) in
+                           enumerate([(0, 180), (0, -180), (10, 179.999), (-10, -179.999), (90, 0),
+                                      (-90, 0), (45, 170), (45, 180)])]
+
+    def _index(self, cell_size):
+        index = apiclient.SightingIndex(cell_size)
+        self.assertEqual(index.update(self.sightings), len(self.sightings))
+        return index
+
+    def test_empty_index(self):
+        index = apiclient.SightingIndex()
+
+        self.assertEqual(index.within(-90, -180, 90, 180), [])
+        self.assertEqual(index.within(0, 0, 1, 1), [])
+        self.assertEqual(index.nearest(0, 0), [])
+
+    def test_within_matches_brute_force(self):
+        boxes = [
+            (-90, -180, 90, 180),   # The whole world
+            (-90, 170, 90, 180),    # Up to the 180th meridian
+            (-90, -180, 90, -170),  # From the 180th meridian
+            (-90, 180, 90, 180),    # Just the 180th meridian
+            (-90, 170, 90, -170),   # Across the 180th meridian
+            (-90, 180, 90, -170),   # Across, starting on the meridian
+            (80, -180, 90, 180),    # Around the north pole
+            (-10, -10, 10, 10),
+            (40, 179, 50, 180),
+            (10, 10, 10, 10),       # A box with nothing in it
+        ]
+
+        generator = random.Random(42)
+
+        for _ in range(100):
+            south, north = sorted(generator.uniform(-90, 90) for _ in range(2))
+            boxes.append((south, generator.uniform(-180, 180), north, generator.uniform(-180, 180)))
+
+        for cell_size in (0.01, 1.0, 7.0):
+            index = self._index(cell_size)
+
+            for box in boxes:
+                expected = _ids(_brute_within(self.sightings, *box))
+                self.assertEqual(_ids(index.within(*box)), expected, (cell_size, box))
+
+    def test_nearest_matches_brute_force(self):
+        generator = random.Random(7)
+
+        for cell_size in (0.01, 1.0):
+            index = self._index(cell_size)
+
+            for latitude, longitude in [(0, 180), (0, -179.9), (89.9, 0)] + [
+                    (generator.uniform(-90, 90), generator.uniform(-180, 180)) for _ in range(50)]:
+                expected = sorted(apiclient._distance(latitude, longitude, sighting['latitude'],
+                                                      sighting['longitude'])
+                                  for sighting in self.sightings)[:5]
+                found = index.nearest(latitude, longitude, k=5)
+
+                self.assertEqual(len(found), 5)
+
+                for (distance, _), expected_distance in zip(found, expected):
+                    self.assertAlmostEqual(distance, expected_distance, places=3)
+
+    def test_replace_and_remove(self):
+        index = apiclient.SightingIndex()
+        index.add(_sighting(1, 10, 10))
+        index.add(_sighting(1, 20, 20))
+
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.within(15, 15, 25, 25)[0]['latitude'], 20)
+        self.assertTrue(index.remove(('u1', 's1')))
+        self.assertEqual(index.within(-90, -180, 90, 180), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Tests of mirroring a user's Sightings into SQLite with --sync against a local
+stand-in server.
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import apiclient
+from stand_in_server import StandInServer, json_response
+
+class _Account(object):
+    """Routes answering the List methods for a user's Sightings, their
+    Resightings and the Locators they belong to, a page at a time.
+    """
+    def __init__(self):
+        self.sightings = [{'user_id': 'u1', 'sighting_id': 's%d' % i, 'latitude': i,
+                           'update_date': '2012-04-%02dT00:00:00Z' % (i + 1)} for i in xrange(5)]
+
+    def _page(self, request, name, items):
+        position = int(request.param('cursor', '0'))
+        fetch_size = int(request.param('fetch_size', '20'))
+        page = {name: items[position:position + fetch_size]}
+
+        if position + fetch_size < len(items):
+            page['cursor'] = str(position + fetch_size)
+
+        return json_response(page)
+
+    def list_sightings(self, request):
+        start_date = request.param('start_date', '')
+        updated = [sighting for sighting in self.sightings if sighting['update_date'] >= start_date]
+
+        return self._page(request, 'sightings', updated)
+
+    def list_details(self, request):
+        _, _, _, _, user_id, sighting_id, kind = request.path.split('/')
+
+        if kind == 'resightings':
+            items = [{'user_id': 'u2', 'sighting_id': '%s-r%d' % (sighting_id, i)} for i in xrange(3)]
+        else:
+            items = [{'locator_id': '%s-l%d' % (sighting_id, i)} for i in xrange(2)]
+
+        return self._page(request, kind, items)
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'sightings.db')
+        self.account = _Account()
+        self.server = StandInServer()
+        self.server.add_route('GET', '/api/1/sightings', self.account.list_details)
+        self.server.add_route('GET', '/api/1/users/u1/sightings', self.account.list_sightings)
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        shutil.rmtree(self.directory)
+
+    def _sync(self, *args):
+        """Run --sync on the command-line.
+
+        Returns:
+        The summary written to stdout.
+        """
+        del self.server.received[:]
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+
+        try:
+            exit_code = apiclient.main([self.server.url, '--sync=' + self.database, '--user-id=u1',
+                                        '--fetch-size=2'] + list(args))
+            written = sys.stdout.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        self.assertEqual(exit_code, 0, written)
+
+        return json.loads(written)
+
+    def _query(self, sql):
+        connection = sqlite3.connect(self.database)
+
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_mirror(self):
+        for args in ([], ['--concurrency=4']):
+            if os.path.exists(self.database):
+                os.remove(self.database)
+
+            counts = self._sync(*args)
+
+            self.assertEqual(counts['sightings'], 5)
+            self.assertEqual(counts['resightings'], 15)
+            self.assertEqual(counts['locators'], 10)
+            self.assertEqual(counts['high_water_mark'], '2012-04-05T00:00:00Z')
+
+            self.assertEqual(self._query('SELECT sighting_id, latitude FROM sightings ORDER BY sighting_id'),
+                             [('s%d' % i, i) for i in xrange(5)])
+            self.assertEqual(self._query("SELECT position, resighting_id FROM resightings "
+                                         "WHERE sighting_id = 's3' ORDER BY position"),
+                             [(i, 's3-r%d' % i) for i in xrange(3)])
+            self.assertEqual(self._query("SELECT locator_id FROM sighting_locators "
+                                         "WHERE sighting_id = 's1' ORDER BY position"),
+                             [('s1-l0',), ('s1-l1',)])
+
+    def test_incremental(self):
+        self._sync()
+
+        self.account.sightings[1] = dict(self.account.sightings[1], latitude=50,
+                                         update_date='2012-05-01T00:00:00Z')
+        counts = self._sync()
+
+        # Only the Sightings updated since the last sync are fetched again
+        self.assertEqual(self.server.received[0].param('start_date'), '2012-04-05T00:00:00Z')
+        self.assertEqual(counts['sightings'], 2)
+        self.assertEqual(counts['high_water_mark'], '2012-05-01T00:00:00Z')
+        self.assertEqual(self._query("SELECT latitude FROM sightings WHERE sighting_id = 's1'"), [(50,)])
+        self.assertEqual(self._query('SELECT COUNT(*) FROM sightings'), [(5,)])
+        self.assertEqual(self._query('SELECT COUNT(*) FROM resightings'), [(15,)])
+
+    def test_listing_options_not_passed_on(self):
+        counts = self._sync('--cursor=3', '--access-token=token')
+
+        self.assertEqual(counts['sightings'], 2)
+
+        details = [request for request in self.server.received if '/api/1/sightings/' in request.path]
+        self.assertEqual(len(details), 6)
+
+        for request in details:
+            self.assertEqual(request.param('access_token'), 'token')
+
+        # Every Resighting and Locator is fetched from the first page
+        self.assertEqual(sorted(request.param('cursor') for request in details), [None] * 4 + ['2'] * 2)
+        self.assertEqual(self._query('SELECT COUNT(*) FROM resightings'), [(6,)])
+
+if __name__ == '__main__':
+    unittest.main()